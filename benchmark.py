@@ -0,0 +1,1777 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the chatbot handlers
+
+Runs the Lambda handler and the bot.py handlers against local stand-ins of the
+Telegram Bot API, the OpenAI API, the DynamoDB table and the S3 bucket, reporting
+the latency percentiles, round trips and bytes of each handler and comparing them
+against a stored baseline. The conversation storage (hot DynamoDB tail and S3
+segments) and the memory index may also be measured on long histories.
+
+"""
+
+# Main dependencies
+import argparse
+import importlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Settings used by the handlers while benchmarking
+bot_token = "123456:benchmark"
+admin_chat_id = 1000
+table_name = "chatgpt-benchmark"
+bucket_name = "chatgpt-benchmark"
+
+# Requests and payload bytes received by the stand-ins, per service
+traffic = Counter()
+traffic_lock = threading.Lock()
+
+# Latency (in seconds) added to each request, per service
+latency = {"telegram": 0.0, "openai": 0.0, "dynamodb": 0.0, "s3": 0.0}
+
+# Rate limits enforced by the stand-ins (0 to disable): messages per second to each
+# chat on Telegram and requests per minute on OpenAI
+limits = {"telegram_chat_rate": 0, "openai_rpm": 0}
+# Times of the recent calls under each limit
+limit_windows = {}
+
+
+# Function to check a rate limit, returning how long (in seconds) the call must wait
+# if it's over the limit, or 0 if it's accepted
+def check_limit(key, limit, window):
+    now = time.monotonic()
+    with traffic_lock:
+        calls = limit_windows.setdefault(key, deque())
+        while calls and calls[0] <= now - window:
+            calls.popleft()
+        if len(calls) >= limit:
+            return calls[0] + window - now
+        calls.append(now)
+        return 0
+
+
+# Latency (in seconds) of the image generations, which take longer than the other requests
+image_latency = 0.0
+
+# Latency spikes of the chat completions: the share of them that is delayed, and by how
+# long (in seconds), drawn from a seeded generator so the runs are comparable
+spikes = {"rate": 0.0, "latency": 0.0}
+spikes_random = random.Random(0)
+
+
+# Function to get the latency of a chat completion, with its spike (if it got one)
+def get_openai_latency():
+    with traffic_lock:
+        spiked = spikes_random.random() < spikes["rate"]
+    return latency["openai"] + (spikes["latency"] if spiked else 0)
+
+
+# Delay (in seconds) between the chunks of a streamed chat completion
+stream_chunk_latency = 0.0
+
+# Text of the chat completions, and the photo downloaded from the Bot API
+reply_text = "benchmark"
+photo_bytes = b"\xff\xd8"
+# Photos downloaded from the Bot API by the name of their file ID (before its "-<n>"), in
+# place of photo_bytes
+photo_files = {}
+
+# If enabled, the OpenAI stand-in discards the large request bodies (only counting them),
+# so its own copies don't add to the memory measured on the handlers
+discard_uploads = False
+
+
+# Function to get the embedding of a text, drawn from a generator seeded by its words, so
+# texts sharing words get similar embeddings
+def fake_embedding(text, dimensions):
+    embedding = [0.0] * dimensions
+    for word in text.lower().split():
+        rng = random.Random(word)
+        for i in range(dimensions):
+            embedding[i] += rng.gauss(0, 1)
+    return embedding
+
+
+# Updates waiting to be fetched with getUpdates (by a bot.py server polling the stand-in)
+pending_updates = deque()
+pending_updates_ready = threading.Condition()
+
+# Functions called with the method, parameters and result of each Bot API call answered
+telegram_listeners = []
+
+
+# Function to queue an update, to be fetched with getUpdates
+def push_update(update):
+    with pending_updates_ready:
+        pending_updates.append(update)
+        pending_updates_ready.notify_all()
+
+
+# Function to get the updates from an offset on, waiting up to a timeout (in seconds) for
+# one to arrive (the updates before the offset were confirmed, so they're dropped)
+def take_updates(offset, timeout, limit=100):
+    deadline = time.monotonic() + timeout
+    with pending_updates_ready:
+        while True:
+            while pending_updates and pending_updates[0]["update_id"] < offset:
+                pending_updates.popleft()
+            remaining = deadline - time.monotonic()
+            if pending_updates or remaining <= 0:
+                return list(pending_updates)[:limit]
+            pending_updates_ready.wait(remaining)
+
+
+# Function to count a request (and its payload bytes) made to a service
+def record_traffic(service, size):
+    with traffic_lock:
+        traffic[f"{service}_requests"] += 1
+        traffic[f"{service}_bytes"] += size
+
+
+# Local stand-in of the Telegram Bot API and the OpenAI API
+# The services are told apart by the request path
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    # The clients may drop their connections (e.g. a bot.py server stopping while polling)
+    def handle(self):
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    # Function to read the request parameters (JSON, form or query string)
+    def read_params(self):
+        size = int(self.headers.get("Content-Length") or 0)
+        url = urlparse(self.path)
+        if discard_uploads and url.path.startswith("/v1/") and size > 64 * 1024:
+            for start in range(0, size, 64 * 1024):
+                self.rfile.read(min(64 * 1024, size - start))
+            return url.path, {}, size
+        body = self.rfile.read(size) if size else b""
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if body and "json" in self.headers.get("Content-Type", ""):
+            params.update(json.loads(body))
+        elif body and "multipart" not in self.headers.get("Content-Type", ""):
+            params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        return url.path, params, len(body)
+
+    # Function to send a response, counting its payload bytes
+    def send_payload(
+        self,
+        service,
+        size,
+        payload,
+        content_type="application/json",
+        status=200,
+        headers=None,
+    ):
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        record_traffic(service, size + len(payload))
+        if status == 429:
+            with traffic_lock:
+                traffic[f"{service}_rejected"] += 1
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def handle_request(self):
+        path, params, size = self.read_params()
+        if path.endswith(("/sendMediaGroup", "/images/generations")):
+            kind = "telegram_albums" if "Group" in path else "openai_images"
+            with traffic_lock:
+                traffic[kind] += 1
+        if path.startswith("/v1/"):
+            with traffic_lock:
+                traffic["openai_upload_bytes"] += size
+            images = path.endswith("/images/generations")
+            time.sleep(image_latency if images else get_openai_latency())
+            return self.handle_openai(path, params, size)
+        time.sleep(latency["telegram"])
+        if path.startswith("/file/"):
+            photo = photo_files.get(path.rsplit("/", 1)[-1][:-4], photo_bytes)
+            with traffic_lock:
+                traffic["telegram_file_bytes"] += len(photo)
+            return self.send_payload("telegram", size, photo, "image/jpeg")
+        return self.handle_telegram(path.rsplit("/", 1)[-1], params, size)
+
+    # Function to answer the Bot API methods used by the handlers
+    def handle_telegram(self, method, params, size):
+        chat = {"id": int(params.get("chat_id") or admin_chat_id), "type": "private"}
+        message = {"message_id": 1, "date": int(time.time()), "chat": chat}
+
+        # Rejecting the messages over the chat's limit, as Telegram does
+        if limits["telegram_chat_rate"] and method.startswith(("send", "edit")):
+            wait = check_limit(chat["id"], limits["telegram_chat_rate"], 1)
+            if wait:
+                retry_after = math.ceil(wait)
+                payload = {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                }
+                return self.send_payload("telegram", size, payload, status=429)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark"}
+        elif method == "getFile":
+            name = str(params.get("file_id")).rsplit("-", 1)[0]
+            result = {
+                "file_id": params.get("file_id"),
+                "file_unique_id": params.get("file_id"),
+                "file_size": len(photo_files.get(name, photo_bytes)),
+                "file_path": f"photos/{name}.jpg",
+            }
+        elif method == "getUpdates":
+            result = take_updates(
+                int(params.get("offset") or 0),
+                float(params.get("timeout") or 0),
+                int(params.get("limit") or 100),
+            )
+        elif method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            result = {**message, "text": params.get("text", "")}
+        elif method == "sendMediaGroup":
+            result = [message for media in json.loads(params.get("media") or "[]")]
+        else:
+            result = True
+        for listener in telegram_listeners:
+            listener(method, params, result)
+        self.send_payload("telegram", size, {"ok": True, "result": result})
+
+    # Function to answer the OpenAI endpoints used by the handlers
+    def handle_openai(self, path, params, size):
+        created = int(time.time())
+
+        # Rejecting the requests over the limit, reporting it on the headers as OpenAI does
+        headers = {}
+        if limits["openai_rpm"]:
+            wait = check_limit("openai", limits["openai_rpm"], 60)
+            remaining = limits["openai_rpm"] - len(limit_windows["openai"])
+            headers = {
+                "x-ratelimit-limit-requests": str(limits["openai_rpm"]),
+                "x-ratelimit-remaining-requests": str(max(0, remaining)),
+                "x-ratelimit-reset-requests": f"{wait or 60 / limits['openai_rpm']:.3f}s",
+            }
+            if wait:
+                error = {"error": {"message": "Rate limit reached", "type": "requests"}}
+                return self.send_payload(
+                    "openai", size, error, status=429, headers=headers
+                )
+
+        if path.endswith("/chat/completions"):
+            model = params.get("model", "gpt-3.5-turbo")
+            usage = {
+                "prompt_tokens": size // 4,
+                "completion_tokens": len(reply_text) // 4,
+                "total_tokens": (size + len(reply_text)) // 4,
+            }
+            with traffic_lock:
+                traffic["openai_prompt_messages"] += len(params.get("messages") or [])
+                traffic["openai_prompt_tokens"] += usage["prompt_tokens"]
+            if params.get("stream"):
+                return self.send_stream(model, created, size, headers)
+            # The complete response takes as long as its chunks would be streamed
+            time.sleep(stream_chunk_latency * len(reply_text.split(" ")))
+            payload = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": reply_text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+        elif path.endswith("/embeddings"):
+            texts = params["input"]
+            texts = [texts] if isinstance(texts, str) else texts
+            dimensions = params.get("dimensions") or 1536
+            payload = {
+                "object": "list",
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": i,
+                        "embedding": fake_embedding(text, dimensions),
+                    }
+                    for i, text in enumerate(texts)
+                ],
+                "model": params.get("model"),
+                "usage": {
+                    "prompt_tokens": sum(len(text) // 4 for text in texts),
+                    "total_tokens": sum(len(text) // 4 for text in texts),
+                },
+            }
+        elif path.endswith("/images/generations"):
+            payload = {
+                "created": created,
+                "data": [
+                    {
+                        "url": f"http://{self.headers['Host']}/files/image.png",
+                        "revised_prompt": params.get("prompt"),
+                    }
+                ],
+            }
+        else:
+            payload = {
+                "id": path.rsplit("/", 1)[-1],
+                "object": "model",
+                "created": created,
+                "owned_by": "benchmark",
+            }
+        self.send_payload("openai", size, payload, headers=headers)
+
+    # Function to answer a streamed chat completion, one word per chunk
+    def send_stream(self, model, created, size, headers):
+        events = []
+        for word in reply_text.split(" "):
+            chunk = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": f"{word} "},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        events.append("data: [DONE]\n\n")
+        if not stream_chunk_latency:
+            return self.send_payload(
+                "openai",
+                size,
+                "".join(events).encode(),
+                "text/event-stream",
+                200,
+                headers,
+            )
+
+        # Writing the chunks as they would be generated, with a chunked body as OpenAI does
+        events = [event.encode() for event in events]
+        record_traffic("openai", size + sum(len(event) for event in events))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        for event in events:
+            time.sleep(stream_chunk_latency)
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+# Function to start a local AWS stand-in (moto's server of the DynamoDB or S3 service)
+# Each request is counted and delayed by a WSGI middleware, and run one at a time, as moto's
+# backends aren't safe to use from many threads (e.g. on the concurrent replays)
+def start_aws_service(service):
+    try:
+        from moto.server import DomainDispatcherApplication, create_backend_app
+        from werkzeug.serving import make_server
+    except ImportError:
+        sys.exit('The AWS stand-ins require moto: pip install "moto[server]"')
+
+    app = DomainDispatcherApplication(create_backend_app, service=service)
+    lock = threading.Lock()
+
+    def counted_app(environ, start_response):
+        time.sleep(latency.get(service, 0))
+        size = int(environ.get("CONTENT_LENGTH") or 0)
+        with lock:
+            start = time.perf_counter()
+            body = b"".join(app(environ, start_response))
+            with traffic_lock:
+                traffic[f"{service}_server_ms"] += (time.perf_counter() - start) * 1000
+        record_traffic(service, size + len(body))
+        return [body]
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, counted_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+# Function to start the Telegram and OpenAI stand-ins
+def start_fake_services():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServicesHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+# Function to create the conversations table and bucket on the AWS stand-ins
+def create_table(dynamodb_url, s3_url):
+    import boto3
+
+    credentials = {
+        "region_name": "us-east-1",
+        "aws_access_key_id": "benchmark",
+        "aws_secret_access_key": "benchmark",
+    }
+    boto3.client("s3", endpoint_url=s3_url, **credentials).create_bucket(
+        Bucket=bucket_name
+    )
+    client = boto3.client("dynamodb", endpoint_url=dynamodb_url, **credentials)
+    client.create_table(
+        TableName=table_name,
+        KeySchema=[
+            {"AttributeName": "pk", "KeyType": "HASH"},
+            {"AttributeName": "sk", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "pk", "AttributeType": "S"},
+            {"AttributeName": "sk", "AttributeType": "N"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+# Function to get the settings shared by both handlers, pointing to the stand-ins
+def get_settings(services_url, dynamodb_url, s3_url):
+    return {
+        "BOT_TOKEN": bot_token,
+        "ADMIN_CHAT_ID": str(admin_chat_id),
+        "OPENAI_API_KEY": "sk-benchmark",
+        "OPENAI_BASE_URL": f"{services_url}/v1/",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_REGION": "us-east-1",
+        "AWS_DYNAMODB": table_name,
+        "AWS_DYNAMODB_ENDPOINT": dynamodb_url,
+        "AWS_BUCKET": bucket_name,
+        "AWS_S3_ENDPOINT": s3_url,
+        # Pacing the calls would hide the handlers cost, unless the stand-ins enforce limits
+        "RATE_LIMITS": str(any(limits.values())).lower(),
+        # A short album window, so the album scenarios measure the requests rather than it
+        "ALBUM_WINDOW": "0.2",
+        # A fresh image cache, so the photos aren't taken from the disk of an earlier run
+        "IMAGE_CACHE_DIR": tempfile.mkdtemp(prefix="images-"),
+    }
+
+
+# Function to build a Telegram update, with a unique ID for each call
+update_ids = iter(range(1, 10**9))
+
+
+def make_update(text=None, **fields):
+    update_id = next(update_ids)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": admin_chat_id, "type": "private", "first_name": "Benchmark"},
+        "from": {"id": admin_chat_id, "is_bot": False, "first_name": "Benchmark"},
+        **fields,
+    }
+    if text is not None:
+        message["text"] = text
+    return {"update_id": update_id, "message": message}
+
+
+# Function to build a photo update, with unique file IDs (so no cached result or image is
+# used, even by the other handler)
+photo_ids = iter(range(1, 10**9))
+
+
+def make_photo_update(i):
+    n = next(photo_ids)
+    return make_update(
+        caption=f"What is in this picture? {i}",
+        photo=[
+            {
+                "file_id": f"small-{n}",
+                "file_unique_id": f"small-{n}",
+                "width": 90,
+                "height": 90,
+            },
+            {
+                "file_id": f"photo-{n}",
+                "file_unique_id": f"photo-{n}",
+                "width": 800,
+                "height": 800,
+            },
+        ],
+    )
+
+
+# Function to build the updates of an album of photos (only the first one has a caption)
+def make_album_updates(i, size=3):
+    updates = [make_photo_update(f"{i}-{n}") for n in range(size)]
+    for n, update in enumerate(updates):
+        update["message"]["media_group_id"] = f"album-{i}"
+        if n:
+            del update["message"]["caption"]
+    return updates
+
+
+# Function to build the updates of a text split across quick messages
+def make_fragment_updates(i):
+    texts = ["Tell me something", f"about the number {i}", "in a few words"]
+    return [make_update(text) for text in texts]
+
+
+# Updates used by each scenario, for the call number i
+# The texts are unique, so each call reaches the services
+scenario_updates = {
+    "text": lambda i: [make_update(f"Tell me something about the number {i}")],
+    "photo": lambda i: [make_photo_update(i)],
+    "album": make_album_updates,
+    "fragments": make_fragment_updates,
+    "image": lambda i: [
+        make_update(f"/image a lighthouse painted in style number {i}")
+    ],
+    "clear": lambda i: [make_update("/clear")],
+}
+
+
+# Function to run a handler on each update at the same time, as the separate
+# invocations of the updates would
+def run_concurrently(handler, updates):
+    threads = [threading.Thread(target=handler, args=(u,)) for u in updates]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Function to run a scenario with the messages coalescing enabled on a module
+def coalesced(module, run):
+    def wrapper(i):
+        module.coalesce_window = 0.2
+        try:
+            run(i)
+        finally:
+            module.coalesce_window = 0
+
+    return wrapper
+
+
+# Function to get the Lambda handler scenarios
+def get_lambda_scenarios(settings):
+    os.environ.update(settings)
+    lambda_function = importlib.import_module("lambda_function")
+
+    def handle(update):
+        lambda_function.lambda_handler({"body": json.dumps(update)}, None)
+
+    def scenario(name):
+        return lambda i: run_concurrently(handle, scenario_updates[name](i))
+
+    scenarios = {f"lambda_handler:{name}": scenario(name) for name in scenario_updates}
+    scenarios["lambda_handler:fragments"] = coalesced(
+        lambda_function, scenarios["lambda_handler:fragments"]
+    )
+    return scenarios
+
+
+# Function to import the bot.py server
+# The bot reads its settings from the .env file of the working directory
+def import_bot(settings):
+    if "bot" not in sys.modules:
+        os.chdir(tempfile.mkdtemp())
+        with open(".env", "w") as f:
+            f.writelines(f"{k}={v}\n" for k, v in settings.items())
+    return importlib.import_module("bot")
+
+
+# Function to start a bot.py server on its own process, polling the updates from the
+# Telegram stand-in (queued with push_update), returning once it's polling
+def start_bot_server(settings, **options):
+    directory = tempfile.mkdtemp(prefix="bot-")
+    settings = {
+        **settings,
+        "TELEGRAM_API_URL": settings["OPENAI_BASE_URL"].rsplit("/v1/", 1)[0],
+        "POLLING_STATE_FILE": os.path.join(directory, "polling_state.json"),
+        "METRICS_PORT": "",
+        **options,
+    }
+    with open(os.path.join(directory, ".env"), "w") as f:
+        f.writelines(f"{k}={v}\n" for k, v in settings.items())
+
+    # Waiting for its first getUpdates call
+    polled = threading.Event()
+
+    def listener(method, params, result):
+        if method == "getUpdates":
+            polled.set()
+
+    telegram_listeners.append(listener)
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    log = open(os.path.join(directory, "bot.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, bot_path], cwd=directory, stdout=log, stderr=subprocess.STDOUT
+    )
+    process.log = log
+    try:
+        if not polled.wait(60):
+            stop_bot_server(process)
+            sys.exit(f"The bot.py server didn't start, see {log.name}")
+    finally:
+        telegram_listeners.remove(listener)
+    return process
+
+
+# Function to stop a bot.py server gracefully (it finishes its pending updates first)
+def stop_bot_server(process):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    process.log.close()
+    with pending_updates_ready:
+        pending_updates.clear()
+
+
+# Function to wait for the image jobs running on the bot.py server
+def wait_image_jobs(bot):
+    while bot.image_jobs:
+        time.sleep(0.005)
+
+
+# Function to get the bot.py handler scenarios
+def get_bot_scenarios(settings):
+    bot = import_bot(settings)
+    from telebot import types
+
+    def scenario(handler, name):
+        def run(i):
+            for update in scenario_updates[name](i):
+                handler(types.Message.de_json(update["message"]))
+
+        return run
+
+    # The buffered messages (an album, or the texts sent in a quick succession) are
+    # answered once they're due, as the chat's worker would, so the latency covers the
+    # answer rather than only the buffering
+    def buffered_scenario(handler, name):
+        def run(i):
+            updates = scenario_updates[name](i)
+            for update in updates:
+                handler(types.Message.de_json(update["message"]))
+            buffer = bot.get_update_buffer(updates[-1])
+            deadline = bot.get_buffer_deadline(buffer) or 0
+            time.sleep(max(deadline - time.monotonic(), 0))
+            bot.answer_buffer(buffer)
+
+        return run
+
+    return {
+        "bot.echo_all": scenario(bot.echo_all, "text"),
+        "bot.echo_all:fragments": coalesced(
+            bot, buffered_scenario(bot.echo_all, "fragments")
+        ),
+        "bot.visual_input": scenario(bot.visual_input, "photo"),
+        "bot.visual_input:album": buffered_scenario(bot.visual_input, "album"),
+        "bot.request_image": scenario(bot.request_image, "image"),
+        "bot.clear_messages": scenario(bot.clear_messages, "clear"),
+    }
+
+
+# Function to get a percentile of the sorted samples (nearest rank)
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, max(0, round(p / 100 * len(samples)) - 1))]
+
+
+# Function to run a scenario, returning its latency percentiles and traffic per call
+# The work left running in the background by the handlers (e.g. the image jobs) is waited
+# for after each call, outside of its latency, but its traffic is counted
+def run_scenario(run, iterations, warmup, settle=None):
+    for i in range(warmup):
+        run(-1 - i)
+        settle and settle()
+
+    durations = []
+    with traffic_lock:
+        traffic.clear()
+    for i in range(iterations):
+        start = time.perf_counter()
+        run(i)
+        durations.append((time.perf_counter() - start) * 1000)
+        settle and settle()
+    durations.sort()
+
+    result = {
+        "iterations": iterations,
+        "p50_ms": round(percentile(durations, 50), 2),
+        "p95_ms": round(percentile(durations, 95), 2),
+        "p99_ms": round(percentile(durations, 99), 2),
+    }
+    for service in latency:
+        result[f"{service}_round_trips"] = round(
+            traffic[f"{service}_requests"] / iterations, 2
+        )
+        result[f"{service}_bytes"] = round(traffic[f"{service}_bytes"] / iterations)
+        result[f"{service}_rejected"] = round(
+            traffic[f"{service}_rejected"] / iterations, 2
+        )
+    return result
+
+
+# Function to compare the results against a baseline, returning the regressions
+# Latency and bytes may grow up to the tolerance, round trips may not grow at all
+def compare_results(results, baseline, tolerance):
+    regressions = []
+    for name, base in baseline.get("results", {}).items():
+        result = results.get(name)
+        if result is None:
+            continue
+        for metric, value in result.items():
+            if metric not in base or metric == "iterations":
+                continue
+            limit = base[metric]
+            if metric.endswith("_ms"):
+                # A small absolute slack avoids failing on timer noise
+                limit = base[metric] * (1 + tolerance) + 1
+            elif metric.endswith("_bytes"):
+                limit = base[metric] * (1 + tolerance)
+            if value > limit:
+                regressions.append(f"{name} {metric}: {value} > {base[metric]}")
+    return regressions
+
+
+# Function to print the results table
+def print_results(results):
+    columns = ["p50_ms", "p95_ms", "p99_ms"]
+    columns += [
+        f"{s}_{m}" for m in ("round_trips", "bytes", "rejected") for s in latency
+    ]
+    print(f"{'handler':<26}" + "".join(f"{c:>22}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<26}" + "".join(f"{result[c]:>22}" for c in columns))
+
+
+# Function to benchmark the image jobs of the bot.py server: on each iteration, the chat
+# requests as many images as allowed (two variants each), and keeps sending text messages
+# until they're delivered
+def run_image_jobs_benchmark(settings, iterations):
+    bot = import_bot(settings)
+    from telebot import types
+
+    def send(handler, text):
+        handler(types.Message.de_json(make_update(text)["message"]))
+
+    handler_durations, generation_durations, served = [], [], []
+    with traffic_lock:
+        traffic.clear()
+    for i in range(iterations):
+        start = time.perf_counter()
+        for job in range(bot.image_jobs_per_chat):
+            send(bot.request_image, f"/image x2 a lighthouse in style {i}-{job}")
+            handler_durations.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+        count = 0
+        while bot.image_jobs:
+            send(bot.echo_all, f"Tell me something about the number {i}-{count}")
+            count += 1
+        generation_durations.append((time.perf_counter() - start) * 1000)
+        served.append(count)
+    handler_durations.sort()
+    generation_durations.sort()
+    served.sort()
+    return {
+        "image_handler_p50_ms": round(percentile(handler_durations, 50), 2),
+        "image_handler_p95_ms": round(percentile(handler_durations, 95), 2),
+        "generation_p50_ms": round(percentile(generation_durations, 50), 2),
+        "texts_served_p50": percentile(served, 50),
+        "albums_sent": traffic["telegram_albums"],
+        "images_generated": traffic["openai_images"],
+    }
+
+
+# Function to benchmark the time to the first visible token of the text replies, with the
+# responses streamed and complete: the time until the chat is first shown some text of the
+# response (on a new or edited message), against the time the whole reply takes
+def run_streaming_benchmark(settings, iterations):
+    os.environ.update(settings)
+    lambda_function = importlib.import_module("lambda_function")
+    bot = import_bot(settings)
+    from telebot import types
+
+    # Noting when the response first becomes visible (past the placeholder message)
+    visible = []
+
+    def listener(method, params, result):
+        if method in ("sendMessage", "editMessageText") and params.get("text") != "...":
+            visible.append(time.perf_counter())
+
+    handlers = {
+        "lambda_handler": (
+            lambda_function,
+            lambda update: lambda_function.lambda_handler(
+                {"body": json.dumps(update)}, None
+            ),
+        ),
+        "bot.echo_all": (
+            bot,
+            lambda update: bot.echo_all(types.Message.de_json(update["message"])),
+        ),
+    }
+    results = {}
+    telegram_listeners.append(listener)
+    try:
+        for name, (module, handle) in handlers.items():
+            setting = module.stream_responses
+            for streamed in (False, True):
+                module.stream_responses = streamed
+                first, total = [], []
+                for i in range(iterations):
+                    visible.clear()
+                    text = f"Tell me something about the number {i} ({streamed})"
+                    start = time.perf_counter()
+                    handle(make_update(text))
+                    total.append((time.perf_counter() - start) * 1000)
+                    first.append((visible[0] - start) * 1000)
+                first.sort()
+                total.sort()
+                results[f"{name}:{'streamed' if streamed else 'complete'}"] = {
+                    "first_token_p50_ms": round(percentile(first, 50), 2),
+                    "first_token_p95_ms": round(percentile(first, 95), 2),
+                    "reply_p50_ms": round(percentile(total, 50), 2),
+                    "reply_p95_ms": round(percentile(total, 95), 2),
+                }
+            module.stream_responses = setting
+    finally:
+        telegram_listeners.remove(listener)
+    return results
+
+
+# Function to print the streaming results table
+def print_streaming_results(results):
+    columns = list(next(iter(results.values())))
+    print(f"{'text replies':<26}" + "".join(f"{c:>22}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<26}" + "".join(f"{result[c]:>22}" for c in columns))
+
+
+# Function to benchmark the throughput of a bot.py server (on the async runtime) as its
+# concurrency grows: for each MAX_CONCURRENT_UPDATES, text messages from many chats are
+# queued at once, and the time until all of them are answered is measured
+def run_throughput_benchmark(settings, concurrencies, chats, updates_per_chat=1):
+    answered = Counter()
+    answers = threading.Condition()
+
+    def listener(method, params, result):
+        if method == "sendMessage":
+            with answers:
+                answered["replies"] += 1
+                answers.notify_all()
+
+    results = {}
+    for concurrency in concurrencies:
+        process = start_bot_server(
+            {**settings, "ALLOWED_USERS": "*", "METRICS": "false"},
+            POLLING_MODE="async",
+            MAX_CONCURRENT_UPDATES=str(concurrency),
+        )
+        # The chats take turns, so their ordering doesn't hold back the others
+        updates = []
+        for n in range(updates_per_chat):
+            for chat_id in range(admin_chat_id + 200, admin_chat_id + 200 + chats):
+                updates.append(
+                    make_update(
+                        f"Tell me something about the number {chat_id}-{n}-{concurrency}",
+                        chat={"id": chat_id, "type": "private", "first_name": "Load"},
+                        **{"from": {"id": chat_id, "is_bot": False, "first_name": "L"}},
+                    )
+                )
+        answered.clear()
+        with traffic_lock:
+            traffic.clear()
+        telegram_listeners.append(listener)
+        try:
+            start = time.perf_counter()
+            for update in updates:
+                push_update(update)
+            with answers:
+                answers.wait_for(lambda: answered["replies"] >= len(updates), 300)
+            duration = time.perf_counter() - start
+        finally:
+            telegram_listeners.remove(listener)
+            stop_bot_server(process)
+        results[f"{concurrency} concurrent"] = {
+            "updates": len(updates),
+            "answered": answered["replies"],
+            "duration_s": round(duration, 2),
+            "updates_per_s": round(answered["replies"] / duration, 2),
+            # Share of the time the DynamoDB stand-in was busy (it runs one call at a time,
+            # so near 1 it's the bottleneck rather than the server)
+            "dynamodb_busy": round(traffic["dynamodb_server_ms"] / 1000 / duration, 2),
+        }
+    return results
+
+
+# Function to print the throughput results table
+def print_throughput_results(results):
+    columns = list(next(iter(results.values())))
+    print(f"{'bot.py server':<18}" + "".join(f"{c:>15}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<18}" + "".join(f"{result[c]:>15}" for c in columns))
+
+
+# Sizes of a photo sent to Telegram (by the name of their files), as it sends them
+photo_sizes = {"s": (90, 68), "m": (320, 240), "x": (800, 600), "y": (1280, 960)}
+photo_sizes["w"] = (2560, 1920)
+
+
+# Function to make the JPEG file of each photo size, from smooth noise (so it compresses
+# about as well as a picture)
+def make_photo_files():
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    for name, (width, height) in photo_sizes.items():
+        output = io.BytesIO()
+        Image.fromarray(noise).resize((width, height), Image.BICUBIC).save(
+            output, format="JPEG", quality=90
+        )
+        photo_files[name] = output.getvalue()
+
+
+# Function to benchmark the photos ingestion of both handlers: the photo is sent with every
+# size (as Telegram does, so the handler picks one) and with the largest one only, reporting
+# the bytes downloaded and uploaded (to the vision model), the peak memory taken by Python
+# objects while requesting the vision model (from tracemalloc, which doesn't see Pillow's
+# pixel buffers) and the latency
+def run_photos_benchmark(settings, iterations):
+    global discard_uploads
+    import tracemalloc
+
+    os.environ.update(settings)
+    lambda_function = importlib.import_module("lambda_function")
+    bot = import_bot(settings)
+    from telebot import types
+
+    make_photo_files()
+    handlers = {
+        "lambda_handler": lambda update: lambda_function.lambda_handler(
+            {"body": json.dumps(update)}, None
+        ),
+        "bot.visual_input": lambda update: bot.visual_input(
+            types.Message.de_json(update["message"])
+        ),
+    }
+
+    # Function to build a photo update, with unique file IDs (so no cached image is used)
+    def photo_update(sizes):
+        n = next(photo_ids)
+        photos = [
+            {
+                "file_id": f"{name}-{n}",
+                "file_unique_id": f"{name}-{n}",
+                "width": photo_sizes[name][0],
+                "height": photo_sizes[name][1],
+            }
+            for name in sizes
+        ]
+        return make_update(caption=f"What is in this picture? {n}", photo=photos)
+
+    # The memory is measured on the vision requests only (downloading, encoding and sending
+    # the photos), as the in-process moto server allocates a lot while answering the rest
+    peaks = []
+
+    def measured(request):
+        def wrapper(*args, **kwargs):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                return request(*args, **kwargs)
+            finally:
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+
+        wrapper.__wrapped__ = request
+        return wrapper
+
+    results = {}
+    discard_uploads = True
+    tracemalloc.start()
+    for module in (lambda_function, bot):
+        module.request_visual_completion = measured(module.request_visual_completion)
+    try:
+        for name, handle in handlers.items():
+            for layout, sizes in (("sizes", list(photo_sizes)), ("largest", ["w"])):
+                durations = []
+                peaks.clear()
+                with traffic_lock:
+                    traffic.clear()
+                for i in range(iterations):
+                    update = photo_update(sizes)
+                    start = time.perf_counter()
+                    handle(update)
+                    durations.append((time.perf_counter() - start) * 1000)
+                durations.sort()
+                peaks.sort()
+                results[f"{name}:{layout}"] = {
+                    "p50_ms": round(percentile(durations, 50), 2),
+                    "peak_memory_kb": round(percentile(peaks, 50) / 1024),
+                    "download_kb": round(
+                        traffic["telegram_file_bytes"] / iterations / 1024
+                    ),
+                    "upload_kb": round(
+                        traffic["openai_upload_bytes"] / iterations / 1024
+                    ),
+                }
+    finally:
+        for module in (lambda_function, bot):
+            module.request_visual_completion = (
+                module.request_visual_completion.__wrapped__
+            )
+        tracemalloc.stop()
+        discard_uploads = False
+    return results
+
+
+# Function to print the photos results table
+def print_photos_results(results):
+    columns = list(next(iter(results.values())))
+    print(f"{'photo':<26}" + "".join(f"{c:>16}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<26}" + "".join(f"{result[c]:>16}" for c in columns))
+
+
+# Function to run the queue mode worker as the SQS trigger of the Lambda function would: a
+# few pollers receive batches of updates and pass them to worker_handler, deleting the ones
+# it doesn't report as failed (those are received again once their visibility times out)
+def run_queue_workers(lambda_function, queue_url, stopping, workers):
+    sqs = lambda_function.get_sqs()
+
+    def poll():
+        while not stopping.is_set():
+            # (short polls, as a long poll would hold the stand-in, which runs one call at
+            # a time)
+            messages = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=10,
+                AttributeNames=["MessageGroupId"],
+            ).get("Messages", [])
+            if not messages:
+                time.sleep(0.02)
+                continue
+            records = [
+                {
+                    "messageId": message["MessageId"],
+                    "body": message["Body"],
+                    "attributes": message["Attributes"],
+                }
+                for message in messages
+            ]
+            response = lambda_function.worker_handler({"Records": records}, None)
+            failed = {item["itemIdentifier"] for item in response["batchItemFailures"]}
+            for message in messages:
+                if message["MessageId"] not in failed:
+                    sqs.delete_message(
+                        QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"]
+                    )
+
+    threads = [threading.Thread(target=poll, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# Function to benchmark the webhook of the Lambda handler on both modes, with text messages
+# from a few chats arriving at a rate (per second): the time to answer the webhook (ingress)
+# and the time until the reply is sent to the chat (end to end), which on queue mode goes
+# through the SQS stand-in (moto's server) and the workers
+def run_queue_benchmark(settings, iterations, rate, chats=4, workers=4):
+    sqs_url = start_aws_service("sqs")
+    import boto3
+
+    queue_url = boto3.client(
+        "sqs",
+        region_name="us-east-1",
+        endpoint_url=sqs_url,
+        aws_access_key_id="benchmark",
+        aws_secret_access_key="benchmark",
+    ).create_queue(
+        QueueName="chatgpt-benchmark.fifo",
+        Attributes={"FifoQueue": "true", "VisibilityTimeout": "30"},
+    )[
+        "QueueUrl"
+    ]
+    os.environ.update(settings)
+    os.environ.update(AWS_SQS_ENDPOINT=sqs_url, AWS_SQS_QUEUE_URL=queue_url)
+    lambda_function = importlib.import_module("lambda_function")
+    lambda_function.allowed_users.add("*")
+
+    # Noting when each chat gets a reply, taken as the answer to its oldest waiting update
+    waiting = {}
+    replies = threading.Condition()
+
+    def listener(method, params, result):
+        if method == "sendMessage":
+            with replies:
+                chat = waiting.get(int(params.get("chat_id") or 0))
+                if chat:
+                    chat.popleft()["replied"] = time.perf_counter()
+                    replies.notify_all()
+
+    results = {}
+    mode_setting = lambda_function.webhook_mode
+    stopping = threading.Event()
+    telegram_listeners.append(listener)
+    try:
+        for mode in ("inline", "queue"):
+            lambda_function.webhook_mode = mode
+            threads = []
+            if mode == "queue":
+                stopping.clear()
+                threads = run_queue_workers(
+                    lambda_function, queue_url, stopping, workers
+                )
+
+            # Answering the webhooks as they arrive, each on its own thread (as the separate
+            # invocations would)
+            units = []
+
+            def invoke(unit):
+                start = time.perf_counter()
+                lambda_function.lambda_handler(
+                    {"body": json.dumps(unit["update"])}, None
+                )
+                unit["ingress_ms"] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            invocations = []
+            for i in range(iterations):
+                time.sleep(max(0, start + i / rate - time.perf_counter()))
+                chat_id = admin_chat_id + 300 + i % chats
+                update = make_update(
+                    f"Tell me something about the number {mode}-{i}",
+                    chat={"id": chat_id, "type": "private", "first_name": "Queue"},
+                    **{"from": {"id": chat_id, "is_bot": False, "first_name": "Q"}},
+                )
+                unit = {"update": update, "arrival": time.perf_counter()}
+                units.append(unit)
+                with replies:
+                    waiting.setdefault(chat_id, deque()).append(unit)
+                invocation = threading.Thread(target=invoke, args=(unit,))
+                invocation.start()
+                invocations.append(invocation)
+            for invocation in invocations:
+                invocation.join()
+            with replies:
+                replies.wait_for(lambda: all(u.get("replied") for u in units), 120)
+            stopping.set()
+            for thread in threads:
+                thread.join()
+
+            ingress = sorted(unit["ingress_ms"] for unit in units)
+            end_to_end = sorted(
+                (unit["replied"] - unit["arrival"]) * 1000
+                for unit in units
+                if unit.get("replied")
+            )
+            results[mode] = {
+                "ingress_p50_ms": round(percentile(ingress, 50), 2),
+                "ingress_p99_ms": round(percentile(ingress, 99), 2),
+                "end_to_end_p50_ms": round(percentile(end_to_end, 50), 2),
+                "end_to_end_p99_ms": round(percentile(end_to_end, 99), 2),
+                "answered": len(end_to_end),
+            }
+    finally:
+        telegram_listeners.remove(listener)
+        lambda_function.webhook_mode = mode_setting
+    return results
+
+
+# Function to print the queue results table
+def print_queue_results(results):
+    columns = list(next(iter(results.values())))
+    print(f"{'webhook mode':<18}" + "".join(f"{c:>20}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<18}" + "".join(f"{result[c]:>20}" for c in columns))
+
+
+# Function to benchmark the hedged chat completions of the bot.py server against the latency
+# spikes: the text messages are answered with hedging disabled and enabled (after recording
+# enough latencies for it), and the latency percentiles of each run are compared
+def run_hedging_benchmark(settings, iterations):
+    bot = import_bot(settings)
+    from telebot import types
+
+    def send(handler, text):
+        handler(types.Message.de_json(make_update(text)["message"]))
+
+    results = {}
+    percentile_setting = bot.hedge_percentile
+    for name, hedge_percentile in (("unhedged", 0), ("hedged", percentile_setting)):
+        bot.hedge_percentile = hedge_percentile
+        bot.model_latencies.clear()
+        bot.hedge_stats.clear()
+        send(bot.clear_messages, "/clear")
+        for i in range(bot.hedge_min_samples):
+            send(bot.echo_all, f"Warming up with the number {name}-{i}")
+        durations = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            send(bot.echo_all, f"Tell me something about the number {name}-{i}")
+            durations.append((time.perf_counter() - start) * 1000)
+        durations.sort()
+        results[name] = {
+            "p50_ms": round(percentile(durations, 50), 2),
+            "p95_ms": round(percentile(durations, 95), 2),
+            "p99_ms": round(percentile(durations, 99), 2),
+            "max_ms": round(durations[-1], 2),
+            "hedges_sent": bot.hedge_stats["sent"],
+            "hedges_won": bot.hedge_stats["won"],
+        }
+    bot.hedge_percentile = percentile_setting
+    return results
+
+
+# Function to print the hedging results table
+def print_hedging_results(results):
+    columns = ["p50_ms", "p95_ms", "p99_ms", "max_ms", "hedges_sent", "hedges_won"]
+    print(f"{'chat completions':<18}" + "".join(f"{c:>14}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<18}" + "".join(f"{result[c]:>14}" for c in columns))
+
+
+# Function to benchmark the memory index of the Lambda handler (bot.py shares it) on a
+# long conversation: adding a turn to it, searching the most similar turns (the top-k
+# query, on the whole index) and recalling them for a new message (with its embedding)
+def run_memory_benchmark(settings, message_count, dimensions, iterations):
+    import numpy as np
+
+    os.environ.update(settings)
+    lambda_function = importlib.import_module("lambda_function")
+    lambda_function.memory_dir = tempfile.mkdtemp(prefix="memory-")
+    lambda_function.embedding_dimensions = dimensions
+    chat_id = admin_chat_id + 10
+    memory = lambda_function.open_memory(chat_id)
+
+    # Building the index of the seeded turns (one per user message and its response), with
+    # random embeddings, in batches
+    rng = np.random.default_rng(0)
+    turns = message_count // 2
+    messages = [
+        {"role": "user", "content": "Question"},
+        {"role": "assistant", "content": reply_text},
+    ]
+    start = time.perf_counter()
+    for first in range(0, turns, 4096):
+        batch = range(first, min(first + 4096, turns))
+        vectors = rng.standard_normal((len(batch), dimensions), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        lambda_function.append_memory(
+            memory, [{"seq": 2 * i + 1, "messages": messages} for i in batch], vectors
+        )
+    build_seconds = time.perf_counter() - start
+
+    def measure(run):
+        durations = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            run(i)
+            durations.append((time.perf_counter() - start) * 1000)
+        durations.sort()
+        return {
+            "p50_ms": round(percentile(durations, 50), 3),
+            "p95_ms": round(percentile(durations, 95), 3),
+        }
+
+    def query(i):
+        vector = rng.standard_normal(dimensions, dtype=np.float32)
+        vector /= np.linalg.norm(vector)
+        lambda_function.search_memory(memory, vector, 0, 2 * memory["count"] + 1)
+
+    def append(i):
+        vector = rng.standard_normal((1, dimensions), dtype=np.float32)
+        seq = 2 * memory["count"] + 1
+        lambda_function.append_memory(
+            memory, [{"seq": seq, "messages": messages}], vector
+        )
+
+    conversation = {"version": 2 * turns + 2 * iterations, "cleared_seq": 0}
+    lambda_function.memory_min_score = -1
+
+    def recall(i):
+        history = [{"role": "user", "content": f"Question {i}"}]
+        lambda_function.add_recalled_turns(chat_id, conversation, history, history)
+
+    results = {
+        "query": measure(query),
+        "append": measure(append),
+        "recall": measure(recall),
+    }
+    index_bytes = sum(
+        os.path.getsize(os.path.join(memory["path"], name))
+        for name in ("rows.i64", "vectors.f32")
+    )
+    results["index"] = {
+        "turns": memory["count"],
+        "dimensions": dimensions,
+        "index_mb": round(index_bytes / 2**20, 1),
+        "build_s": round(build_seconds, 2),
+    }
+    return results
+
+
+# Function to print the memory results table
+def print_memory_results(results):
+    print(f"{'memory index':<18}" + "".join(f"{c:>14}" for c in ("p50_ms", "p95_ms")))
+    for name in ("query", "append", "recall"):
+        print(f"{name:<18}" + "".join(f"{v:>14}" for v in results[name].values()))
+    print("\n".join(f"{k:<18}{v:>14}" for k, v in results["index"].items()))
+
+
+# Function to benchmark the conversation context of the Lambda handler (bot.py shares it)
+# as the history grows: for each size, a chat is seeded with that many turns and answered,
+# reporting the latency and the prompt sent to the chat model (its messages and tokens)
+# The time spent by moto's server is reported apart, as its transactions copy the whole
+# table, so they slow down as it grows (unlike DynamoDB)
+def run_history_benchmark(settings, sizes, iterations):
+    os.environ.update(settings)
+    lambda_function = importlib.import_module("lambda_function")
+    lambda_function.allowed_users.add("*")
+
+    results = {}
+    for offset, size in enumerate(sizes):
+        chat_id = admin_chat_id + 100 + offset
+        seed_conversation(lambda_function, chat_id, 2 * size)
+        chat = {"id": chat_id, "type": "private", "first_name": "Benchmark"}
+        durations = []
+        with traffic_lock:
+            traffic.clear()
+        for i in range(iterations):
+            update = make_update(
+                f"Tell me something about the number {i}",
+                chat=chat,
+                **{"from": {"id": chat_id, "is_bot": False, "first_name": "Benchmark"}},
+            )
+            start = time.perf_counter()
+            lambda_function.lambda_handler({"body": json.dumps(update)}, None)
+            durations.append((time.perf_counter() - start) * 1000)
+        durations.sort()
+        results[f"{size} turns"] = {
+            "p50_ms": round(percentile(durations, 50), 2),
+            "p95_ms": round(percentile(durations, 95), 2),
+            "prompt_messages": round(traffic["openai_prompt_messages"] / iterations, 1),
+            "prompt_tokens": round(traffic["openai_prompt_tokens"] / iterations),
+            "openai_bytes": round(traffic["openai_bytes"] / iterations),
+            "dynamodb_round_trips": round(traffic["dynamodb_requests"] / iterations, 2),
+            "dynamodb_server_ms": round(traffic["dynamodb_server_ms"] / iterations, 2),
+        }
+    return results
+
+
+# Function to print the history results table
+def print_history_results(results):
+    columns = list(next(iter(results.values())))
+    print(f"{'history':<18}" + "".join(f"{c:>22}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<18}" + "".join(f"{result[c]:>22}" for c in columns))
+
+
+# DynamoDB capacity units consumed by the storage operations, estimated from the item
+# sizes (as DynamoDB bills them: reads per 4 KB, writes per 1 KB, transactions twice)
+capacity = Counter()
+
+
+# Function to get the size (in bytes) of a DynamoDB attribute value, on its typed format
+def attribute_size(value):
+    ((kind, data),) = value.items()
+    if kind in ("S", "B"):
+        return len(data.encode() if isinstance(data, str) else data)
+    if kind == "N":
+        return len(data.lstrip("-").replace(".", "")) // 2 + 2
+    if kind == "M":
+        return 3 + sum(len(k) + attribute_size(v) + 1 for k, v in data.items())
+    if kind == "L":
+        return 3 + sum(attribute_size(v) + 1 for v in data)
+    return 1
+
+
+# Function to get the size (in bytes) of a DynamoDB item, on its typed format
+def item_size(item):
+    return sum(len(name) + attribute_size(value) for name, value in item.items())
+
+
+# Function to count the write units of a DynamoDB call, before it's sent
+# The deleted and updated items are assumed to be under 1 KB
+def count_write_units(params, model, context, **kwargs):
+    request = json.loads(params["body"] or b"{}")
+    context["capacity_request"] = request
+    if model.name == "PutItem":
+        capacity["write_units"] += math.ceil(item_size(request["Item"]) / 1024)
+    elif model.name in ("UpdateItem", "DeleteItem"):
+        capacity["write_units"] += 1
+    elif model.name == "BatchWriteItem":
+        for requests in request["RequestItems"].values():
+            for write in requests:
+                item = write.get("PutRequest", {}).get("Item")
+                capacity["write_units"] += (
+                    math.ceil(item_size(item) / 1024) if item else 1
+                )
+    elif model.name == "TransactWriteItems":
+        for write in request["TransactItems"]:
+            item = write.get("Put", {}).get("Item")
+            capacity["write_units"] += 2 * (
+                math.ceil(item_size(item) / 1024) if item else 1
+            )
+
+
+# Function to count the read units of a DynamoDB call, from its response
+# Eventually consistent reads take half a unit per 4 KB
+def count_read_units(parsed, model, context, **kwargs):
+    request = context.get("capacity_request", {})
+    items = parsed.get("Items") or ([parsed["Item"]] if "Item" in parsed else [])
+    if model.name in ("GetItem", "Query"):
+        units = math.ceil(max(1, sum(item_size(item) for item in items)) / 4096)
+        capacity["read_units"] += units * (1 if request.get("ConsistentRead") else 0.5)
+
+
+# Function to seed a conversation with alternating user and assistant messages
+# Their words are drawn from a vocabulary, so they compress about as well as real text
+def seed_conversation(lambda_function, chat_id, count):
+    rng = random.Random(chat_id)
+    letters = "etaoinshrdlcumwfgypbvk"
+    vocabulary = [
+        "".join(rng.choices(letters, k=rng.randint(2, 9))) for _ in range(2000)
+    ]
+    words = len(reply_text.split())
+    table = lambda_function.get_table()
+    with table.batch_writer() as batch:
+        for seq in range(1, count + 1):
+            content = " ".join(rng.choices(vocabulary, k=words))
+            item = lambda_function.dynamo_message_item(
+                chat_id,
+                seq,
+                {
+                    "role": "user" if seq % 2 else "assistant",
+                    "content": content,
+                    "tokens": len(content) // 4,
+                },
+            )
+            if not seq % 2:
+                item["model"] = "gpt-3.5-turbo-1106"
+                item["usage"] = {"prompt_tokens": 900, "completion_tokens": 80}
+            batch.put_item(Item=item)
+    table.put_item(
+        Item={"pk": lambda_function.chat_key(chat_id), "sk": 0, "last_seq": count}
+    )
+
+
+# Function to measure a storage operation, returning its latency and the units and
+# requests it takes on average
+def measure_storage(run, iterations):
+    durations = []
+    with traffic_lock:
+        traffic.clear()
+    capacity.clear()
+    for i in range(iterations):
+        start = time.perf_counter()
+        run(i)
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    return {
+        "p50_ms": round(percentile(durations, 50), 2),
+        "p95_ms": round(percentile(durations, 95), 2),
+        "read_units": round(capacity["read_units"] / iterations, 2),
+        "write_units": round(capacity["write_units"] / iterations, 2),
+        "dynamodb_round_trips": round(traffic["dynamodb_requests"] / iterations, 2),
+        "s3_round_trips": round(traffic["s3_requests"] / iterations, 2),
+        "s3_bytes": round(traffic["s3_bytes"] / iterations),
+    }
+
+
+# Function to get the items and bytes stored by a conversation on the table and the bucket
+def get_storage_size(lambda_function, chat_id):
+    import boto3
+
+    # A plain client keeps the items on their typed format
+    client = boto3.client(
+        "dynamodb",
+        region_name=os.environ["AWS_REGION"],
+        endpoint_url=os.environ["AWS_DYNAMODB_ENDPOINT"],
+    )
+    query = {
+        "TableName": table_name,
+        "KeyConditionExpression": "pk = :pk",
+        "ExpressionAttributeValues": {":pk": {"S": lambda_function.chat_key(chat_id)}},
+    }
+    sizes = []
+    while True:
+        res = client.query(**query)
+        sizes.extend(item_size(item) for item in res["Items"])
+        if "LastEvaluatedKey" not in res:
+            break
+        query["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+    objects = (
+        lambda_function.get_s3()
+        .list_objects_v2(
+            Bucket=bucket_name, Prefix=lambda_function.segment_prefix(chat_id)
+        )
+        .get("Contents", [])
+    )
+    return {
+        "dynamodb_items": len(sizes),
+        "dynamodb_kb": round(sum(sizes) / 1024, 1),
+        "largest_item_bytes": max(sizes, default=0),
+        "s3_objects": len(objects),
+        "s3_kb": round(sum(obj["Size"] for obj in objects) / 1024, 1),
+    }
+
+
+# Function to benchmark the conversation storage of the Lambda handler (bot.py shares it)
+# on a long history, with every message on the table ("hot") and with the older ones
+# compacted into segments on the bucket ("tiered")
+def run_storage_benchmark(settings, message_count, iterations):
+    os.environ.update(settings)
+    lambda_function = importlib.import_module("lambda_function")
+    client = lambda_function.get_table().meta.client
+    client.meta.events.register("before-call.dynamodb", count_write_units)
+    # (ahead of the table resource, which turns the typed items into Python values)
+    client.meta.events.register_first("after-call.dynamodb", count_read_units)
+
+    results = {}
+    for offset, layout in enumerate(("hot", "tiered")):
+        lambda_function.cold_storage = layout == "tiered"
+        chat_id = admin_chat_id + 1 + offset
+        seed_conversation(lambda_function, chat_id, message_count)
+
+        # Compacting the history one segment at a time, until the hot tail fits
+        segments = max(
+            0,
+            (message_count - lambda_function.hot_messages)
+            // lambda_function.segment_messages,
+        )
+        if layout == "tiered" and segments:
+            results[f"{layout}:compact"] = measure_storage(
+                lambda i: lambda_function.compact_conversation(chat_id), segments
+            )
+
+        # Loading the conversation (without the in-memory cache) and saving turns on it
+        def load(i):
+            lambda_function.conversations.clear()
+            lambda_function.get_conversation(chat_id)
+
+        def save(i):
+            lambda_function.save_conversation_turn(
+                chat_id,
+                lambda_function.get_conversation(chat_id),
+                {"role": "user", "content": f"Question {i}"},
+                {"role": "assistant", "content": reply_text},
+                {"model": "gpt-3.5-turbo-1106"},
+            )
+
+        results[f"{layout}:load"] = measure_storage(load, iterations)
+        results[f"{layout}:turn"] = measure_storage(save, iterations)
+        sizes = get_storage_size(lambda_function, chat_id)
+        results[f"{layout}:export"] = measure_storage(
+            lambda i: lambda_function.export_conversation(chat_id), 1
+        )
+        results[f"{layout}:clear"] = measure_storage(
+            lambda i: lambda_function.clear_dynamo_messages(chat_id), 1
+        )
+        results[f"{layout}:clear"].update(sizes)
+    return results
+
+
+# Function to print the storage results table
+def print_storage_results(results):
+    columns = ["p50_ms", "p95_ms", "read_units", "write_units"]
+    columns += ["dynamodb_round_trips", "s3_round_trips", "s3_bytes"]
+    print(f"{'operation':<18}" + "".join(f"{c:>22}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<18}" + "".join(f"{result[c]:>22}" for c in columns))
+    columns = [
+        "dynamodb_items",
+        "dynamodb_kb",
+        "largest_item_bytes",
+        "s3_objects",
+        "s3_kb",
+    ]
+    print(f"\n{'stored':<18}" + "".join(f"{c:>22}" for c in columns))
+    for name, result in results.items():
+        if name.endswith(":clear"):
+            layout = name.split(":")[0]
+            print(f"{layout:<18}" + "".join(f"{result[c]:>22}" for c in columns))
+
+
+# Reading the benchmark options
+parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+parser.add_argument("--iterations", type=int, default=30)
+parser.add_argument("--warmup", type=int, default=2)
+parser.add_argument(
+    "--targets",
+    default="lambda,bot",
+    help="lambda, bot, images, photos, hedging, streaming, queue, throughput, "
+    "storage, memory and/or history",
+)
+parser.add_argument("--telegram-latency", type=float, default=20, help="ms per request")
+parser.add_argument("--openai-latency", type=float, default=100, help="ms per request")
+parser.add_argument("--dynamodb-latency", type=float, default=5, help="ms per request")
+parser.add_argument("--s3-latency", type=float, default=10, help="ms per request")
+parser.add_argument("--image-latency", type=float, default=100, help="ms per image")
+parser.add_argument(
+    "--openai-spike-rate", type=float, default=0, help="share of delayed completions"
+)
+parser.add_argument(
+    "--openai-spike-latency", type=float, default=2000, help="ms per spike"
+)
+parser.add_argument(
+    "--stream-chunk-latency", type=float, default=0, help="ms per streamed chunk"
+)
+parser.add_argument("--telegram-chat-rate", type=float, default=0, help="per second")
+parser.add_argument("--openai-rpm", type=float, default=0, help="per minute")
+parser.add_argument("--reply-words", type=int, default=60)
+parser.add_argument(
+    "--throughput-concurrency", default="1,4,8,16", help="MAX_CONCURRENT_UPDATES"
+)
+parser.add_argument("--throughput-chats", type=int, default=32)
+parser.add_argument("--queue-rate", type=float, default=4, help="updates per second")
+parser.add_argument("--storage-messages", type=int, default=10000)
+parser.add_argument("--memory-messages", type=int, default=100000)
+parser.add_argument("--memory-dimensions", type=int, default=256)
+parser.add_argument(
+    "--history-turns", default="10,100,1000,5000", help="history sizes to measure"
+)
+parser.add_argument("--photo-bytes", type=int, default=64 * 1024)
+parser.add_argument("--output", help="file to save the results (JSON)")
+parser.add_argument("--baseline", default="benchmark_baseline.json")
+parser.add_argument("--save-baseline", action="store_true")
+parser.add_argument("--tolerance", type=float, default=0.25)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    latency["telegram"] = args.telegram_latency / 1000
+    latency["openai"] = args.openai_latency / 1000
+    latency["dynamodb"] = args.dynamodb_latency / 1000
+    latency["s3"] = args.s3_latency / 1000
+    image_latency = args.image_latency / 1000
+    spikes["rate"] = args.openai_spike_rate
+    spikes["latency"] = args.openai_spike_latency / 1000
+    limits["telegram_chat_rate"] = args.telegram_chat_rate
+    stream_chunk_latency = args.stream_chunk_latency / 1000
+    limits["openai_rpm"] = args.openai_rpm
+    reply_text = " ".join(["benchmark"] * args.reply_words)
+    photo_bytes = b"\xff\xd8" + b"\0" * (args.photo_bytes - 2)
+    baseline_path = os.path.abspath(args.baseline)
+    output_path = args.output and os.path.abspath(args.output)
+
+    # Starting the stand-ins and pointing the clients to them
+    services_url = start_fake_services()
+    dynamodb_url = start_aws_service("dynamodb")
+    s3_url = start_aws_service("s3")
+    create_table(dynamodb_url, s3_url)
+    settings = get_settings(services_url, dynamodb_url, s3_url)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import telebot
+
+    telebot.apihelper.API_URL = services_url + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = services_url + "/file/bot{0}/{1}"
+
+    # Running the scenarios of each target
+    scenarios = {}
+    targets = args.targets.split(",")
+    if "lambda" in targets:
+        scenarios.update(get_lambda_scenarios(settings))
+    if "bot" in targets:
+        scenarios.update(get_bot_scenarios(settings))
+    settles = {}
+    if "bot" in targets:
+        settles["bot.request_image"] = lambda: wait_image_jobs(sys.modules["bot"])
+    results = {
+        name: run_scenario(run, args.iterations, args.warmup, settles.get(name))
+        for name, run in scenarios.items()
+    }
+    if results:
+        print_results(results)
+
+    # Running the other benchmarks (image jobs, photos, hedging, streaming, queue, throughput,
+    # storage, memory and history), which are only reported (not compared)
+    report = {"settings": vars(args), "results": results}
+    if "images" in targets:
+        report["images"] = run_image_jobs_benchmark(settings, args.iterations)
+        print("\n".join(f"{k:<24}{v:>12}" for k, v in report["images"].items()))
+    if "photos" in targets:
+        report["photos"] = run_photos_benchmark(settings, args.iterations)
+        print_photos_results(report["photos"])
+    if "hedging" in targets:
+        report["hedging"] = run_hedging_benchmark(settings, args.iterations)
+        print_hedging_results(report["hedging"])
+    if "streaming" in targets:
+        report["streaming"] = run_streaming_benchmark(settings, args.iterations)
+        print_streaming_results(report["streaming"])
+    if "queue" in targets:
+        report["queue"] = run_queue_benchmark(
+            settings, args.iterations, args.queue_rate
+        )
+        print_queue_results(report["queue"])
+    if "throughput" in targets:
+        concurrencies = [int(c) for c in args.throughput_concurrency.split(",")]
+        report["throughput"] = run_throughput_benchmark(
+            settings, concurrencies, args.throughput_chats
+        )
+        print_throughput_results(report["throughput"])
+    if "storage" in targets:
+        report["storage"] = run_storage_benchmark(
+            settings, args.storage_messages, args.iterations
+        )
+        print_storage_results(report["storage"])
+    if "memory" in targets:
+        report["memory"] = run_memory_benchmark(
+            settings, args.memory_messages, args.memory_dimensions, args.iterations
+        )
+        print_memory_results(report["memory"])
+
+    if "history" in targets:
+        sizes = [int(size) for size in args.history_turns.split(",")]
+        report["history"] = run_history_benchmark(settings, sizes, args.iterations)
+        print_history_results(report["history"])
+
+    # Saving the results, or comparing them against the baseline
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
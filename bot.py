@@ -9,22 +9,764 @@ Telegram Chatbot server
 """
 
 # Main dependencies
+import asyncio
+import atexit
+import bisect
+import contextvars
+import functools
+import gzip
+import itertools
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import signal
 import telebot
 import openai
+import httpx
+import numpy as np
 import boto3
+import botocore.config
+from boto3.dynamodb.conditions import Key
 import base64
+import io
+import random
+import re
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import dotenv_values
 
 # Getting the .env variables and keys
 config = dotenv_values(".env")
 
+# Runtime used to poll and process the updates ("async" or "sync")
+polling_mode = config.get("POLLING_MODE") or "async"
+# Maximum number of updates being processed at the same time by the async runtime
+max_concurrent_updates = int(config.get("MAX_CONCURRENT_UPDATES") or 8)
+# Maximum number of updates fetched but not yet processed by the async runtime
+# (or by the worker processes)
+max_pending_updates = int(config.get("MAX_PENDING_UPDATES") or 100)
+# Interval (in seconds) between the polls of the async runtime while updates are being
+# processed (Telegram returns them again right away, since they aren't confirmed yet)
+polling_interval = float(config.get("POLLING_INTERVAL") or 0.5)
+# Number of worker processes, and how many updates each one may have queued, on the
+# "processes" runtime (updates beyond that are answered with a busy message)
+worker_processes = int(config.get("WORKER_PROCESSES") or os.cpu_count() or 1)
+shard_queue_size = int(config.get("SHARD_QUEUE_SIZE") or 20)
+# File keeping the polling offset and the updates not yet processed, across restarts
+polling_state_file = config.get("POLLING_STATE_FILE") or "polling_state.json"
+# For how long (in seconds) an update ID processed by the async runtime (or by a worker
+# process) is remembered, so an update received again after a restart is skipped if it was
+# already processed
+update_claim_ttl = int(config.get("UPDATE_CLAIM_TTL") or 86400)
+
+# Connection pool size (per host), retries and timeouts (in seconds) of the outbound HTTP calls
+http_pool_size = int(config.get("HTTP_POOL_SIZE") or 10)
+http_retries = int(config.get("HTTP_RETRIES") or 3)
+http_backoff = float(config.get("HTTP_BACKOFF") or 0.5)
+http_connect_timeout = float(config.get("HTTP_CONNECT_TIMEOUT") or 5)
+http_timeout = float(config.get("HTTP_TIMEOUT") or 60)
+
+# Outbound rate limits, enforced by token buckets before each call (if enabled)
+# Telegram: messages per second (overall and per chat) and per minute (per group)
+rate_limits = (config.get("RATE_LIMITS") or "true").lower() == "true"
+telegram_rate = float(config.get("TELEGRAM_RATE") or 30)
+telegram_chat_rate = float(config.get("TELEGRAM_CHAT_RATE") or 1)
+telegram_group_rate = float(config.get("TELEGRAM_GROUP_RATE") or 20)
+telegram_chat_burst = int(config.get("TELEGRAM_CHAT_BURST") or 3)
+# OpenAI: requests, tokens and images per minute (updated from the rate limit headers)
+openai_rpm = float(config.get("OPENAI_RPM") or 500)
+openai_tpm = float(config.get("OPENAI_TPM") or 60000)
+openai_ipm = float(config.get("OPENAI_IPM") or 5)
+
+# Number of retries made by the HTTP session
+http_retry_count = 0
+
+
+# Whether the latency of each stage (e.g. an external call) and the token usage are recorded
+metrics_enabled = (config.get("METRICS") or "true").lower() == "true"
+# Port of the Prometheus metrics endpoint (disabled if not set)
+metrics_port = int(config.get("METRICS_PORT") or 0)
+# Stages slower than this (in seconds) are logged, along with their chat
+metrics_slow_span = float(config.get("METRICS_SLOW_SPAN") or 10)
+
+# Upper bounds (in seconds) of the stage latency histogram buckets
+metrics_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Stage latency histograms ((stage, route): counts per bucket and sum) and token counters
+stage_metrics = {}
+token_metrics = Counter()
+metrics_lock = threading.Lock()
+
+
+# Attributes of the update being processed by each thread (or task, on the async runtime),
+# kept on a context variable, so the tasks sharing a thread don't mix them up
+class MetricsContext:
+    def __init__(self):
+        object.__setattr__(
+            self, "values", contextvars.ContextVar("metrics", default={})
+        )
+
+    def __getattr__(self, name):
+        try:
+            return self.values.get()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.values.set({**self.values.get(), name: value})
+
+
+# Route and chat of the update being processed
+metrics_context = MetricsContext()
+
+# If set, every received update is also appended to this file as a compact trace record
+# (with the IDs hashed and only the length of the texts), which replay.py may replay
+trace_file = config.get("TRACE_FILE")
+# Salt of the hashed IDs on the trace records (the bot token, if not set)
+trace_salt = config.get("TRACE_SALT")
+# Commands kept on the trace records (any other one is recorded as "/other")
+trace_commands = ("/start", "/clear", "/export", "/image", "/cancel")
+trace_lock = threading.Lock()
+
+
+# Function to record the duration of a stage of the current update
+def record_span(stage, seconds):
+    # The stages of a hedged request still running after another one was used aren't
+    # recorded
+    finished = getattr(metrics_context, "finished", None)
+    if finished is not None and finished.is_set():
+        return
+    route = getattr(metrics_context, "route", "none")
+    bucket = bisect.bisect_left(metrics_buckets, seconds)
+    with metrics_lock:
+        entry = stage_metrics.get((stage, route))
+        if entry is None:
+            entry = stage_metrics[(stage, route)] = [0] * (len(metrics_buckets) + 1) + [
+                0
+            ]
+        entry[bucket] += 1
+        entry[-1] += seconds
+    if seconds > metrics_slow_span:
+        chat_id = getattr(metrics_context, "chat_id", None)
+        print(f"Slow {stage} on {route} (chat {chat_id}): {seconds:.3f}s")
+
+
+# Function to record the token usage of a chat model request
+def record_usage(usage):
+    if metrics_enabled and usage:
+        route = getattr(metrics_context, "route", "none")
+        with metrics_lock:
+            for kind in ("prompt", "completion", "total"):
+                token_metrics[(route, kind)] += usage.get(f"{kind}_tokens", 0)
+
+
+# Decorator recording the metrics of a handler (or an async one), tagged with its route
+# and chat
+def metered(route):
+    def decorator(handler):
+        if asyncio.iscoroutinefunction(handler):
+
+            @functools.wraps(handler)
+            async def async_wrapper(message):
+                metrics_context.route = route
+                metrics_context.chat_id = message.chat.id
+                with span("total"):
+                    return await handler(message)
+
+            return async_wrapper
+
+        @functools.wraps(handler)
+        def wrapper(message):
+            metrics_context.route = route
+            metrics_context.chat_id = message.chat.id
+            with span("total"):
+                return handler(message)
+
+        return wrapper
+
+    return decorator
+
+
+# Function to wrap a function that runs on another thread (e.g. on an executor), so the
+# stages it records are tagged with the route and chat of the current update
+def in_metrics_context(function):
+    route = getattr(metrics_context, "route", "none")
+    chat_id = getattr(metrics_context, "chat_id", None)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        metrics_context.route = route
+        metrics_context.chat_id = chat_id
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+# Function to get the stage name of an outbound HTTP call, from its service and method
+# (e.g. "telegram.sendMessage", "telegram.download" or "openai.chat.completions")
+def get_http_stage(url):
+    path = urlsplit(url).path
+    if path.startswith("/file/bot"):
+        return "telegram.download"
+    if path.startswith("/bot"):
+        return "telegram." + path.rsplit("/", 1)[-1]
+    if url.startswith(openai_base_url):
+        parts = url[len(openai_base_url) :].split("?")[0].split("/")
+        return "openai." + (parts[0] if parts[0] == "models" else ".".join(parts))
+    return "http." + urlsplit(url).hostname
+
+
+# Functions timing the AWS calls (DynamoDB and SQS), through the botocore events
+def start_aws_span(context, **kwargs):
+    context["span_start"] = time.perf_counter()
+
+
+def end_aws_span(context, model, **kwargs):
+    if "span_start" in context:
+        record_span(
+            f"{model.service_model.endpoint_prefix}.{model.name}",
+            time.perf_counter() - context["span_start"],
+        )
+
+
+# Function to time the calls made by an AWS client
+def meter_aws_client(client):
+    if metrics_enabled:
+        client.meta.events.register("before-call", start_aws_span)
+        client.meta.events.register("after-call", end_aws_span)
+
+
+# Context manager timing a stage of the current update
+@contextmanager
+def span(stage):
+    if not metrics_enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+
+# Stages sent on the background lane (e.g. image generation), which must leave part of
+# the buckets to the interactive ones, so short replies aren't queued behind them
+background_stages = {
+    "openai.images.generations",
+    "telegram.sendPhoto",
+    "telegram.sendMediaGroup",
+    "telegram.sendChatAction",
+}
+background_headroom = 0.5
+
+
+# Token bucket pacing the calls to a service, whose rate adapts to its rate limit responses
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = self.max_rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Function to take the amount from the bucket, if it's available
+    # Returns how long to wait (in seconds) before trying again, or 0 if it was taken
+    def take(self, amount=1, background=False):
+        amount = min(amount, self.burst)
+        needed = min(self.burst, amount + background * self.burst * background_headroom)
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            wait = self.paused_until - now
+            if wait <= 0:
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return 0
+                wait = (needed - self.tokens) / self.rate
+        return min(wait, 1)
+
+    # Function to wait until the amount is available, taking it from the bucket
+    def acquire(self, amount=1, background=False):
+        while True:
+            wait = self.take(amount, background)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    # Function to wait until the amount is available without blocking the event loop
+    async def acquire_async(self, amount=1, background=False):
+        while True:
+            wait = self.take(amount, background)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    # Function to pause the bucket after a rate limited call, halving its rate
+    def penalize(self, retry_after):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    # Function to speed the bucket back up after a successful call
+    def recover(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+    # Function to update the bucket from the limit reported by the service (per minute),
+    # what's left of it and when it's reset (in seconds), keeping 10 seconds of burst
+    def update_limit(self, limit, remaining, reset):
+        with self.lock:
+            self.max_rate = limit / 60
+            self.rate = min(self.rate, self.max_rate)
+            self.burst = max(1, limit / 6)
+            self.tokens = min(self.tokens, self.burst, remaining)
+            if remaining <= 0:
+                self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+
+# Buckets of each service, with up to 10 seconds of burst for the per minute limits
+rate_buckets = {
+    "telegram": TokenBucket(telegram_rate, telegram_rate),
+    "openai.requests": TokenBucket(openai_rpm / 60, openai_rpm / 6),
+    "openai.tokens": TokenBucket(openai_tpm / 60, openai_tpm / 6),
+    "openai.images": TokenBucket(openai_ipm / 60, openai_ipm / 6),
+}
+# Buckets of each chat, from the least recently used
+chat_buckets = OrderedDict()
+chat_buckets_lock = threading.Lock()
+
+# Pattern of the images sent as data URLs, which aren't counted by their size
+image_data_pattern = re.compile(rb'"data:image/[^"]*"')
+
+
+# Function to get the bucket of a chat (groups and channels have a per minute limit)
+def get_chat_bucket(chat_id):
+    with chat_buckets_lock:
+        bucket = chat_buckets.get(chat_id)
+        if bucket is None:
+            group = str(chat_id).startswith(("-", "@"))
+            rate = telegram_group_rate / 60 if group else telegram_chat_rate
+            bucket = chat_buckets[chat_id] = TokenBucket(rate, telegram_chat_burst)
+            while len(chat_buckets) > 10000:
+                chat_buckets.popitem(last=False)
+        chat_buckets.move_to_end(chat_id)
+        return bucket
+
+
+# Function to estimate the tokens of a chat model request from its body
+# Each image counts as a high detail one, plus a typical completion
+def estimate_request_tokens(body):
+    if not isinstance(body, bytes):
+        body = json.dumps(body or "").encode()
+    body, images = image_data_pattern.subn(b'""', body)
+    return len(body) // 4 + images * 765 + 256
+
+
+# Function to get the buckets (and the amount taken from each one) of an outbound call
+def get_rate_buckets(stage, kwargs):
+    if stage.startswith("telegram.") and stage not in (
+        "telegram.getUpdates",
+        "telegram.download",
+    ):
+        buckets = [(rate_buckets["telegram"], 1)]
+        # (the chat ID is a string on the calls made by the async client)
+        chat_id = (kwargs.get("params") or {}).get("chat_id")
+        if chat_id is not None:
+            buckets.append((get_chat_bucket(str(chat_id)), 1))
+        return buckets
+    if stage.startswith("openai."):
+        buckets = [(rate_buckets["openai.requests"], 1)]
+        if stage == "openai.chat.completions":
+            body = kwargs.get("data") or kwargs.get("json")
+            buckets.append(
+                (rate_buckets["openai.tokens"], estimate_request_tokens(body))
+            )
+        elif stage == "openai.images.generations":
+            buckets.append((rate_buckets["openai.images"], 1))
+        return buckets
+    return []
+
+
+# Function to wait for the rate limits of an outbound call
+def wait_rate_limits(stage, kwargs):
+    if rate_limits:
+        background = stage in background_stages
+        for bucket, amount in get_rate_buckets(stage, kwargs):
+            bucket.acquire(amount, background)
+
+
+# Function to wait for the rate limits of an outbound call made by the async client
+async def wait_rate_limits_async(stage, kwargs):
+    if rate_limits:
+        background = stage in background_stages
+        for bucket, amount in get_rate_buckets(stage, kwargs):
+            await bucket.acquire_async(amount, background)
+
+
+# Function to parse the durations of the OpenAI rate limit headers (e.g. "6m0s" or "20ms")
+def parse_duration(value):
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(amount) * units[unit]
+        for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value or "")
+    )
+
+
+# Function to adapt the buckets of an outbound call to its response
+# If the call was rate limited (429), returns how long to wait (in seconds) before it's sent
+# again, or None otherwise (the 429 responses are retried even when the rate limits aren't
+# enforced)
+def update_rate_limits(stage, kwargs, response):
+    global http_retry_count
+
+    # OpenAI reports its limits (and what's left of them) on every response
+    headers = response.headers
+    if rate_limits:
+        for kind in ("requests", "tokens"):
+            if f"x-ratelimit-limit-{kind}" in headers:
+                rate_buckets[f"openai.{kind}"].update_limit(
+                    float(headers[f"x-ratelimit-limit-{kind}"]),
+                    float(headers.get(f"x-ratelimit-remaining-{kind}", 1)),
+                    parse_duration(headers.get(f"x-ratelimit-reset-{kind}")),
+                )
+
+    buckets = []
+    if rate_limits:
+        buckets = [bucket for bucket, amount in get_rate_buckets(stage, kwargs)]
+    if response.status_code != 429:
+        for bucket in buckets:
+            bucket.recover()
+        return None
+
+    # Telegram sends the time to wait on the response body, OpenAI on the headers
+    retry_after = headers.get("Retry-After")
+    if retry_after is None and stage.startswith("telegram."):
+        try:
+            retry_after = response.json()["parameters"]["retry_after"]
+        except Exception:
+            pass
+    retry_after = float(retry_after or 1)
+    print(f"Rate limited on {stage}, waiting {retry_after}s")
+    http_retry_count += 1
+
+    # For Telegram, the limit is most likely the chat's one (the last bucket)
+    # Without buckets to pause, the caller waits before sending the call again
+    if not buckets:
+        return retry_after
+    for bucket in buckets[-1:] if stage.startswith("telegram.") else buckets:
+        bucket.penalize(retry_after)
+    return 0
+
+
+# Retry policy with a random jitter on the exponential backoff
+# The Retry-After header of 503 responses is honored by urllib3 (429 responses are
+# sent again by the session, once their retry_after wait is over, since Telegram sends
+# it on the response body)
+class JitteredRetry(Retry):
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+    def increment(self, *args, **kwargs):
+        global http_retry_count
+        http_retry_count += 1
+        return super().increment(*args, **kwargs)
+
+
+# Initializing the HTTP session shared by every outbound call (Telegram, OpenAI and downloads)
+# Its pools are blocking, so no more than the pool size connections are opened per host
+http_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=http_pool_size,
+    pool_block=True,
+    max_retries=JitteredRetry(
+        total=http_retries,
+        backoff_factor=http_backoff,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    ),
+)
+
+
+# HTTP session pacing and timing each outbound call, as a stage named after its service
+# and method, and sending the rate limited calls again once the wait is over
+class MeteredSession(requests.Session):
+    def request(self, method, url, *args, **kwargs):
+        stage = get_http_stage(url)
+        for attempt in range(http_retries + 1):
+            wait_rate_limits(stage, kwargs)
+            with span(stage):
+                response = super().request(method, url, *args, **kwargs)
+            retry_after = update_rate_limits(stage, kwargs, response)
+            if attempt == http_retries or retry_after is None:
+                return response
+            response.close()
+            time.sleep(retry_after)
+
+
+http_session = MeteredSession()
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+
+# Function to get the connection reuse counters of the HTTP session
+def get_http_stats():
+    connections = sent = 0
+    pools = http_adapter.poolmanager.pools
+    for key in pools.keys():
+        connections += pools[key].num_connections
+        sent += pools[key].num_requests
+    return {
+        "connections": connections,
+        "requests": sent,
+        "reused": sent - connections,
+        "retries": http_retry_count,
+    }
+
+
+# Stream of a response body received through the shared HTTP session
+class SessionResponseStream(httpx.SyncByteStream):
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        yield from self.response.raw.stream(64 * 1024, decode_content=False)
+
+    def close(self):
+        self.response.close()
+
+
+# Transport sending the OpenAI SDK requests through the shared HTTP session
+class SessionTransport(httpx.BaseTransport):
+    def handle_request(self, request):
+        timeout = request.extensions.get("timeout", {})
+        response = http_session.request(
+            request.method,
+            str(request.url),
+            headers=dict(request.headers),
+            data=request.read(),
+            stream=True,
+            timeout=(
+                timeout.get("connect", http_connect_timeout),
+                timeout.get("read", http_timeout),
+            ),
+        )
+        return httpx.Response(
+            response.status_code,
+            headers=list(response.raw.headers.items()),
+            stream=SessionResponseStream(response),
+        )
+
+
+# Async HTTP client of the async runtime (the Telegram and OpenAI calls of the text and
+# photo messages), pacing, timing and retrying each outbound call like the shared session:
+# the 5xx responses and failed connections are retried with a jittered backoff, and the
+# rate limited calls are sent again once the wait is over
+class MeteredAsyncClient(httpx.AsyncClient):
+    async def send(self, request, **kwargs):
+        global http_retry_count
+        stage = get_http_stage(str(request.url))
+        call = {"params": dict(request.url.params), "data": request.content}
+        for attempt in range(http_retries + 1):
+            await wait_rate_limits_async(stage, call)
+            try:
+                with span(stage):
+                    response = await super().send(request, **kwargs)
+            except httpx.TransportError:
+                if attempt == http_retries:
+                    raise
+                http_retry_count += 1
+                await asyncio.sleep(random.uniform(0, http_backoff * 2**attempt))
+                continue
+            if response.status_code in (500, 502, 503, 504) and attempt < http_retries:
+                await response.aclose()
+                http_retry_count += 1
+                await asyncio.sleep(random.uniform(0, http_backoff * 2**attempt))
+                continue
+            # The time to wait may be on the body of a streamed response
+            if response.status_code == 429:
+                await response.aread()
+            retry_after = update_rate_limits(stage, call, response)
+            if attempt == http_retries or retry_after is None:
+                return response
+            await response.aclose()
+            await asyncio.sleep(retry_after)
+
+
+# The Bot API calls are made through the shared HTTP session
+# A local Bot API server may be used instead of Telegram's one
+if config.get("TELEGRAM_API_URL"):
+    telebot.apihelper.API_URL = config["TELEGRAM_API_URL"] + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = config["TELEGRAM_API_URL"] + "/file/bot{0}/{1}"
+telebot.apihelper.session = http_session
+telebot.apihelper.CONNECT_TIMEOUT = http_connect_timeout
+telebot.apihelper.READ_TIMEOUT = http_timeout
+
 # Instantiating the Telegram Chatbot object
-bot = telebot.TeleBot(config["BOT_TOKEN"])
+# The async runtime takes care of the concurrency, so the handlers run on its tasks
+bot = telebot.TeleBot(config["BOT_TOKEN"], threaded=polling_mode == "sync")
 
 # Setting the API Key and model engine for OpenAI
 openai.api_key = config["OPENAI_API_KEY"]
-model_engine = "gpt-3.5-turbo-1106"
+# Retries are made by the shared HTTP session
+openai.http_client = httpx.Client(transport=SessionTransport())
+openai.max_retries = 0
+openai.timeout = http_timeout
+# Base URL of the OpenAI API (another OpenAI compatible server may be used)
+openai_base_url = config.get("OPENAI_BASE_URL") or "https://api.openai.com/v1/"
+openai.base_url = openai_base_url
+
+# Async HTTP and OpenAI clients, created by the async runtime on its event loop
+async_http = None
+async_openai = None
+
+
+# Function to call a Bot API method with the async HTTP client, returning its result
+async def telegram_request(method, **params):
+    url = telebot.apihelper.API_URL.format(config["BOT_TOKEN"], method)
+    response = await async_http.post(url, params=params)
+    result = response.json()
+    if not result.get("ok"):
+        raise telebot.apihelper.ApiTelegramException(method, response, result)
+    return result["result"]
+
+
+# Function to send a text message with the async HTTP client
+async def send_message_async(chat_id, text):
+    return await telegram_request("sendMessage", chat_id=chat_id, text=text)
+
+
+# Model engines for the chat and vision requests
+model_engine = config.get("CHAT_MODEL") or "gpt-3.5-turbo-1106"
+vision_model = config.get("VISION_MODEL") or "gpt-4-vision-preview"
+
+# Deadline (in seconds) of the chat and vision requests, including their hedges
+chat_deadline = float(config.get("CHAT_DEADLINE") or 30)
+vision_deadline = float(config.get("VISION_DEADLINE") or 45)
+# If a request wasn't answered by this percentile of its model's recent latencies (0 disables
+# it), a hedge request is sent to the hedge model (or to the same one), and the first
+# response is used
+hedge_percentile = float(config.get("HEDGE_PERCENTILE") or 95)
+hedge_model = config.get("HEDGE_MODEL")
+vision_hedge_model = config.get("VISION_HEDGE_MODEL")
+# Latencies recorded for a model before its requests are hedged, and the minimum delay
+# (in seconds) before a hedge
+hedge_min_samples = int(config.get("HEDGE_MIN_SAMPLES") or 20)
+hedge_min_delay = float(config.get("HEDGE_MIN_DELAY") or 0.5)
+
+# Recent latencies of each model (model: latencies), and the hedges sent and won
+model_latencies = {}
+latencies_lock = threading.Lock()
+hedge_stats = Counter()
+# Threads running the (possibly hedged) model requests
+model_executor = ThreadPoolExecutor(max_workers=32)
+
+# Minimum side (in pixels) of the photos sent to the vision model, and the maximum one
+# Larger photos are downscaled (the model itself scales them down to these sizes)
+vision_min_side = int(config.get("VISION_MIN_SIDE") or 768)
+vision_max_side = int(config.get("VISION_MAX_SIDE") or 2048)
+# Maximum size (in bytes) of a downloaded photo
+vision_max_bytes = int(config.get("VISION_MAX_BYTES") or 5242880)
+# Byte budget of the processed photos kept in memory (by their Telegram file_unique_id), and
+# the directory and byte budget of the optional on-disk tier
+image_cache_bytes = int(config.get("IMAGE_CACHE_BYTES") or 33554432)
+image_cache_dir = config.get("IMAGE_CACHE_DIR")
+image_cache_disk_bytes = int(config.get("IMAGE_CACHE_DISK_BYTES") or 268435456)
+# Number of recent turns whose photos are re-attached to the text messages that follow them,
+# which are then answered by the vision model (disabled by default, with 0)
+image_followup_turns = int(config.get("IMAGE_FOLLOWUP_TURNS") or 0)
+
+# Processed photos kept in memory (file unique ID: base64 image), from the least recently
+# used, and the bytes they take (the ones on the disk are only counted once needed)
+image_cache = OrderedDict()
+image_cache_lock = threading.Lock()
+image_cache_used = 0
+image_disk_used = None
+# The photos of an album arrive as separate updates (sharing a media_group_id), so they're
+# buffered until none arrived for this long (in seconds), and answered with a single request
+album_window = float(config.get("ALBUM_WINDOW") or 1.5)
+
+# If set, the text messages of a chat are also buffered until none arrived for this long
+# (in seconds), so the ones sent in a quick succession are answered together (0 disables it)
+coalesce_window = float(config.get("COALESCE_WINDOW") or 0)
+
+# Albums being buffered (media group ID: their messages and when they're due to be answered)
+# The buffered messages are answered by the chat's worker, before its next update
+albums = {}
+albums_lock = threading.Lock()
+# Text messages being buffered (chat ID: their messages, when they're due to be answered
+# and a generation, increased by each message, which supersedes the answers in progress)
+fragments = {}
+fragments_lock = threading.Lock()
+
+# Maximum number of results kept on the in-process cache, and for how long (in seconds)
+cache_size = int(config.get("CACHE_SIZE") or 256)
+cache_ttl = int(config.get("CACHE_TTL") or 3600)
+# Generated image URLs expire after a while, so they're kept for less time
+image_cache_ttl = int(config.get("IMAGE_CACHE_TTL") or 1800)
+# If enabled, results are also cached on the DynamoDB table (shared by every instance)
+cache_dynamodb = (config.get("CACHE_DYNAMODB") or "false").lower() == "true"
+# Tag that may be added to a message to skip the cache for it
+cache_opt_out_tag = "#nocache"
+
+# Sizes accepted by the image generation, and the maximum number of images of a request
+# (each size and variant is generated at the same time, and they're sent as an album)
+image_sizes = ("1024x1024", "1792x1024", "1024x1792")
+image_max_images = min(int(config.get("IMAGE_MAX_IMAGES") or 4), 10)
+# Maximum number of image jobs running at the same time on each chat, and of images being
+# generated at the same time by the server
+image_jobs_per_chat = int(config.get("IMAGE_JOBS_PER_CHAT") or 2)
+image_workers = int(config.get("IMAGE_WORKERS") or 8)
+
+# Image jobs running on each chat (chat ID: job IDs), and the threads generating the images
+image_jobs = {}
+image_jobs_lock = threading.Lock()
+image_job_ids = itertools.count(1)
+image_executor = ThreadPoolExecutor(max_workers=image_workers)
+# Threads running the image jobs, waited for before stopping
+image_job_threads = set()
+
+# Users (or chats) allowed to use the bot besides the admin, as comma-separated IDs
+# ("*" allows everyone)
+allowed_users = {
+    user.strip()
+    for user in (config.get("ALLOWED_USERS") or "").split(",")
+    if user.strip()
+}
+# Tokens each user (other than the admin) may use per period ("daily" or "monthly")
+# Over it, requests are downgraded to the fallback model (if set) until the hard quota,
+# which defaults to twice the quota, and rejected from then on (0 disables the quotas)
+token_quota = int(config.get("TOKEN_QUOTA") or 0)
+token_quota_period = config.get("TOKEN_QUOTA_PERIOD") or "daily"
+token_quota_hard = int(config.get("TOKEN_QUOTA_HARD") or 0) or 2 * token_quota
+quota_fallback_model = config.get("QUOTA_FALLBACK_MODEL")
+
+# Tokens used by each user on the current period, as last known (user ID: (period, tokens))
+# It's updated by every charge, so the table is only read on the first request of a user
+quota_usage = {}
+quota_lock = threading.Lock()
+
+# In-process results cache (key: (expiration, result)), from the least recently used
+results_cache = OrderedDict()
+cache_lock = threading.Lock()
+# Cache hits and misses, per route
+cache_stats = {}
 
 # Initializing the boto3 (AWS) session
 session = boto3.Session(
@@ -32,303 +774,3473 @@ session = boto3.Session(
     aws_secret_access_key=config["AWS_SECRET_ACCESS_KEY"],
 )
 
+# Initializing the DynamoDB table once, to be reused by every request
+# An endpoint may be set to use a local table (e.g. DynamoDB Local)
+dynamodb = session.resource(
+    "dynamodb",
+    region_name=config["AWS_REGION"],
+    endpoint_url=config.get("AWS_DYNAMODB_ENDPOINT") or None,
+)
+table = dynamodb.Table(config["AWS_DYNAMODB"])
+meter_aws_client(dynamodb.meta.client)
+
+# Initializing the S3 client, which keeps the older conversation segments
+# An endpoint may be set to use a local bucket (e.g. moto's server)
+s3_endpoint = config.get("AWS_S3_ENDPOINT") or None
+s3 = session.client(
+    "s3",
+    region_name=config["AWS_REGION"],
+    endpoint_url=s3_endpoint,
+    config=botocore.config.Config(
+        s3={"addressing_style": "path" if s3_endpoint else "auto"}
+    ),
+)
+meter_aws_client(s3)
+
+
+# Function to normalize the parameters of a cacheable request
+# Whitespace differences are ignored, as well as the bookkeeping fields of the messages
+def normalize_cache_params(value):
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {
+            k: normalize_cache_params(v)
+            for k, v in value.items()
+            if k not in ("seq", "tokens")
+        }
+    if isinstance(value, list):
+        return [normalize_cache_params(v) for v in value]
+    return value
+
+
+# Function to get the cache key of a request, as a stable hash of its parameters
+def cache_key(route, **params):
+    data = json.dumps(normalize_cache_params(params), sort_keys=True, default=str)
+    return f"cache#{route}#{hashlib.sha256(data.encode()).hexdigest()}"
+
+
+# Function to remove the cache opt-out tag from a text
+# Returns the text without the tag and whether the cache may be used for the request
+def split_cache_opt_out(text):
+    if text and cache_opt_out_tag in text:
+        return " ".join(text.replace(cache_opt_out_tag, " ").split()), False
+    return text, True
+
+
+# Function to get a cached result, from the in-process cache or from the DynamoDB table
+def get_cached_result(route, key):
+    stats = cache_stats.setdefault(route, {"hits": 0, "misses": 0})
+    now = time.time()
+
+    # Looking for the result on the in-process cache first
+    with cache_lock:
+        entry = results_cache.get(key)
+        if entry and entry[0] > now:
+            results_cache.move_to_end(key)
+            stats["hits"] += 1
+            return entry[1]
+
+    # Then, if enabled, on the DynamoDB table (expired items may not be deleted yet)
+    if cache_dynamodb:
+        item = table.get_item(Key={"pk": key, "sk": 0}).get("Item")
+        if item and item["expires_at"] > now:
+            result = json.loads(item["result"])
+            with cache_lock:
+                results_cache[key] = (float(item["expires_at"]), result)
+                while len(results_cache) > cache_size:
+                    results_cache.popitem(last=False)
+            stats["hits"] += 1
+            return result
+
+    stats["misses"] += 1
+    return None
+
+
+# Function to save a result to the in-process cache and, if enabled, to the DynamoDB table
+def set_cached_result(key, result, ttl=None):
+    expires_at = int(time.time() + (ttl or cache_ttl))
+
+    # Saving the result, evicting the least recently used ones over the cache size
+    with cache_lock:
+        results_cache[key] = (expires_at, result)
+        results_cache.move_to_end(key)
+        while len(results_cache) > cache_size:
+            results_cache.popitem(last=False)
+
+    # The table's TTL must be enabled on the "expires_at" attribute
+    if cache_dynamodb:
+        table.put_item(
+            Item={
+                "pk": key,
+                "sk": 0,
+                "result": json.dumps(result),
+                "expires_at": expires_at,
+            }
+        )
+
+
+# Function to get the cache hit rate of each route
+def get_cache_stats():
+    return {
+        route: {
+            **stats,
+            "hit_rate": stats["hits"] / ((stats["hits"] + stats["misses"]) or 1),
+        }
+        for route, stats in cache_stats.items()
+    }
+
+
+# Function to get the path of an image on the on-disk tier of the image cache
+def image_cache_path(file_unique_id):
+    return os.path.join(image_cache_dir, f"{file_unique_id}.b64")
+
+
+# Function to keep a processed image on the in-memory tier of the image cache, evicting the
+# least recently used ones over its byte budget
+def keep_cached_image(file_unique_id, image):
+    global image_cache_used
+    with image_cache_lock:
+        image_cache_used -= len(image_cache.pop(file_unique_id, ""))
+        if len(image) <= image_cache_bytes:
+            image_cache[file_unique_id] = image
+            image_cache_used += len(image)
+        while image_cache_used > image_cache_bytes:
+            image_cache_used -= len(image_cache.popitem(last=False)[1])
+
+
+# Function to get a processed image (encoded as base64) by its Telegram file_unique_id,
+# from the in-memory tier of the image cache or from the on-disk one
+def get_cached_image(file_unique_id):
+    stats = cache_stats.setdefault("image", {"hits": 0, "misses": 0})
+    with image_cache_lock:
+        image = image_cache.get(file_unique_id)
+        if image is not None:
+            image_cache.move_to_end(file_unique_id)
+            stats["hits"] += 1
+            return image
+
+    # The images read from the disk are touched, so the least recently used are removed
+    if image_cache_dir:
+        path = image_cache_path(file_unique_id)
+        try:
+            with open(path) as f:
+                image = f.read()
+            os.utime(path)
+        except OSError:
+            image = None
+        if image:
+            keep_cached_image(file_unique_id, image)
+            stats["hits"] += 1
+            return image
+
+    stats["misses"] += 1
+    return None
+
+
+# Function to save a processed image to the image cache, on both tiers
+def set_cached_image(file_unique_id, image):
+    global image_disk_used
+    keep_cached_image(file_unique_id, image)
+    if not image_cache_dir:
+        return
+    try:
+        # The image is written to a temporary file first, so it's never read incomplete
+        os.makedirs(image_cache_dir, exist_ok=True)
+        path = image_cache_path(file_unique_id)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(image)
+        os.replace(temp_path, path)
+        with image_cache_lock:
+            image_disk_used = (image_disk_used or 0) + len(image)
+            trim = image_disk_used > image_cache_disk_bytes
+        if trim:
+            trim_image_disk_cache()
+    except OSError as e:
+        print(f"Failed to save the image to the disk cache: {e}")
+
+
+# Function to remove the least recently used images of the on-disk tier over its byte budget
+def trim_image_disk_cache():
+    global image_disk_used
+    files = []
+    for entry in os.scandir(image_cache_dir):
+        if entry.name.endswith(".b64"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    used = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if used <= image_cache_disk_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        used -= size
+    with image_cache_lock:
+        image_disk_used = used
+
+
+# Function to select the photo size to be sent to the vision model
+# Telegram sends several sizes of each photo, from the smallest to the largest,
+# so we take the smallest one that still meets the resolution used by the model
+def select_photo_size(photos):
+    for photo in photos:
+        if min(photo.width, photo.height) >= vision_min_side:
+            return photo
+    return photos[-1]
+
+
+# Function to get the reference to a photo kept on the conversation history, so it can be
+# sent again to the vision model on a later turn
+def photo_reference(photo):
+    return {
+        "file_id": photo.file_id,
+        "file_unique_id": photo.file_unique_id,
+        "width": photo.width,
+        "height": photo.height,
+    }
+
+
+# Function to downscale an image to the maximum side used by the vision model
+def downscale_image(image):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image)) as img:
+        img.thumbnail((vision_max_side, vision_max_side))
+        output = io.BytesIO()
+        img.convert("RGB").save(output, format="JPEG", quality=85)
+    return output.getbuffer()
+
+
+# Function to encode binary data as base64, in chunks
+# The chunks are views of the data (multiple of 3 bytes, so no padding is added)
+def encode_base64(data, chunk_size=3 * 64 * 1024):
+    view = memoryview(data)
+    encoded = bytearray()
+    for start in range(0, len(view), chunk_size):
+        encoded += base64.b64encode(view[start : start + chunk_size])
+    return encoded.decode("ascii")
+
 
 # Function to get image from URL as base64
-def url_to_base64(url):
+# The download is streamed and stops if the image exceeds the size limit
+def url_to_base64(url, downscale=False):
     try:
         # Fetch the image from the URL
-        response = requests.get(url)
+        with http_session.get(
+            url, stream=True, timeout=(http_connect_timeout, http_timeout)
+        ) as response:
+            # Check if the request was successful (status code 200)
+            if response.status_code != 200:
+                print(f"Failed to fetch image. Status code: {response.status_code}")
+                return None
 
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Encode the image content as base64
-            base64_image = base64.b64encode(response.content).decode("utf-8")
-            return base64_image
-        else:
-            print(f"Failed to fetch image. Status code: {response.status_code}")
+            # Reading the image content, up to the size limit
+            image = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                image += chunk
+                if len(image) > vision_max_bytes:
+                    print(f"Image exceeds the size limit of {vision_max_bytes} bytes")
+                    return None
+
+        # If the image is larger than the model uses, we downscale it
+        if downscale:
+            image = downscale_image(image)
+
+        # Encode the image content as base64
+        return encode_base64(image)
     except Exception as e:
         print(f"An error occurred: {e}")
     # If no image could be encoded, we return Nne
     return None
 
 
-# Function to get messages from DynamoDN table
-def get_dynamodb_messages():
-    # Initializing DynamoDB instance and getting table
-    dynamodb = session.resource("dynamodb", region_name=config["AWS_REGION"])
-    table = dynamodb.Table(config["AWS_DYNAMODB"])
-    scan = table.scan()
-    # Getting messages formatted as dict
-    dynamo_messages = scan["Items"][0]["messages"]
+# Function to get image from URL as base64 with the async HTTP client, like url_to_base64
+# The image is downscaled and encoded on a thread, so the event loop isn't held by them
+async def url_to_base64_async(url, downscale=False):
+    try:
+        # Fetch the image from the URL
+        async with async_http.stream("GET", url) as response:
+            # Check if the request was successful (status code 200)
+            if response.status_code != 200:
+                print(f"Failed to fetch image. Status code: {response.status_code}")
+                return None
+
+            # Reading the image content, up to the size limit
+            image = bytearray()
+            async for chunk in response.aiter_bytes(chunk_size=64 * 1024):
+                image += chunk
+                if len(image) > vision_max_bytes:
+                    print(f"Image exceeds the size limit of {vision_max_bytes} bytes")
+                    return None
+
+        # If the image is larger than the model uses, we downscale it
+        if downscale:
+            image = await asyncio.to_thread(downscale_image, image)
+
+        # Encode the image content as base64
+        return await asyncio.to_thread(encode_base64, image)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    # If no image could be encoded, we return None
+    return None
+
+
+# Maximum number of messages loaded from the conversation history
+history_limit = int(config.get("HISTORY_LIMIT") or 50)
+
+# If enabled, only the newest messages (the hot tail) are kept on the DynamoDB table, and
+# the older ones are compacted into gzip-compressed JSONL segments on the S3 bucket
+cold_storage = (config.get("COLD_STORAGE") or "false").lower() == "true"
+# Number of messages kept on the hot tail (at least the history limit), and on each segment
+hot_messages = max(int(config.get("HOT_MESSAGES") or 200), history_limit)
+segment_messages = int(config.get("SEGMENT_MESSAGES") or 500)
+
+# Maximum number of chats whose conversation is kept in memory
+conversation_cache_size = int(config.get("CONVERSATION_CACHE_SIZE") or 100)
+
+# Conversations kept in memory (chat ID: conversation), from the least recently used
+conversations = OrderedDict()
+conversations_lock = threading.Lock()
+
+# Maximum number of tokens of the conversation context sent to the chat model
+context_token_budget = int(config.get("CONTEXT_TOKEN_BUDGET") or 3000)
+# Optional system prompt, always pinned at the start of the conversation context
+system_prompt = config.get("SYSTEM_PROMPT")
+# If enabled, messages evicted from the context are kept as a rolling summary
+summarize_evicted = (config.get("SUMMARIZE_EVICTED") or "false").lower() == "true"
+
+# If enabled, every conversation turn is embedded, and the past turns most similar to the
+# new message are recalled on the context, even after they left the history
+long_term_memory = (config.get("MEMORY") or "false").lower() == "true"
+# Embedding model, and the dimensions its embeddings are shortened to (0 keeps them whole)
+embedding_model = config.get("EMBEDDING_MODEL") or "text-embedding-3-small"
+embedding_dimensions = int(config.get("EMBEDDING_DIMENSIONS") or 256)
+# Maximum number of recalled turns, their minimum similarity and their maximum tokens
+memory_top_k = int(config.get("MEMORY_TOP_K") or 3)
+memory_min_score = float(config.get("MEMORY_MIN_SCORE") or 0.3)
+memory_token_budget = int(config.get("MEMORY_TOKENS") or 600)
+# Directory where the memory index of each chat is kept
+memory_dir = config.get("MEMORY_DIR") or "memory"
+
+# Memory indexes opened (chat ID: memory), from the least recently used
+memories = OrderedDict()
+memories_lock = threading.Lock()
+
+# If enabled, text responses are streamed to the user as they are generated
+stream_responses = (config.get("STREAM_RESPONSES") or "false").lower() == "true"
+# Minimum interval (in seconds) between the edits of a streamed message
+stream_edit_interval = float(config.get("STREAM_EDIT_INTERVAL") or 1.0)
+# Maximum length of a Telegram message
+telegram_message_limit = 4096
+
+# If enabled, conversation turns are buffered and saved in batches, when the buffer
+# reaches the size, after the interval (in seconds) or on exit
+write_behind = (config.get("WRITE_BEHIND") or "false").lower() == "true"
+write_behind_size = int(config.get("WRITE_BEHIND_SIZE") or 10)
+write_behind_interval = float(config.get("WRITE_BEHIND_INTERVAL") or 5)
+
+# Conversation turns waiting to be saved (write-behind)
+pending_turns = []
+pending_turns_lock = threading.Lock()
+
+# Tokenizer used to count the messages tokens (loaded on first use)
+tokenizer = None
+
+
+# Function to count the tokens of a message content
+def count_tokens(text):
+    global tokenizer
+    # Loading the tokenizer used by the chat models, if available
+    if tokenizer is None:
+        try:
+            import tiktoken
+
+            tokenizer = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"Tokenizer could not be loaded, estimating tokens: {e}")
+            tokenizer = False
+    # Each message also takes a few tokens for its role and delimiters
+    if tokenizer:
+        return len(tokenizer.encode(text)) + 4
+    # Otherwise, we estimate around 4 characters per token
+    return len(text) // 4 + 4
+
+
+# Function to get the DynamoDB partition key for a chat conversation
+# Each message is stored as its own item, with the sequence number as the sort key
+# The item with sort key 0 holds the conversation metadata (e.g. the last sequence number)
+def chat_key(chat_id):
+    return f"chat#{chat_id}"
+
+
+# Function to get messages from DynamoDB table
+def get_dynamodb_messages(chat_id, limit=history_limit):
+    # Querying only the newest messages of the chat (metadata item is skipped)
+    # The read is strongly consistent, like the metadata one, so the messages cached
+    # under its version include the newest ones
+    res = table.query(
+        KeyConditionExpression=Key("pk").eq(chat_key(chat_id)) & Key("sk").gt(0),
+        ScanIndexForward=False,
+        Limit=limit,
+        ConsistentRead=True,
+    )
+
+    # Items are returned newest first, so we reverse them to the conversation order
+    # The sequence number and the token count are kept to build the context later
+    dynamo_messages = [
+        {
+            "role": item["role"],
+            "content": item["content"],
+            "seq": int(item["sk"]),
+            "tokens": int(item.get("tokens") or count_tokens(item["content"])),
+            **({"images": item["images"]} if "images" in item else {}),
+        }
+        for item in reversed(res["Items"])
+    ]
+
+    # Returning resulting list
+    return dynamo_messages
+
+
+# Function to reserve the next sequence number(s) for a chat conversation
+# The atomic counter keeps the messages strictly ordered, even with concurrent writers
+def next_dynamo_sequence(table, chat_id, count=1):
+    res = table.update_item(
+        Key={"pk": chat_key(chat_id), "sk": 0},
+        UpdateExpression="ADD last_seq :count",
+        ExpressionAttributeValues={":count": count},
+        ReturnValues="UPDATED_NEW",
+    )
+    # Returning the first reserved sequence number
+    return int(res["Attributes"]["last_seq"]) - count + 1
+
+
+# Function to get the DynamoDB item of a conversation message
+# The message must be formatted as one of the following:
+# {"role": "user", "content": "Text content'}
+# {"role": "assistant", "content": "Text content'}
+# The tokens are counted only once, and stored alongside the message
+def dynamo_message_item(chat_id, seq, message):
+    message["seq"] = seq
+    return {
+        "pk": chat_key(chat_id),
+        "sk": seq,
+        "role": message["role"],
+        "content": message["content"],
+        "tokens": message.setdefault("tokens", count_tokens(message["content"])),
+        # The photos of the message are referenced by their Telegram IDs
+        **({"images": message["images"]} if message.get("images") else {}),
+    }
+
+
+# Function to save conversation turns (the user message and the response) on DynamoDB table
+# Each turn is a tuple with the chat ID, both messages and the request metadata
+# (e.g. the model and the token usage), which is kept on the response item
+def save_dynamo_turns(turns):
+    # Reserving the sequence numbers of each chat with a single update
+    # The numbers are kept on the messages, so turns saved again after a failure reuse
+    # them (overwriting the items already written, instead of writing them twice)
+    counts = {}
+    for chat_id, user_message, *_ in turns:
+        if "seq" not in user_message:
+            counts[chat_id] = counts.get(chat_id, 0) + 2
+    for chat_id, count in counts.items():
+        seq = next_dynamo_sequence(table, chat_id, count)
+        for turn_chat_id, user_message, bot_message, _ in turns:
+            if turn_chat_id == chat_id and "seq" not in user_message:
+                user_message["seq"], bot_message["seq"] = seq, seq + 1
+                seq += 2
+
+    # Writing every message with batch requests (up to 25 items each)
+    last_seqs = {}
+    with table.batch_writer() as batch:
+        for chat_id, user_message, bot_message, metadata in turns:
+            seq = user_message["seq"]
+            batch.put_item(Item=dynamo_message_item(chat_id, seq, user_message))
+            batch.put_item(
+                Item={
+                    **dynamo_message_item(chat_id, seq + 1, bot_message),
+                    **(metadata or {}),
+                }
+            )
+            last_seqs[chat_id] = max(last_seqs.get(chat_id, 0), seq + 1)
+
+    # Moving the oldest messages of each chat to the S3 bucket, if needed
+    for chat_id, last_seq in last_seqs.items():
+        with conversations_lock:
+            conversation = conversations.get(chat_id, {})
+        compact_hot_tail(chat_id, conversation, last_seq)
+
+    # Adding the turns to the chat memories
+    if long_term_memory:
+        remember_turns([turn[:3] for turn in turns])
+
+
+# Function to save a conversation turn on DynamoDB table
+# With write-behind enabled, the turn is added to the cached conversation and buffered,
+# to be saved along with the next ones
+def queue_dynamo_turn(chat_id, conversation, user_message, bot_message, metadata=None):
+    if not write_behind:
+        save_conversation_turn(
+            chat_id, conversation, user_message, bot_message, metadata
+        )
+        return
+
+    # Saving the buffered turns once the buffer is full
+    append_conversation_messages(conversation, [user_message, bot_message])
+    with pending_turns_lock:
+        pending_turns.append((chat_id, user_message, bot_message, metadata))
+        full = len(pending_turns) >= write_behind_size
+    if full:
+        flush_dynamo_turns()
+
+
+# Function to save the buffered conversation turns on DynamoDB table
+def flush_dynamo_turns():
+    with pending_turns_lock:
+        turns = pending_turns[:]
+        pending_turns.clear()
+    if not turns:
+        return
+    try:
+        save_dynamo_turns(turns)
+    # If something goes wrong, the turns are kept on the buffer to be saved later
+    except Exception as e:
+        print(f"Failed to save the conversation turns: {e}")
+        with pending_turns_lock:
+            pending_turns[:0] = turns
+
+
+# Function to save the buffered conversation turns periodically
+def flush_dynamo_turns_periodically():
+    while True:
+        time.sleep(write_behind_interval)
+        flush_dynamo_turns()
+
+
+# Function to get the conversation metadata from DynamoDB table: its version (the last
+# sequence number), the rolling summary of the evicted messages, the last sequence
+# number moved to the S3 bucket and the first one after the last clear
+def get_dynamodb_conversation_meta(chat_id):
+    item = table.get_item(
+        Key={"pk": chat_key(chat_id), "sk": 0}, ConsistentRead=True
+    ).get("Item", {})
+    return (
+        int(item.get("last_seq", 0)),
+        item.get("summary"),
+        int(item.get("summary_seq", 0)),
+        int(item.get("cold_seq", 0)),
+        int(item.get("cleared_seq", 0)),
+    )
+
+
+# Function to add messages to a cached conversation, keeping only the newest ones
+def append_conversation_messages(conversation, messages):
+    conversation["messages"].extend(messages)
+    del conversation["messages"][:-history_limit]
+
+
+# Function to get the conversation of a chat (its newest messages and metadata)
+# The cached conversation is used while its version matches the stored one, so the
+# history is only read again when the conversation was changed elsewhere
+def get_conversation(chat_id):
+    # With write-behind, the buffered turns are only in memory, so the cached conversation
+    # is used as is (the bot must be the only writer of its conversations)
+    if write_behind:
+        with conversations_lock:
+            conversation = conversations.get(chat_id)
+            if conversation is not None:
+                conversations.move_to_end(chat_id)
+                return conversation
+        flush_dynamo_turns()
+
+    meta = get_dynamodb_conversation_meta(chat_id)
+    version, summary, summary_seq, cold_seq, cleared_seq = meta
+    with conversations_lock:
+        conversation = conversations.get(chat_id)
+        if conversation is not None and conversation["version"] == version:
+            conversations.move_to_end(chat_id)
+        else:
+            conversation = None
+
+    # Otherwise, the history is loaded and cached, evicting the least recently used chats
+    if conversation is None:
+        conversation = {"version": version, "messages": get_dynamodb_messages(chat_id)}
+        with conversations_lock:
+            conversations[chat_id] = conversation
+            while len(conversations) > conversation_cache_size:
+                conversations.popitem(last=False)
+
+    conversation["summary"] = summary
+    conversation["summary_seq"] = summary_seq
+    conversation["cold_seq"] = cold_seq
+    conversation["cleared_seq"] = cleared_seq
+    return conversation
+
+
+# Function to save a conversation turn on DynamoDB table, with optimistic concurrency
+# The turn (the user message and the response, which keeps the request metadata) is
+# written with a single transaction, only if the conversation is still at its version;
+# otherwise, the conversation is reloaded and the turn goes after the new messages
+def save_conversation_turn(
+    chat_id, conversation, user_message, bot_message, metadata=None
+):
+    for attempt in range(3):
+        version = conversation["version"]
+        items = [
+            dynamo_message_item(chat_id, version + 1, user_message),
+            {
+                **dynamo_message_item(chat_id, version + 2, bot_message),
+                **(metadata or {}),
+            },
+        ]
+        try:
+            table.meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": table.name,
+                            "Key": {"pk": chat_key(chat_id), "sk": 0},
+                            "UpdateExpression": "SET last_seq = :next",
+                            "ConditionExpression": "attribute_not_exists(last_seq) OR last_seq = :version",
+                            "ExpressionAttributeValues": {
+                                ":next": version + 2,
+                                ":version": version,
+                            },
+                        }
+                    }
+                ]
+                + [{"Put": {"TableName": table.name, "Item": item}} for item in items]
+            )
+            break
+        # If the conversation was changed elsewhere, we reload it and try again
+        except table.meta.client.exceptions.TransactionCanceledException:
+            print(f"Conversation {chat_id} changed, reloading it")
+            conversation = get_conversation(chat_id)
+    else:
+        raise Exception("The conversation was changed too many times while saving")
+
+    # Updating the cached conversation with the new messages
+    conversation["version"] = version + 2
+    append_conversation_messages(conversation, [user_message, bot_message])
+
+    # Moving the oldest messages to the S3 bucket, if needed
+    compact_hot_tail(chat_id, conversation, conversation["version"])
+
+    # Adding the turn to the chat memory
+    if long_term_memory:
+        remember_turns([(chat_id, user_message, bot_message)])
+
+
+# Function to get the S3 key prefix of a chat conversation segments
+def segment_prefix(chat_id):
+    return f"conversations/{chat_id}/"
+
+
+# Function to get the S3 key of a conversation segment
+# The zero-padded sequence numbers keep the segments listed in the conversation order,
+# and the random suffix keeps concurrent compactions of the same range apart
+def segment_key(chat_id, first_seq, last_seq):
+    suffix = os.urandom(4).hex()
+    return (
+        f"{segment_prefix(chat_id)}{first_seq:012d}-{last_seq:012d}-{suffix}.jsonl.gz"
+    )
+
+
+# Function to convert the numbers read from DynamoDB table (decimals) to JSON ones
+def json_number(value):
+    return int(value) if value % 1 == 0 else float(value)
+
+
+# Function to get the segment record of a message item, which keeps its sequence number
+# and request metadata
+def segment_record(item):
+    return {
+        "seq": int(item["sk"]),
+        **{k: v for k, v in item.items() if k not in ("pk", "sk")},
+    }
+
+
+# Function to encode records as a gzip-compressed JSONL segment (a message per line)
+def encode_segment(records):
+    lines = (
+        json.dumps(record, default=json_number, ensure_ascii=False) + "\n"
+        for record in records
+    )
+    return gzip.compress("".join(lines).encode(), compresslevel=6)
+
+
+# Function to decode the messages of a gzip-compressed JSONL segment
+def decode_segment(data):
+    return [json.loads(line) for line in gzip.decompress(data).splitlines() if line]
+
+
+# Function to query every item of a chat conversation within a range of sequence numbers
+def query_conversation_items(chat_id, first_seq, last_seq=None):
+    key = Key("pk").eq(chat_key(chat_id))
+    if last_seq is None:
+        key &= Key("sk").gte(first_seq)
+    else:
+        key &= Key("sk").between(first_seq, last_seq)
+    query = {"KeyConditionExpression": key, "ConsistentRead": True}
+    items = []
+    while True:
+        res = table.query(**query)
+        items.extend(res["Items"])
+        # Following the pagination until all items are read
+        if "LastEvaluatedKey" not in res:
+            return items
+        query["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+
+# Function to move the oldest messages of a conversation to the S3 bucket, once its hot tail
+# (up to the given version) is a segment too long
+def compact_hot_tail(chat_id, conversation, version):
+    if (
+        cold_storage
+        and version - conversation.get("cold_seq", 0) > hot_messages + segment_messages
+    ):
+        try:
+            conversation["cold_seq"] = compact_conversation(chat_id)
+        except Exception as e:
+            print(f"Failed to compact the conversation {chat_id}: {e}")
+
+
+# Function to move the oldest segment of the hot tail to the S3 bucket, returning the last
+# sequence number moved so far
+# The segment is uploaded first, then the cold sequence number moves forward (if no other
+# compaction or clear got there first) and only then the items are deleted, so the messages
+# are never lost; a failed attempt just leaves its segment behind, which is removed
+def compact_conversation(chat_id):
+    item = table.get_item(
+        Key={"pk": chat_key(chat_id), "sk": 0},
+        ConsistentRead=True,
+        ProjectionExpression="last_seq, cold_seq",
+    ).get("Item", {})
+    last_seq, cold_seq = int(item.get("last_seq", 0)), int(item.get("cold_seq", 0))
+    if last_seq - cold_seq <= hot_messages + segment_messages:
+        return cold_seq
+
+    # Uploading the oldest messages of the hot tail as a segment
+    next_cold_seq = cold_seq + segment_messages
+    items = query_conversation_items(chat_id, cold_seq + 1, next_cold_seq)
+    bucket = config["AWS_BUCKET"]
+    key = segment_key(chat_id, cold_seq + 1, next_cold_seq)
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=encode_segment(map(segment_record, items)),
+        ContentType="application/gzip",
+    )
+
+    try:
+        table.update_item(
+            Key={"pk": chat_key(chat_id), "sk": 0},
+            UpdateExpression="SET cold_seq = :next",
+            ConditionExpression="attribute_not_exists(cold_seq) OR cold_seq = :cold",
+            ExpressionAttributeValues={":next": next_cold_seq, ":cold": cold_seq},
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Conversation {chat_id} was already compacted or cleared")
+        s3.delete_object(Bucket=bucket, Key=key)
+        return get_dynamodb_conversation_meta(chat_id)[3]
+
+    # Deleting the moved messages from the hot tail
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.delete_item(Key={"pk": item["pk"], "sk": item["sk"]})
+    return next_cold_seq
+
+
+# Function to list the S3 keys of a chat conversation segments, in the conversation order
+def list_conversation_segments(chat_id):
+    keys = []
+    pages = s3.get_paginator("list_objects_v2")
+    for page in pages.paginate(
+        Bucket=config["AWS_BUCKET"], Prefix=segment_prefix(chat_id)
+    ):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return sorted(keys)
+
+
+# Function to export the full history of a conversation as a gzip-compressed JSONL file,
+# joining the segments on the S3 bucket and the hot tail on the DynamoDB table
+def export_conversation(chat_id):
+    # Records by sequence number, so the messages left behind by an interrupted compaction
+    # (or the segments of concurrent ones) are only exported once
+    records = {}
+    if cold_storage:
+        for key in list_conversation_segments(chat_id):
+            obj = s3.get_object(Bucket=config["AWS_BUCKET"], Key=key)
+            for record in decode_segment(obj["Body"].read()):
+                records[record["seq"]] = record
+    for item in query_conversation_items(chat_id, 1):
+        records.setdefault(int(item["sk"]), segment_record(item))
+    return encode_segment(records[seq] for seq in sorted(records))
+
+
+# Function to clear previous saved messages on DynamoDB table
+def clear_dynamo_messages(chat_id):
+    # Saving the buffered turns first, so they're cleared as well
+    flush_dynamo_turns()
+
+    # Deleting every message item of the chat (the sequence counter is kept)
+    query = {
+        "KeyConditionExpression": Key("pk").eq(chat_key(chat_id)) & Key("sk").gt(0),
+        "ProjectionExpression": "pk, sk",
+    }
+    with table.batch_writer() as batch:
+        while True:
+            res = table.query(**query)
+            for item in res["Items"]:
+                batch.delete_item(Key={"pk": item["pk"], "sk": item["sk"]})
+            # Following the pagination until all items are deleted
+            if "LastEvaluatedKey" not in res:
+                break
+            query["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+    # Removing the rolling summary of the conversation as well, and changing its version
+    # (the counter is kept, so the sequence numbers are never reused)
+    # The hot tail (and the memory) starts over after the cleared messages
+    table.update_item(
+        Key={"pk": chat_key(chat_id), "sk": 0},
+        UpdateExpression=(
+            "REMOVE summary, summary_seq"
+            " SET cold_seq = if_not_exists(last_seq, :zero) + :one,"
+            " cleared_seq = if_not_exists(last_seq, :zero) + :one"
+            " ADD last_seq :one"
+        ),
+        ExpressionAttributeValues={":one": 1, ":zero": 0},
+    )
+
+    # Deleting the segments on the S3 bucket, after the cold sequence number changed (so no
+    # compaction in progress may add one later)
+    if cold_storage:
+        keys = list_conversation_segments(chat_id)
+        for i in range(0, len(keys), 1000):
+            s3.delete_objects(
+                Bucket=config["AWS_BUCKET"],
+                Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+            )
+
+    # Clearing the chat memory as well
+    if long_term_memory:
+        clear_memory(chat_id)
+
+    # Removing the cached conversation
+    with conversations_lock:
+        conversations.pop(chat_id, None)
+
+
+# Function to save the rolling summary of the evicted messages on DynamoDB table
+def update_dynamo_summary(chat_id, summary, summary_seq):
+    # Only a summary covering newer messages may replace the current one
+    try:
+        table.update_item(
+            Key={"pk": chat_key(chat_id), "sk": 0},
+            UpdateExpression="SET summary = :summary, summary_seq = :seq",
+            ConditionExpression="attribute_not_exists(summary_seq) OR summary_seq < :seq",
+            ExpressionAttributeValues={":summary": summary, ":seq": summary_seq},
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        print("A newer conversation summary was already saved")
+
+
+# Function to summarize the messages evicted from the context, along with the previous summary
+def summarize_messages(summary, evicted):
+    # Formatting the evicted messages as a transcript
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+    if summary:
+        transcript = f"Previous summary: {summary}\n\n{transcript}"
+
+    # Requesting a short summary to the chat model
+    res = openai.chat.completions.create(
+        model=model_engine,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Summarize the conversation below in a few sentences,"
+                    " keeping facts that may be needed later."
+                ),
+            },
+            {"role": "user", "content": transcript},
+        ],
+        max_tokens=300,
+    )
+    record_usage(res.usage.model_dump())
+    return res.choices[0].message.content
+
+
+# Function to get the embeddings of texts, normalized so their dot product is the cosine
+def embed_texts(texts):
+    # The newer embedding models may shorten the embeddings to the given dimensions
+    res = openai.embeddings.create(
+        model=embedding_model,
+        input=texts,
+        extra_body=(
+            {"dimensions": embedding_dimensions} if embedding_dimensions else None
+        ),
+        timeout=chat_deadline,
+    )
+    record_usage(res.usage.model_dump())
+    vectors = np.array([item.embedding for item in res.data], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# Function to get the text of a conversation turn, as embedded on the memory
+def turn_text(messages):
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+# Function to (re)map the files of a chat memory, after they changed
+# Each turn is a row of the index (its sequence number, and where its messages start and
+# end on the turns file), along with its embedding on the vectors file
+def map_memory(memory):
+    rows_path = os.path.join(memory["path"], "rows.i64")
+    count = os.path.getsize(rows_path) // 24 if os.path.exists(rows_path) else 0
+    memory.update(count=count, rows=None, vectors=None)
+    if count:
+        memory["rows"] = np.memmap(rows_path, np.int64, "r", shape=(count, 3))
+        memory["vectors"] = np.memmap(
+            os.path.join(memory["path"], "vectors.f32"),
+            np.float32,
+            "r",
+            shape=(count, embedding_dimensions or 1536),
+        )
+
+
+# Function to remove every turn of a chat memory
+def reset_memory(memory):
+    memory.update(rows=None, vectors=None)
+    for name in ("rows.i64", "vectors.f32", "turns.jsonl"):
+        path = os.path.join(memory["path"], name)
+        if os.path.exists(path):
+            os.remove(path)
+    map_memory(memory)
+
+
+# Function to open the memory of a chat, whose files are kept on the memory directory
+# The opened memories are kept, evicting the least recently used ones
+def open_memory(chat_id):
+    with memories_lock:
+        memory = memories.get(chat_id)
+        if memory is not None:
+            memories.move_to_end(chat_id)
+            return memory
+
+    path = os.path.join(memory_dir, str(chat_id))
+    os.makedirs(path, exist_ok=True)
+    memory = {"path": path, "lock": threading.Lock()}
+    try:
+        map_memory(memory)
+    # Files left incomplete (or with other dimensions) are started over
+    except ValueError:
+        reset_memory(memory)
+    with memories_lock:
+        memory = memories.setdefault(chat_id, memory)
+        while len(memories) > conversation_cache_size:
+            memories.popitem(last=False)
+    return memory
+
+
+# Function to add turns to a chat memory, appending to its files
+# Each turn is a dict with its sequence number (the user message one) and its messages
+def append_memory(memory, turns, vectors):
+    count = memory["count"]
+    start = int(memory["rows"][-1, 1] + memory["rows"][-1, 2]) if count else 0
+    lines = [
+        json.dumps(turn["messages"], ensure_ascii=False).encode() + b"\n"
+        for turn in turns
+    ]
+    rows = []
+    for turn, line in zip(turns, lines):
+        rows.append((turn["seq"], start, len(line)))
+        start += len(line)
+
+    # The rows are written last, so anything left behind by an interrupted append (past
+    # the last row) is dropped on the next one
+    with open(os.path.join(memory["path"], "turns.jsonl"), "ab") as f:
+        f.truncate(rows[0][1])
+        f.write(b"".join(lines))
+    with open(os.path.join(memory["path"], "vectors.f32"), "ab") as f:
+        f.truncate(count * vectors.shape[1] * 4)
+        f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+    with open(os.path.join(memory["path"], "rows.i64"), "ab") as f:
+        f.write(np.array(rows, dtype=np.int64).tobytes())
+    map_memory(memory)
+
+
+# Function to read turns of a chat memory, by their row indexes
+def read_memory_turns(memory, indexes):
+    turns = []
+    with open(os.path.join(memory["path"], "turns.jsonl"), "rb") as f:
+        for index in indexes:
+            seq, start, length = (int(value) for value in memory["rows"][index])
+            f.seek(start)
+            turns.append({"seq": seq, "messages": json.loads(f.read(length))})
+    return turns
+
+
+# Function to get the past turns most similar to an embedding, with their similarity
+# Only the turns between the given sequence numbers are searched (e.g. the ones older than
+# the context, and newer than the last clear)
+def search_memory(memory, vector, after_seq, before_seq):
+    if not memory["count"]:
+        return []
+    rows, vectors = memory["rows"], memory["vectors"]
+    first, last = np.searchsorted(rows[:, 0], [after_seq, before_seq])
+    if first >= last:
+        return []
+
+    # Cosine similarity of every turn at once (the embeddings are normalized), keeping the
+    # top ones without sorting the whole range
+    scores = vectors[first:last] @ vector
+    k = min(memory_top_k, len(scores))
+    top = np.argpartition(scores, -k)[-k:]
+    top = top[np.argsort(scores[top])[::-1]]
+    top = top[scores[top] >= memory_min_score]
+    turns = read_memory_turns(memory, first + top)
+    for turn, score in zip(turns, scores[top]):
+        turn["score"] = float(score)
+    return turns
+
+
+# Function to add saved conversation turns to the chat memories, embedding all of them with
+# a single request
+# Each turn is a tuple with the chat ID and both messages (which have their sequence numbers)
+def remember_turns(turns):
+    try:
+        vectors = embed_texts(
+            [
+                turn_text([user_message, bot_message])
+                for _, user_message, bot_message in turns
+            ]
+        )
+        for i, (chat_id, user_message, bot_message) in enumerate(turns):
+            memory = open_memory(chat_id)
+            with memory["lock"]:
+                append_memory(
+                    memory,
+                    [
+                        {
+                            "seq": user_message["seq"],
+                            "messages": [
+                                {"role": m["role"], "content": m["content"]}
+                                for m in (user_message, bot_message)
+                            ],
+                        }
+                    ],
+                    vectors[i : i + 1],
+                )
+    # The memory is an addition to the context, so a failure is only logged
+    except Exception as e:
+        print(f"Failed to remember the conversation turns: {e}")
+
+
+# Function to clear the memory of a chat
+def clear_memory(chat_id):
+    memory = open_memory(chat_id)
+    with memory["lock"]:
+        reset_memory(memory)
+
+
+# Function to add the past turns most similar to the new message to the context (right
+# before the recent messages), as long as they're older than the context
+def add_recalled_turns(chat_id, conversation, history, context):
+    try:
+        memory = open_memory(chat_id)
+        # The turns from before the last clear (e.g. made elsewhere) are dropped
+        with memory["lock"]:
+            if memory["count"] and memory["rows"][0, 0] < conversation["cleared_seq"]:
+                reset_memory(memory)
+        vector = embed_texts([history[-1]["content"]])[0]
+
+        # The oldest message of the history on the context (the newest messages may not
+        # have a sequence number yet)
+        pinned = sum(1 for m in context if m["role"] == "system")
+        recent = history[len(history) - (len(context) - pinned) :]
+        before_seq = min(
+            (m["seq"] for m in recent if "seq" in m),
+            default=conversation["version"] + 1,
+        )
+        turns = search_memory(memory, vector, conversation["cleared_seq"], before_seq)
+    # The memory is an addition to the context, so a failure is only logged
+    except Exception as e:
+        print(f"Failed to recall the turns of chat {chat_id}: {e}")
+        return context
+
+    # Adding the most similar turns that fit the memory budget, in the conversation order
+    lines, used = [], 0
+    for turn in turns:
+        text = turn_text(turn["messages"])
+        tokens = count_tokens(text)
+        if lines and used + tokens > memory_token_budget:
+            break
+        used += tokens
+        lines.append((turn["seq"], text))
+    if not lines:
+        return context
+    recalled = {
+        "role": "system",
+        "content": "Relevant earlier messages of the conversation:\n\n"
+        + "\n\n".join(text for _, text in sorted(lines)),
+    }
+    return context[:pinned] + [recalled] + context[pinned:]
+
+
+# Function to build the conversation context that fits the token budget
+# The newest messages are kept, along with the pinned system prompt and the rolling summary
+def build_context(history, summary=None, budget=context_token_budget):
+    # Defining the pinned messages at the start of the context
+    pinned = []
+    if system_prompt:
+        pinned.append({"role": "system", "content": system_prompt})
+    if summary:
+        pinned.append(
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {summary}",
+            }
+        )
+    used = sum(count_tokens(m["content"]) for m in pinned)
+
+    # Adding the newest messages while they fit the budget (the last one is always sent)
+    selected = []
+    for message in reversed(history):
+        tokens = message.get("tokens") or count_tokens(message["content"])
+        if selected and used + tokens > budget:
+            break
+        used += tokens
+        selected.append({"role": message["role"], "content": message["content"]})
+    selected.reverse()
+
+    # Returning the context and the messages evicted from it
+    evicted = history[: len(history) - len(selected)]
+    return pinned + selected, evicted
+
+
+# Function to get the conversation context to be sent to the chat model
+def get_conversation_context(chat_id, history, conversation):
+    # If summaries are disabled, evicted messages are simply left out
+    if not summarize_evicted:
+        return build_context(history)[0]
+
+    # Otherwise, new evicted messages are folded into the rolling summary
+    summary = conversation["summary"]
+    context, evicted = build_context(history, summary)
+    new_evicted = [m for m in evicted if m.get("seq", 0) > conversation["summary_seq"]]
+    if new_evicted:
+        summary = summarize_messages(summary, new_evicted)
+        update_dynamo_summary(chat_id, summary, new_evicted[-1]["seq"])
+        conversation["summary"] = summary
+        conversation["summary_seq"] = new_evicted[-1]["seq"]
+        context = build_context(history[len(evicted) :], summary)[0]
+    return context
+
+
+# Function to record the latency of a model request, keeping the most recent ones
+def record_model_latency(model, seconds):
+    with latencies_lock:
+        latencies = model_latencies.setdefault(model, deque(maxlen=100))
+        latencies.append(seconds)
+
+
+# Function to get after how long (in seconds) a request to a model is hedged
+# Returns None if hedging is disabled, or there are not enough recorded latencies yet
+def get_hedge_delay(model):
+    if not hedge_percentile:
+        return None
+    with latencies_lock:
+        latencies = sorted(model_latencies.get(model, ()))
+    if len(latencies) < hedge_min_samples:
+        return None
+    index = min(len(latencies) - 1, int(len(latencies) * hedge_percentile / 100))
+    return max(latencies[index], hedge_min_delay)
+
+
+# Function to make a model request within a deadline, hedging it if it's slower than usual
+# The request function receives the model and its timeout, and the first response is used
+# (a late one is discarded, as its call can't be interrupted, but its timeout ends with the
+# deadline, and the discard function, if given, still gets it, e.g. to charge its usage)
+def hedged_request(
+    request, model, fallback_model=None, deadline=chat_deadline, discard=None
+):
+    expires = time.monotonic() + deadline
+    finished = threading.Event()
+
+    # Function to make one of the requests, recording its latency
+    # The requests run on other threads, so they're tagged with the update's route and chat
+    @in_metrics_context
+    def attempt(model):
+        metrics_context.finished = finished
+        try:
+            started = time.monotonic()
+            result = request(model, max(expires - started, 0.001))
+            record_model_latency(model, time.monotonic() - started)
+            return result
+        finally:
+            metrics_context.finished = None
+
+    # Function to pass the response of a request that wasn't used to the discard function
+    def discarded(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            discard(future.result())
+        except Exception as e:
+            print(f"Failed to discard a {model} response: {e}")
+
+    futures = [model_executor.submit(attempt, model)]
+    pending = set(futures)
+    hedge = None
+    delay = get_hedge_delay(model)
+    if delay is not None and delay < deadline:
+        # If the request is slower than usual, the hedge one is sent
+        if not wait(pending, timeout=delay).done:
+            hedge = model_executor.submit(attempt, fallback_model or model)
+            futures.append(hedge)
+            pending.add(hedge)
+            with latencies_lock:
+                hedge_stats["sent"] += 1
+            print(f"Hedged the {model} request after {delay:.3f}s")
+
+    # Waiting for the first successful response, until the deadline
+    # Once it's over, the other requests are discarded
+    error = None
+    winner = None
+    try:
+        while pending:
+            remaining = max(expires - time.monotonic(), 0)
+            done, pending = wait(
+                pending, timeout=remaining, return_when=FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    with latencies_lock:
+                        hedge_stats["won"] += 1
+                winner = future
+                return result
+        if error is not None:
+            raise error
+        raise TimeoutError(f"The {model} request exceeded its deadline of {deadline}s")
+    finally:
+        finished.set()
+        if discard:
+            for future in futures:
+                if future is not winner:
+                    future.add_done_callback(discarded)
+
+
+# Function to make a model request within a deadline with the async clients, hedging it if
+# it's slower than usual, like hedged_request does (the request function is a coroutine)
+# A late response is passed to the discard function, if given, or cancelled otherwise
+async def hedged_request_async(
+    request, model, fallback_model=None, deadline=chat_deadline, discard=None
+):
+    expires = time.monotonic() + deadline
+    finished = threading.Event()
+
+    # Function to make one of the requests, recording its latency
+    # Each request runs on its own task, so its stages stop being recorded once finished
+    async def attempt(model):
+        metrics_context.finished = finished
+        started = time.monotonic()
+        result = await request(model, max(expires - started, 0.001))
+        record_model_latency(model, time.monotonic() - started)
+        return result
+
+    # Function to pass the response of a request that wasn't used to the discard function
+    # (on a thread, as it may make blocking calls)
+    def discarded(task):
+        if task.cancelled() or task.exception() is not None or discard is None:
+            return
+        asyncio.get_running_loop().run_in_executor(None, discard_result, task.result())
+
+    def discard_result(result):
+        try:
+            discard(result)
+        except Exception as e:
+            print(f"Failed to discard a {model} response: {e}")
+
+    tasks = [asyncio.create_task(attempt(model))]
+    pending = set(tasks)
+    hedge = None
+    delay = get_hedge_delay(model)
+    if delay is not None and delay < deadline:
+        # If the request is slower than usual, the hedge one is sent
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            hedge = asyncio.create_task(attempt(fallback_model or model))
+            tasks.append(hedge)
+            pending.add(hedge)
+            with latencies_lock:
+                hedge_stats["sent"] += 1
+            print(f"Hedged the {model} request after {delay:.3f}s")
+
+    # Waiting for the first successful response, until the deadline
+    # Once it's over, the other requests are discarded
+    error = None
+    winner = None
+    try:
+        while pending:
+            remaining = max(expires - time.monotonic(), 0)
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for task in done:
+                try:
+                    result = task.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if task is hedge:
+                    with latencies_lock:
+                        hedge_stats["won"] += 1
+                winner = task
+                return result
+        if error is not None:
+            raise error
+        raise TimeoutError(f"The {model} request exceeded its deadline of {deadline}s")
+    finally:
+        finished.set()
+        for task in tasks:
+            if task is not winner:
+                if discard is None:
+                    task.cancel()
+                task.add_done_callback(discarded)
+
+
+# Function to stream a chat completion to the user, editing a message as the tokens arrive
+# The edits are throttled (Telegram limits the edits per chat) and long responses
+# continue on follow-up messages, returning the complete response at the end
+def stream_completion(chat_id, messages, model=model_engine):
+    # Sending a placeholder message right away, to be updated with the response
+    started = time.monotonic()
+    sent = bot.send_message(chat_id, "...")
+    stream = openai.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        timeout=chat_deadline,
+    )
+
+    # Response received so far, where the current message starts on it and what it shows
+    response = ""
+    offset = 0
+    shown = ""
+    last_edit = 0
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            response += delta
+
+            # If the current message is full, we finish it and continue on a new one
+            # (unless it already shows its full text, which Telegram wouldn't take as an edit)
+            while len(response) - offset > telegram_message_limit:
+                end = offset + telegram_message_limit
+                if response[offset:end] != shown:
+                    try:
+                        bot.edit_message_text(
+                            response[offset:end], chat_id, sent.message_id
+                        )
+                    # A failed edit only leaves this message short, so the reply goes on
+                    except Exception as e:
+                        print(f"Failed to finish the streamed message: {e}")
+                offset = end
+                shown = response[offset : offset + telegram_message_limit]
+                sent = bot.send_message(chat_id, shown)
+                last_edit = time.monotonic()
+
+            # Otherwise, we update the current message if the edit interval has passed
+            interval_passed = time.monotonic() - last_edit >= stream_edit_interval
+            if interval_passed and response[offset:] != shown:
+                if not shown:
+                    print(
+                        f"Time to first visible token: {time.monotonic() - started:.3f}s"
+                    )
+                shown = response[offset:]
+                last_edit = time.monotonic()
+                try:
+                    bot.edit_message_text(shown, chat_id, sent.message_id)
+                # A failed intermediate edit is fine, as the next one carries the full text
+                except Exception as e:
+                    print(f"Failed to edit the streamed message: {e}")
+
+    # The stream's connection is released even if the reply fails midway
+    finally:
+        stream.response.close()
+
+    # Making sure the final text is shown
+    if response[offset:] != shown:
+        bot.edit_message_text(
+            response[offset:] or "(empty response)", chat_id, sent.message_id
+        )
+
+    # Returning the complete response
+    return response
+
+
+# Function to answer the conversation, sending the response to the user
+# Returns the response content, to be saved to the conversation, and the request metadata
+# If a claim function is given, the response is only sent if it succeeds (otherwise, the
+# messages were superseded by a newer one, and the content is None)
+# If a charge function is given, it gets the tokens of a hedged response that wasn't used
+def reply_chat_completion(
+    chat_id, messages, use_cache=True, model=model_engine, claim=None, charge=None
+):
+    # Identical requests are answered from the cache
+    key = cache_key("chat", model=model, messages=messages)
+    cached = get_cached_result("chat", key) if use_cache else None
+    if cached:
+        if claim and not claim():
+            return None, None
+        bot.send_message(chat_id, cached["content"])
+        return cached["content"], {"model": model, "cached": True}
+
+    # If enabled, the response is streamed to the user as it's generated
+    # (the token usage isn't sent on streamed responses)
+    if stream_responses:
+        # A streamed response can't be superseded once it's shown, so it's claimed first
+        if claim and not claim():
+            return None, None
+        with span("openai.stream"):
+            content = stream_completion(chat_id, messages, model)
+        metadata = {"model": model}
+
+    # Otherwise, we wait for the complete response
+    else:
+        # Making an API request to the OpenAI API (hedged, if it's slower than usual)
+        res = hedged_request(
+            lambda model, timeout: openai.chat.completions.create(
+                model=model, messages=messages, timeout=timeout
+            ),
+            model,
+            hedge_model,
+            discard=charge and (lambda res: charge(res.usage.total_tokens)),
+        )
+        content = res.choices[0].message.content
+        metadata = {"model": res.model, "usage": res.usage.model_dump()}
+        record_usage(metadata["usage"])
+
+        # If a newer message arrived meanwhile, the response is dropped
+        if claim and not claim():
+            return None, metadata
+
+        # If desired, we can add the total tokens used on the request to the user
+        bot.send_message(
+            chat_id, content + f"\n\nTotal Tokens: {res.usage.total_tokens}"
+        )
+
+    # Saving the response to the cache, for identical requests
+    if use_cache:
+        set_cached_result(key, {"content": content})
+    return content, metadata
+
+
+# Function to stream a chat completion to the user with the async clients, like
+# stream_completion does
+async def stream_completion_async(chat_id, messages, model=model_engine):
+    # Sending a placeholder message right away, to be updated with the response
+    started = time.monotonic()
+    sent = await send_message_async(chat_id, "...")
+    stream = await async_openai.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        timeout=chat_deadline,
+    )
+
+    # Function to edit the current message
+    async def edit(text):
+        await telegram_request(
+            "editMessageText",
+            chat_id=chat_id,
+            message_id=sent["message_id"],
+            text=text,
+        )
+
+    # Response received so far, where the current message starts on it and what it shows
+    response = ""
+    offset = 0
+    shown = ""
+    last_edit = 0
+    try:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            response += delta
+
+            # If the current message is full, we finish it and continue on a new one
+            # (unless it already shows its full text, which Telegram wouldn't take as an edit)
+            while len(response) - offset > telegram_message_limit:
+                end = offset + telegram_message_limit
+                if response[offset:end] != shown:
+                    try:
+                        await edit(response[offset:end])
+                    # A failed edit only leaves this message short, so the reply goes on
+                    except Exception as e:
+                        print(f"Failed to finish the streamed message: {e}")
+                offset = end
+                shown = response[offset : offset + telegram_message_limit]
+                sent = await send_message_async(chat_id, shown)
+                last_edit = time.monotonic()
+
+            # Otherwise, we update the current message if the edit interval has passed
+            interval_passed = time.monotonic() - last_edit >= stream_edit_interval
+            if interval_passed and response[offset:] != shown:
+                if not shown:
+                    print(
+                        f"Time to first visible token: {time.monotonic() - started:.3f}s"
+                    )
+                shown = response[offset:]
+                last_edit = time.monotonic()
+                try:
+                    await edit(shown)
+                # A failed intermediate edit is fine, as the next one carries the full text
+                except Exception as e:
+                    print(f"Failed to edit the streamed message: {e}")
+
+    # The stream's connection is released even if the reply fails midway
+    finally:
+        await stream.response.aclose()
+
+    # Making sure the final text is shown
+    if response[offset:] != shown:
+        await edit(response[offset:] or "(empty response)")
+
+    # Returning the complete response
+    return response
+
+
+# Function to answer the conversation with the async clients, like reply_chat_completion
+# does (the cache and the charges, which may use the DynamoDB table, run on threads)
+async def reply_chat_completion_async(
+    chat_id, messages, use_cache=True, model=model_engine, claim=None, charge=None
+):
+    # Identical requests are answered from the cache
+    key = cache_key("chat", model=model, messages=messages)
+    cached = None
+    if use_cache:
+        cached = await asyncio.to_thread(get_cached_result, "chat", key)
+    if cached:
+        if claim and not claim():
+            return None, None
+        await send_message_async(chat_id, cached["content"])
+        return cached["content"], {"model": model, "cached": True}
+
+    # If enabled, the response is streamed to the user as it's generated
+    # (the token usage isn't sent on streamed responses)
+    if stream_responses:
+        # A streamed response can't be superseded once it's shown, so it's claimed first
+        if claim and not claim():
+            return None, None
+        with span("openai.stream"):
+            content = await stream_completion_async(chat_id, messages, model)
+        metadata = {"model": model}
+
+    # Otherwise, we wait for the complete response
+    else:
+        # Making an API request to the OpenAI API (hedged, if it's slower than usual)
+        res = await hedged_request_async(
+            lambda model, timeout: async_openai.chat.completions.create(
+                model=model, messages=messages, timeout=timeout
+            ),
+            model,
+            hedge_model,
+            discard=charge and (lambda res: charge(res.usage.total_tokens)),
+        )
+        content = res.choices[0].message.content
+        metadata = {"model": res.model, "usage": res.usage.model_dump()}
+        record_usage(metadata["usage"])
+
+        # If a newer message arrived meanwhile, the response is dropped
+        if claim and not claim():
+            return None, metadata
+
+        # If desired, we can add the total tokens used on the request to the user
+        await send_message_async(
+            chat_id, content + f"\n\nTotal Tokens: {res.usage.total_tokens}"
+        )
+
+    # Saving the response to the cache, for identical requests
+    if use_cache:
+        await asyncio.to_thread(set_cached_result, key, {"content": content})
+    return content, metadata
+
+
+# If write-behind is enabled, the buffered turns are saved periodically and on exit
+if write_behind:
+    threading.Thread(target=flush_dynamo_turns_periodically, daemon=True).start()
+    atexit.register(flush_dynamo_turns)
+
+
+# Function to start an image job of a chat, returning its ID (or None, if the chat already
+# has as many jobs running as allowed)
+def start_image_job(chat_id):
+    with image_jobs_lock:
+        jobs = image_jobs.setdefault(chat_id, set())
+        if len(jobs) >= image_jobs_per_chat:
+            return None
+        job_id = next(image_job_ids)
+        jobs.add(job_id)
+        return job_id
+
+
+# Function to check if an image job is still running (it wasn't cancelled)
+def is_image_job_active(chat_id, job_id):
+    with image_jobs_lock:
+        return job_id in image_jobs.get(chat_id, ())
+
+
+# Function to remove a finished image job
+def finish_image_job(chat_id, job_id):
+    with image_jobs_lock:
+        jobs = image_jobs.get(chat_id, set())
+        jobs.discard(job_id)
+        if not jobs:
+            image_jobs.pop(chat_id, None)
+
+
+# Function to cancel the image jobs of a chat, returning how many were running
+def cancel_image_jobs(chat_id):
+    with image_jobs_lock:
+        return len(image_jobs.pop(chat_id, ()))
+
+
+# Function to wait for the running image jobs, so their images are sent before stopping
+def wait_image_jobs():
+    with image_jobs_lock:
+        threads = list(image_job_threads)
+    if threads:
+        print(f"Waiting for {len(threads)} image job(s)...")
+    for thread in threads:
+        thread.join()
+
+
+# This function checks if the message was sent by the admin
+def is_admin_message(message):
+    return message.chat.id == int(config["ADMIN_CHAT_ID"])
+
+
+# This function checks if the message was sent by an allowed user (or on an allowed chat)
+def is_allowed_user(message):
+    ids = {str(message.chat.id), str(message.from_user and message.from_user.id)}
+    return (
+        is_admin_message(message) or "*" in allowed_users or bool(ids & allowed_users)
+    )
+
+
+# This function checks if the message is allowed, informing the user otherwise
+def is_allowed_message(message):
+    if is_allowed_user(message):
+        return True
+    bot.send_message(
+        message.chat.id, "Currently, you don't have access to this feature."
+    )
+    return False
+
+
+# This function checks if the message is allowed, informing the user otherwise with the
+# async HTTP client
+async def is_allowed_message_async(message):
+    if is_allowed_user(message):
+        return True
+    await send_message_async(
+        message.chat.id, "Currently, you don't have access to this feature."
+    )
+    return False
+
+
+# Function to get the current quota period (e.g. 20240131 for a daily quota)
+def get_quota_period():
+    period_format = "%Y%m" if token_quota_period == "monthly" else "%Y%m%d"
+    return int(time.strftime(period_format, time.gmtime()))
+
+
+# Function to get the user whose quota is charged for a message (None if there's no quota)
+def get_quota_user(message):
+    if not token_quota or is_admin_message(message):
+        return None
+    return message.from_user.id if message.from_user else message.chat.id
+
+
+# Function to get the tokens used by a user on the current period
+def get_quota_usage(user_id):
+    period = get_quota_period()
+    with quota_lock:
+        known = quota_usage.get(user_id)
+    if known and known[0] == period:
+        return known[1]
+
+    # The first request of the user (or period) reads the counter from the table
+    item = table.get_item(Key={"pk": f"quota#{user_id}", "sk": period}).get("Item", {})
+    tokens = int(item.get("tokens", 0))
+    with quota_lock:
+        known = quota_usage.get(user_id)
+        if known and known[0] == period:
+            tokens = max(tokens, known[1])
+        quota_usage[user_id] = (period, tokens)
+    return tokens
+
+
+# Function to check if a request of a message is admitted, given its estimated tokens
+# Returns the model to be used (the fallback one, if over the quota), or None if the request
+# was rejected (after informing the user)
+def admit_request(message, estimate, model=model_engine, fallback=True):
+    user_id = get_quota_user(message)
+    if user_id is None:
+        return model
+
+    used = get_quota_usage(user_id) + estimate
+    if used <= token_quota:
+        return model
+    if fallback and quota_fallback_model and used <= token_quota_hard:
+        return quota_fallback_model
+
+    period = "month" if token_quota_period == "monthly" else "day"
+    bot.send_message(
+        message.chat.id,
+        f"You've reached your quota of {token_quota} tokens for the {period}, please try again later.",
+    )
+    return None
+
+
+# Function to charge the tokens used by a request to the quota of a message's user
+# The counter is increased atomically on the table, which returns the updated total
+def charge_quota(message, tokens):
+    user_id = get_quota_user(message)
+    if user_id is None or not tokens:
+        return
+    period = get_quota_period()
+    try:
+        res = table.update_item(
+            Key={"pk": f"quota#{user_id}", "sk": period},
+            UpdateExpression="ADD tokens :tokens SET expires_at = :expires_at",
+            ExpressionAttributeValues={
+                ":tokens": tokens,
+                # The counters are kept for a while after their period
+                ":expires_at": int(time.time()) + 40 * 86400,
+            },
+            ReturnValues="UPDATED_NEW",
+        )
+    # The response was already sent, so a failed charge is only logged
+    except Exception as e:
+        print(f"Failed to charge {tokens} tokens to user {user_id}: {e}")
+        return
+    with quota_lock:
+        quota_usage[user_id] = (period, int(res["Attributes"]["tokens"]))
+
+
+# Function to get the tokens used by a request from its metadata (cached responses are free)
+# Streamed responses don't have the token usage, so it's estimated
+def get_used_tokens(metadata, estimate, content):
+    if metadata.get("cached"):
+        return 0
+    if "usage" in metadata:
+        return metadata["usage"]["total_tokens"]
+    return estimate + count_tokens(content or "")
+
+
+# Initial/welcome message handler
+@bot.message_handler(commands=["start"])
+@metered("start")
+def send_welcome(message):
+    bot.reply_to(
+        message,
+        f"Hello, {message.chat.first_name}, welcome to the personal ChatGPT Telegram Chatbot!",
+    )
+
+
+# Command to clear current conversation
+@bot.message_handler(commands=["clear"])
+@metered("clear")
+def clear_messages(message):
+    # Checking if it's an allowed message
+    if is_allowed_message(message):
+        # Clearing the current conversation
+        clear_dynamo_messages(message.chat.id)
+        bot.reply_to(message, "Conversation was cleared!")
+
+
+# Command to export the whole conversation, as a gzip-compressed JSONL file
+@bot.message_handler(commands=["export"])
+@metered("export")
+def export_messages(message):
+    # Checking if it's an allowed message
+    if is_allowed_message(message):
+        # Saving the buffered turns first, so they're exported as well
+        flush_dynamo_turns()
+        bot.send_document(
+            message.chat.id,
+            export_conversation(message.chat.id),
+            visible_file_name=f"conversation-{message.chat.id}.jsonl.gz",
+        )
+
+
+# Function to parse the options of an image request, which may start with the sizes of the
+# images (e.g. "1792x1024") and the number of variants of each size (e.g. "x3")
+# Returns the prompt and the (size, variant) of each image to generate
+def parse_image_request(text):
+    words = text.split()
+    sizes, variants = [], 1
+    while words:
+        if words[0] in image_sizes:
+            sizes.append(words.pop(0))
+        elif re.fullmatch(r"x[1-9]", words[0]):
+            variants = int(words.pop(0)[1:])
+        else:
+            break
+    images = [(size, i) for size in sizes or image_sizes[:1] for i in range(variants)]
+    return " ".join(words), images[:image_max_images]
+
+
+# Function to generate an image, returning its URL and the revised prompt (as a caption)
+# Identical prompts (and variants) are answered from the cache
+def generate_image(prompt, size, variant, use_cache):
+    params = {
+        "model": "dall-e-3",
+        "prompt": prompt,
+        "size": size,
+        "quality": "standard",
+        "n": 1,
+    }
+    key = cache_key("image", variant=variant, **params)
+    result = get_cached_result("image", key) if use_cache else None
+    if result is None:
+        # Requesting the image generation
+        response = openai.images.generate(**params)
+        result = {
+            "url": response.data[0].url,
+            "caption": response.data[0].revised_prompt,
+        }
+        if use_cache:
+            set_cached_result(key, result, image_cache_ttl)
+    return result
+
+
+# Function to run an image job, generating its images at the same time and sending them
+# to the chat (as an album, if there's more than one)
+# The upload_photo action (sent when the job was requested) is kept on while the images are
+# generated, and the results are dropped if the job is cancelled meanwhile
+# Jobs run on their own threads, so the polling goes on while the images are generated
+def run_image_job(chat_id, job_id, prompt, images, use_cache):
+    metrics_context.route = "image_job"
+    metrics_context.chat_id = chat_id
+    try:
+        futures = [
+            image_executor.submit(
+                in_metrics_context(generate_image), prompt, size, variant, use_cache
+            )
+            for size, variant in images
+        ]
+        done, pending = wait(futures, timeout=4)
+        while pending:
+            if not is_image_job_active(chat_id, job_id):
+                for future in pending:
+                    future.cancel()
+                return
+            # The chat action lasts for 5 seconds, or until a message is sent
+            bot.send_chat_action(chat_id, "upload_photo")
+            done, pending = wait(pending, timeout=4)
+        if not is_image_job_active(chat_id, job_id):
+            return
+
+        # Sending the generated images back to the user, and the errors of the failed ones
+        results, errors = [], []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if len(results) == 1:
+            bot.send_photo(
+                chat_id, photo=results[0]["url"], caption=results[0]["caption"]
+            )
+        elif results:
+            bot.send_media_group(
+                chat_id,
+                [
+                    telebot.types.InputMediaPhoto(r["url"], caption=r["caption"])
+                    for r in results
+                ],
+            )
+        if errors:
+            bot.send_message(
+                chat_id,
+                f"Error trying to generate {len(errors)} of the images: {errors[0]}",
+            )
+    # If something goes wrong, we'll inform about the error
+    except Exception as e:
+        bot.send_message(chat_id, f"Error trying to generate the image: {e}")
+    finally:
+        finish_image_job(chat_id, job_id)
+        with image_jobs_lock:
+            image_job_threads.discard(threading.current_thread())
+
+
+# Image generation request handler
+# The image job runs on its own thread, so the update is answered right away
+@bot.message_handler(commands=["image"])
+@metered("image")
+def request_image(message):
+    # Checking if it's an allowed message
+    if is_allowed_message(message):
+        chat_id = message.chat.id
+        # Getting the text from the message
+        text = message.text.strip()
+        # If no content was provided
+        if text == "/image":
+            bot.send_message(
+                chat_id,
+                "Please provide a prompt for the image generation.",
+            )
+            return
+
+        # We'll extract the prompt and the images options from the message text
+        prompt, use_cache = split_cache_opt_out(text.replace("/image", ""))
+        prompt, images = parse_image_request(prompt)
+
+        # If the content is too short
+        if len(prompt) < 10:
+            bot.send_message(chat_id, "Prompt is too short (min length: 10 chars).")
+            return
+
+        # If the chat has too many images being generated
+        job_id = start_image_job(chat_id)
+        if job_id is None:
+            bot.send_message(
+                chat_id,
+                f"Up to {image_jobs_per_chat} image requests may run at the same time,"
+                " please wait for them (or /cancel them).",
+            )
+            return
+
+        # If everything is ok, we'll generate the images and send them to the user
+        bot.send_chat_action(chat_id, "upload_photo")
+        thread = threading.Thread(
+            target=run_image_job,
+            args=(chat_id, job_id, prompt, images, use_cache),
+            daemon=True,
+        )
+        with image_jobs_lock:
+            image_job_threads.add(thread)
+        thread.start()
+
+
+# Command to cancel the image requests of the chat
+@bot.message_handler(commands=["cancel"])
+@metered("cancel")
+def cancel_images(message):
+    count = cancel_image_jobs(message.chat.id)
+    bot.send_message(
+        message.chat.id,
+        (
+            f"Cancelled {count} image request(s)."
+            if count
+            else "No image requests to cancel."
+        ),
+    )
+
+
+# Function to download a photo sent by the user, encoded as base64 (or None if it failed)
+def download_photo(photo):
+    # Processed photos are reused (e.g. when sent again, or re-attached on a later turn)
+    image = get_cached_image(photo.file_unique_id)
+    if image is not None:
+        return image
+
+    # Getting the image path
+    file_info = bot.get_file(photo.file_id)
+
+    # Creating the image URL for the photo
+    image_url = telebot.apihelper.FILE_URL.format(
+        config["BOT_TOKEN"], file_info.file_path
+    )
+
+    # Getting the image encoded as base64
+    downscale = max(photo.width, photo.height) > vision_max_side
+    with span("url_to_base64"):
+        image = url_to_base64(image_url, downscale)
+    if image is not None:
+        set_cached_image(photo.file_unique_id, image)
+    return image
+
+
+# Function to get the images of photos encoded as base64, downloading them at the same time
+def download_photos(photos):
+    if not photos:
+        return []
+    with ThreadPoolExecutor(max_workers=len(photos)) as executor:
+        return list(executor.map(in_metrics_context(download_photo), photos))
+
+
+# Function to download a photo with the async HTTP client, like download_photo
+# (the image cache, which may be on the disk, is used on a thread)
+async def download_photo_async(photo):
+    # Processed photos are reused (e.g. when sent again, or re-attached on a later turn)
+    image = await asyncio.to_thread(get_cached_image, photo.file_unique_id)
+    if image is not None:
+        return image
+
+    # Getting the image path
+    file_info = await telegram_request("getFile", file_id=photo.file_id)
+
+    # Creating the image URL for the photo
+    image_url = telebot.apihelper.FILE_URL.format(
+        config["BOT_TOKEN"], file_info["file_path"]
+    )
+
+    # Getting the image encoded as base64
+    downscale = max(photo.width, photo.height) > vision_max_side
+    with span("url_to_base64"):
+        image = await url_to_base64_async(image_url, downscale)
+    if image is not None:
+        await asyncio.to_thread(set_cached_image, photo.file_unique_id, image)
+    return image
+
+
+# Function to get the images of photos encoded as base64 with the async HTTP client,
+# downloading them at the same time
+async def download_photos_async(photos):
+    return list(await asyncio.gather(*map(download_photo_async, photos)))
+
+
+# Function to get the content of a message with images (encoded as base64) for the vision model
+def image_content(text, base64_images):
+    return [{"type": "text", "text": text}] + [
+        {
+            "type": "image_url",
+            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+        }
+        for base64_image in base64_images
+    ]
+
+
+# Function to request the vision model to answer a caption about one or more photos
+# The earlier messages of the context (which may have images of their own) go before it
+# Returns the response content and the request metadata (or None if it failed,
+# after informing the user), and a charge function, if given, gets the tokens of a hedged
+# response that wasn't used
+def request_visual_completion(chat_id, caption, photos, context=(), charge=None):
+    # Getting the images encoded as base64
+    base64_images = download_photos(photos)
+
+    # If some image was not returned
+    if None in base64_images:
+        bot.send_message(chat_id, "The image could not be retrieved.")
+        return None, None
+
+    # Defining the headers for the request
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config['OPENAI_API_KEY']}",
+    }
+
+    # Defining the payload for the visual input completion request
+    payload = {
+        "messages": list(context)
+        + [
+            # Including the message and the images sent by the user
+            {"role": "user", "content": image_content(caption, base64_images)}
+        ],
+        "max_tokens": 300,
+    }
+
+    # Function to make the request to the API, with the required model
+    def request(model, timeout):
+        res = http_session.post(
+            f"{openai_base_url}chat/completions",
+            headers=headers,
+            json={"model": model, **payload},
+            timeout=(http_connect_timeout, timeout),
+        )
+        res.raise_for_status()
+        return res.json()
+
+    # Making the request (hedged, if it's slower than usual)
+    try:
+        result = hedged_request(
+            request,
+            vision_model,
+            vision_hedge_model,
+            vision_deadline,
+            discard=charge and (lambda result: charge(result["usage"]["total_tokens"])),
+        )
+    # If an error occurs while requesting the API (or it took too long)
+    except Exception as e:
+        print(f"Vision request failed: {e}")
+        bot.send_message(chat_id, "There was an error while parsing the image.")
+        return None, None
+
+    # Returning the API response content and the request metadata
+    metadata = {"model": result["model"], "usage": result["usage"]}
+    record_usage(result["usage"])
+    return result["choices"][0]["message"]["content"], metadata
+
+
+# Function to request the vision model with the async clients, like
+# request_visual_completion does
+async def request_visual_completion_async(
+    chat_id, caption, photos, context=(), charge=None
+):
+    # Getting the images encoded as base64
+    base64_images = await download_photos_async(photos)
+
+    # If some image was not returned
+    if None in base64_images:
+        await send_message_async(chat_id, "The image could not be retrieved.")
+        return None, None
+
+    # Defining the headers for the request
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config['OPENAI_API_KEY']}",
+    }
+
+    # Defining the payload for the visual input completion request
+    payload = {
+        "messages": list(context)
+        + [
+            # Including the message and the images sent by the user
+            {"role": "user", "content": image_content(caption, base64_images)}
+        ],
+        "max_tokens": 300,
+    }
+
+    # Function to make the request to the API, with the required model
+    async def request(model, timeout):
+        res = await async_http.post(
+            f"{openai_base_url}chat/completions",
+            headers=headers,
+            json={"model": model, **payload},
+            timeout=httpx.Timeout(timeout, connect=http_connect_timeout),
+        )
+        res.raise_for_status()
+        return res.json()
 
-    # Returning resulting dict
-    return dynamo_messages
+    # Making the request (hedged, if it's slower than usual)
+    try:
+        result = await hedged_request_async(
+            request,
+            vision_model,
+            vision_hedge_model,
+            vision_deadline,
+            discard=charge and (lambda result: charge(result["usage"]["total_tokens"])),
+        )
+    # If an error occurs while requesting the API (or it took too long)
+    except Exception as e:
+        print(f"Vision request failed: {e}")
+        await send_message_async(chat_id, "There was an error while parsing the image.")
+        return None, None
 
+    # Returning the API response content and the request metadata
+    metadata = {"model": result["model"], "usage": result["usage"]}
+    record_usage(result["usage"])
+    return result["choices"][0]["message"]["content"], metadata
 
-# Function to update the messages list on DynamoDB table
-def update_dynamo_messages(message):
-    # Initializing DynamoDB instance and getting table
-    dynamodb = session.resource("dynamodb", region_name=config["AWS_REGION"])
-    table = dynamodb.Table(config["AWS_DYNAMODB"])
 
-    # Getting the required item with the list of messages to be updated
-    res = table.get_item(Key={"field": "messages"})
-    item = res["Item"]
+# Function to get the messages of the history on the context (after the pinned ones), and
+# the indexes of the ones recent enough to have their photos re-attached
+def get_recent_image_messages(history, context):
+    pinned = sum(1 for m in context if m["role"] == "system")
+    offset = len(history) - (len(context) - pinned)
+    first = len(history) - 1 - 2 * image_followup_turns
+    indexes = [
+        i for i in range(max(offset, first), len(history)) if history[i].get("images")
+    ]
+    return pinned, offset, indexes
 
-    # Appending the new message to the list
-    # Must be formatted as one of the following:
-    # {"role": "user", "content": "Text content'}
-    # {"role": "assistant", "content": "Text content'}
-    item["messages"].append(message)
 
-    # Updating item in the table
-    table.put_item(Item=item)
+# Function to get the photos of the recent messages on the context, to be re-attached
+def get_recent_photos(history, context):
+    _, _, indexes = get_recent_image_messages(history, context)
+    return [
+        telebot.types.PhotoSize.de_json(image)
+        for i in indexes
+        for image in history[i]["images"]
+    ]
 
 
-# Function to clear previous saved messages on DynamoDB table
-def clear_dynamo_messages():
-    # Initializing DynamoDB instance and getting table
-    dynamodb = session.resource("dynamodb", region_name=config["AWS_REGION"])
-    table = dynamodb.Table(config["AWS_DYNAMODB"])
+# Function to attach the images of the recent photos (encoded as base64, in the same order)
+# to their messages on the context
+def attach_images(history, context, base64_images):
+    pinned, offset, indexes = get_recent_image_messages(history, context)
+    context = list(context)
+    for i in indexes:
+        count = len(history[i]["images"])
+        message = context[pinned + i - offset]
+        context[pinned + i - offset] = {
+            "role": message["role"],
+            "content": image_content(message["content"], base64_images[:count]),
+        }
+        base64_images = base64_images[count:]
+    return context
 
-    # Getting the required item with the list of messages to be updated
-    res = table.get_item(Key={"field": "messages"})
-    item = res["Item"]
 
-    # Clearing the list of items
-    item["messages"] = []
+# Function to re-attach the photos of the recent turns to their messages on the context, so
+# a follow-up message about them is answered by the vision model (the photos are usually
+# still on the image cache, so no other download is needed)
+# Returns the context with the images, or None if no recent message on it has photos
+def attach_recent_images(history, context):
+    # Getting the images of every message at once
+    photos = get_recent_photos(history, context)
+    if not photos:
+        return None
+    base64_images = download_photos(photos)
+    if None in base64_images:
+        print("The images of the recent turns could not be retrieved")
+        return None
+    return attach_images(history, context, base64_images)
 
-    # Updating item in the table
-    table.put_item(Item=item)
 
-    # Clearing the local messages list
-    global messages
-    messages = []
+# Function to re-attach the photos of the recent turns with the async HTTP client, like
+# attach_recent_images does
+async def attach_recent_images_async(history, context):
+    # Getting the images of every message at once
+    photos = get_recent_photos(history, context)
+    if not photos:
+        return None
+    base64_images = await download_photos_async(photos)
+    if None in base64_images:
+        print("The images of the recent turns could not be retrieved")
+        return None
+    return attach_images(history, context, base64_images)
 
 
-# Initializing the messages queue to be used during the conversation
-messages = get_dynamodb_messages()
+# Function to answer a follow-up message about the photos of the recent turns, whose context
+# has them re-attached, with the vision model
+# Returns the response content and the request metadata (the response is None if it wasn't
+# sent, e.g. if a newer message superseded it)
+def reply_image_followup(message, context, claim=None):
+    # Checking if the user's quota admits the request (the vision model has no fallback)
+    estimate = estimate_request_tokens({"messages": context}) + 300
+    if admit_request(message, estimate, fallback=False) is None:
+        return None, None
 
+    content, metadata = request_visual_completion(
+        message.chat.id,
+        context[-1]["content"],
+        [],
+        context[:-1],
+        charge=lambda tokens: charge_quota(message, tokens),
+    )
+    if content is None:
+        return None, None
+    charge_quota(message, get_used_tokens(metadata, estimate, content))
 
-# This function checks if the message was sent by the admin
-def is_admin_message(message):
-    # Comparing the user ID and the defined admin chat ID
-    if message.chat.id != int(config["ADMIN_CHAT_ID"]):
-        bot.send_message(
-            message.chat.id, "Currently, only the admin has access to this feature."
-        )
-        return False
-    return True
+    # If a newer message arrived meanwhile, the response is dropped
+    if claim and not claim():
+        return None, metadata
+    bot.send_message(message.chat.id, content)
+    return content, metadata
 
 
-# Initial/welcome message handler
-@bot.message_handler(commands=["start"])
-def send_welcome(message):
-    bot.reply_to(
-        message,
-        f"Hello, {message.chat.first_name}, welcome to the personal ChatGPT Telegram Chatbot!",
+# Function to answer a follow-up message about the photos of the recent turns with the
+# async clients, like reply_image_followup does
+async def reply_image_followup_async(message, context, claim=None):
+    # Checking if the user's quota admits the request (the vision model has no fallback)
+    estimate = estimate_request_tokens({"messages": context}) + 300
+    admitted = await asyncio.to_thread(admit_request, message, estimate, fallback=False)
+    if admitted is None:
+        return None, None
+
+    content, metadata = await request_visual_completion_async(
+        message.chat.id,
+        context[-1]["content"],
+        [],
+        context[:-1],
+        charge=lambda tokens: charge_quota(message, tokens),
     )
+    if content is None:
+        return None, None
+    tokens = get_used_tokens(metadata, estimate, content)
+    await asyncio.to_thread(charge_quota, message, tokens)
 
+    # If a newer message arrived meanwhile, the response is dropped
+    if claim and not claim():
+        return None, metadata
+    await send_message_async(message.chat.id, content)
+    return content, metadata
 
-# Command to clear current conversation
-@bot.message_handler(commands=["clear"])
-def clear_messages(message):
-    # Checking if it's an admin message
-    if is_admin_message(message):
-        # Clearing the current conversation
-        clear_dynamo_messages()
-        bot.reply_to(message, "Conversation was cleared!")
 
+# Function to add a photo to its album, which is due to be answered once no other photo
+# arrived for the album window
+def collect_album(message):
+    with albums_lock:
+        album = albums.setdefault(message.media_group_id, {"messages": []})
+        album["messages"].append(message)
+        album["deadline"] = time.monotonic() + album_window
 
-# Image generation request handler (future feature)
-@bot.message_handler(commands=["image"])
-# Image generation request handler (future feature)
-def request_image(message):
-    # Checking if it's an admin message
-    if is_admin_message(message):
-        # Getting the text from the message
-        text = message.text.strip()
-        # If no content was provided
-        if text == "/image":
-            bot.send_message(
-                message.chat.id,
-                "Please provide a prompt for the image generation.",
-            )
-        # If a prompt was provided
-        else:
-            # We'll extract the prompt from the message text
-            prompt = text.replace("/image", "")
 
-            # If the content is too short
-            if len(prompt) < 10:
-                bot.send_message(
-                    message.chat.id, "Prompt is too short (min length: 10 chars)."
-                )
+# Function to take the photos of an album, once all of them arrived (None if there are none)
+def take_album(media_group_id):
+    with albums_lock:
+        album = albums.pop(media_group_id, None)
+    if album is None:
+        return None
+    return sorted(album["messages"], key=lambda m: m.message_id)
+
+
+# Function to answer the photos of an album, once all of them arrived
+def answer_album(media_group_id):
+    messages = take_album(media_group_id)
+    if messages is None:
+        return
+    metrics_context.route = "photo"
+    metrics_context.chat_id = messages[0].chat.id
+    with span("total"):
+        answer_photos(messages)
 
-            # If everything is ok, we'll try to generate the image and return to the user
-            else:
-                try:
-                    # Requesting the image generation
-                    response = openai.images.generate(
-                        model="dall-e-3",
-                        prompt=prompt,
-                        size="1024x1024",
-                        quality="standard",
-                        n=1,
-                    )
-                    # Getting the image URL
-                    image_url = response.data[0].url
-                    # Getting the revised prompt to be sent as a caption
-                    caption = response.data[0].revised_prompt
-                    # Send the generated image back to the user
-                    bot.send_photo(
-                        message.chat.id,
-                        photo=image_url,
-                        caption=caption,
-                    )
-                # If something goes wrong, we'll inform about the error
-                except Exception as e:
-                    bot.send_message(
-                        message.chat.id,
-                        f"Error trying to generate the image: {e}",
-                    )
+
+# Function to answer the photos of an album with the async clients
+async def answer_album_async(media_group_id):
+    messages = take_album(media_group_id)
+    if messages is None:
+        return
+    metrics_context.route = "photo"
+    metrics_context.chat_id = messages[0].chat.id
+    with span("total"):
+        await answer_photos_async(messages)
 
 
 # Visual input messages handler
+# The photos of an album are answered together, once all of them arrived
 @bot.message_handler(func=lambda msg: True, content_types=["photo"])
+@metered("photo")
 def visual_input(message):
+    if not is_allowed_message(message):
+        return
+    if message.media_group_id:
+        collect_album(message)
+    else:
+        answer_photos([message])
+
+
+# Visual input messages handler of the async runtime
+@metered("photo")
+async def visual_input_async(message):
+    if not await is_allowed_message_async(message):
+        return
+    if message.media_group_id:
+        collect_album(message)
+    else:
+        await answer_photos_async([message])
+
+
+# Function to save a conversation turn on the chat's conversation
+def save_turn(chat_id, user_message, bot_message, metadata=None):
+    conversation = get_conversation(chat_id)
+    queue_dynamo_turn(chat_id, conversation, user_message, bot_message, metadata)
+
+
+# Function to answer the caption of one or more photos (e.g. an album) with the vision model
+def answer_photos(messages):
+    chat_id = messages[0].chat.id
     try:
-        # Checking if a image caption was provided
-        if message.caption is None:
+        # Checking if a image caption was provided (on an album, only a photo has it)
+        captions = [m.caption for m in messages if m.caption]
+        if not captions:
             bot.send_message(
-                message.chat.id,
+                chat_id,
                 'Please, provide some context for the image as captions, e.g.: "What this image represents?"',
             )
             return
 
-        # Getting the image path
-        file_info = bot.get_file(message.photo[-1].file_id)
-
-        # Creating the image URL for the photo
-        image_url = f"https://api.telegram.org/file/bot{config['BOT_TOKEN']}/{file_info.file_path}"
+        # Checking if the cache should be skipped for this request
+        caption, use_cache = split_cache_opt_out(captions[0])
 
-        # Getting the image encoded as base64
-        base64_image = url_to_base64(image_url)
+        # Selecting the photo sizes to be sent to the model
+        photos = [select_photo_size(m.photo) for m in messages]
 
-        # If no image was returned
-        if base64_image is None:
-            bot.send_message(message.chat.id, "The image could not be retrieved.")
+        # Checking if the user's quota admits the request (the vision model has no fallback)
+        estimate = count_tokens(caption) + len(photos) * 765 + 300
+        if admit_request(messages[0], estimate, fallback=False) is None:
             return
 
-        # Defining the headers for the request
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {config['OPENAI_API_KEY']}",
-        }
+        # The same caption on the same photos is answered from the cache
+        key = cache_key(
+            "vision",
+            model=vision_model,
+            caption=caption,
+            photo=[photo.file_unique_id for photo in photos],
+            max_tokens=300,
+        )
+        cached = get_cached_result("vision", key) if use_cache else None
+        if cached:
+            content = cached["content"]
+            metadata = {"model": vision_model, "cached": True}
+        else:
+            content, metadata = request_visual_completion(
+                chat_id,
+                caption,
+                photos,
+                charge=lambda tokens: charge_quota(messages[0], tokens),
+            )
+            if content is None:
+                return
+            charge_quota(messages[0], get_used_tokens(metadata, estimate, content))
+            if use_cache:
+                set_cached_result(key, {"content": content})
 
-        # Defining the payload for the visual input completion request
-        payload = {
-            # Defining the required model for the request
-            "model": "gpt-4-vision-preview",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        # Including the message sent by the user
-                        {"type": "text", "text": message.caption},
-                        # Including the image sent by the user
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            "max_tokens": 300,
+        # Replying with the API response contet
+        bot.send_message(chat_id, content)
+
+        # Defining user message for the conversation (referencing its photos)
+        user_message = {
+            "role": "user",
+            "content": caption,
+            "images": [photo_reference(photo) for photo in photos],
         }
+        # Defining bot response for the conversation
+        bot_message = {
+            "role": "assistant",
+            "content": content,
+        }
+        # Adding the newly received and generated messages to the conversation in order to provide to the chatbot
+        # Both messages are saved with a single request
+        save_turn(chat_id, user_message, bot_message, metadata)
 
-        # Making the request to the API
-        res = requests.post(
-            "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+    # If something goes wrong
+    except Exception as e:
+        bot.send_message(
+            chat_id,
+            f"There was an error while processing your request: {e}",
         )
 
-        # If an error occurs while requesting the API
-        if res.status_code != 200:
-            bot.send_message(
-                message.chat.id, "There was an error while parsing the image."
+
+# Function to answer the caption of one or more photos with the async clients, like
+# answer_photos does (the quota, the cache and the conversation, which may use the
+# DynamoDB table, are used on threads)
+async def answer_photos_async(messages):
+    chat_id = messages[0].chat.id
+    try:
+        # Checking if a image caption was provided (on an album, only a photo has it)
+        captions = [m.caption for m in messages if m.caption]
+        if not captions:
+            await send_message_async(
+                chat_id,
+                'Please, provide some context for the image as captions, e.g.: "What this image represents?"',
             )
             return
 
-        # Replying with the API response contet
-        bot.send_message(
-            message.chat.id, res.json()["choices"][0]["message"]["content"]
+        # Checking if the cache should be skipped for this request
+        caption, use_cache = split_cache_opt_out(captions[0])
+
+        # Selecting the photo sizes to be sent to the model
+        photos = [select_photo_size(m.photo) for m in messages]
+
+        # Checking if the user's quota admits the request (the vision model has no fallback)
+        estimate = count_tokens(caption) + len(photos) * 765 + 300
+        admitted = await asyncio.to_thread(
+            admit_request, messages[0], estimate, fallback=False
+        )
+        if admitted is None:
+            return
+
+        # The same caption on the same photos is answered from the cache
+        key = cache_key(
+            "vision",
+            model=vision_model,
+            caption=caption,
+            photo=[photo.file_unique_id for photo in photos],
+            max_tokens=300,
         )
+        cached = None
+        if use_cache:
+            cached = await asyncio.to_thread(get_cached_result, "vision", key)
+        if cached:
+            content = cached["content"]
+            metadata = {"model": vision_model, "cached": True}
+        else:
+            content, metadata = await request_visual_completion_async(
+                chat_id,
+                caption,
+                photos,
+                charge=lambda tokens: charge_quota(messages[0], tokens),
+            )
+            if content is None:
+                return
+            tokens = get_used_tokens(metadata, estimate, content)
+            await asyncio.to_thread(charge_quota, messages[0], tokens)
+            if use_cache:
+                await asyncio.to_thread(set_cached_result, key, {"content": content})
 
-        # Defining user message for the conversation
+        # Replying with the API response content
+        await send_message_async(chat_id, content)
+
+        # Saving both messages on the conversation (the user one referencing its photos)
         user_message = {
             "role": "user",
-            "content": message.caption,
+            "content": caption,
+            "images": [photo_reference(photo) for photo in photos],
         }
-        # Defining bot response for the conversation
         bot_message = {
             "role": "assistant",
-            "content": res.json()["choices"][0]["message"]["content"],
+            "content": content,
         }
-        # Adding the newly received and generated messages to the list in order to provide to the chatbot
-        messages.append(user_message)
-        messages.append(bot_message)
-        # Updating the DynamoDB table
-        update_dynamo_messages(user_message)
-        update_dynamo_messages(bot_message)
+        await asyncio.to_thread(save_turn, chat_id, user_message, bot_message, metadata)
 
     # If something goes wrong
     except Exception as e:
-        bot.send_message(
-            message.chat.id, f"There was an error while processing your request: {e}"
+        await send_message_async(
+            chat_id,
+            f"There was an error while processing your request: {e}",
         )
 
 
 # General messages handler
+# If enabled, the messages sent in a quick succession are answered together
 @bot.message_handler(func=lambda msg: True)
+@metered("text")
 def echo_all(message):
-    # Checking if it's an admin message
-    if is_admin_message(message):
-        # Defining user message for the conversation
-        user_message = {
-            "role": "user",
-            "content": message.text,
-        }
-        # Adding the newly received message to the messages list in order to provide to the chatbot
-        messages.append(user_message)
-        # Updating on the DynamoDB table
-        update_dynamo_messages(user_message)
+    # Checking if it's an allowed message
+    if is_allowed_message(message):
+        if coalesce_window:
+            collect_fragment(message)
+        else:
+            answer_text(message, message.text)
+
+
+# General messages handler of the async runtime
+@metered("text")
+async def echo_all_async(message):
+    # Checking if it's an allowed message
+    if await is_allowed_message_async(message):
+        if coalesce_window:
+            collect_fragment(message)
+        else:
+            await answer_text_async(message, message.text)
+
+
+# Function to add a text message to its chat's buffer, which is due to be answered once no
+# other message arrived for the coalesce window
+def collect_fragment(message):
+    with fragments_lock:
+        entry = fragments.setdefault(message.chat.id, {"messages": [], "generation": 0})
+        entry["messages"].append(message)
+        entry["generation"] += 1
+        entry["deadline"] = time.monotonic() + coalesce_window
+
+
+# Function to get the text messages buffered for a chat, along with the function claiming
+# them (None if there are none)
+# They're only removed from the buffer once claimed: if a newer message arrives meanwhile
+# (on the "sync" runtime, where the updates of a chat may run at the same time), the answer
+# is dropped, and they're answered along with the newer message
+def get_fragments(chat_id):
+    with fragments_lock:
+        entry = fragments.get(chat_id)
+        if entry is None:
+            return None
+        messages = sorted(entry["messages"], key=lambda m: m.message_id)
+        generation = entry["generation"]
+
+    # Function to claim the buffered messages, if no newer one arrived
+    def claim():
+        with fragments_lock:
+            if fragments.get(chat_id) is not entry or entry["generation"] != generation:
+                print(f"Messages of chat {chat_id} were superseded")
+                return False
+            fragments.pop(chat_id)
+        return True
+
+    return messages, claim
+
+
+# Function to answer the text messages buffered for a chat
+def answer_fragments(chat_id):
+    buffered = get_fragments(chat_id)
+    if buffered is None:
+        return
+    messages, claim = buffered
+    metrics_context.route = "text"
+    metrics_context.chat_id = chat_id
+    with span("total"):
+        answer_text(messages[-1], "\n".join(m.text for m in messages), claim)
+
+
+# Function to answer the text messages buffered for a chat with the async clients
+async def answer_fragments_async(chat_id):
+    buffered = get_fragments(chat_id)
+    if buffered is None:
+        return
+    messages, claim = buffered
+    metrics_context.route = "text"
+    metrics_context.chat_id = chat_id
+    with span("total"):
+        text = "\n".join(m.text for m in messages)
+        await answer_text_async(messages[-1], text, claim)
+
+
+# Function to get the buffer collecting the message of an update, if any: its album, or its
+# chat's text messages (if they're coalesced)
+def get_update_buffer(update):
+    message = update.get("message") or {}
+    if "photo" in message and message.get("media_group_id"):
+        return ("album", message["media_group_id"])
+    if coalesce_window and not message.get("text", "/").startswith("/"):
+        return ("text", message["chat"]["id"])
+    return None
+
+
+# Function to get the buffered messages of a kind ("album" or "text"), and their lock
+def get_buffers(kind):
+    return (albums, albums_lock) if kind == "album" else (fragments, fragments_lock)
+
+
+# Function to get when the messages of a buffer are due to be answered (None if there are
+# none, e.g. if the message wasn't allowed)
+def get_buffer_deadline(buffer):
+    entries, lock = get_buffers(buffer[0])
+    with lock:
+        return entries.get(buffer[1], {}).get("deadline")
+
+
+# Function to answer the messages of a buffer
+def answer_buffer(buffer):
+    kind, key = buffer
+    try:
+        if kind == "album":
+            answer_album(key)
+        else:
+            answer_fragments(key)
+    except Exception as e:
+        print(f"An error occurred while answering the buffered messages: {e}")
+
+
+# Function to answer the messages of a buffer with the async clients
+async def answer_buffer_async(buffer):
+    kind, key = buffer
+    try:
+        if kind == "album":
+            await answer_album_async(key)
+        else:
+            await answer_fragments_async(key)
+    except Exception as e:
+        print(f"An error occurred while answering the buffered messages: {e}")
+
+
+# Function to drop the messages of a buffer, without answering them
+def drop_buffer(buffer):
+    entries, lock = get_buffers(buffer[0])
+    with lock:
+        entries.pop(buffer[1], None)
+
+
+# Function to take the buffers whose messages are due to be answered (or all of them), so
+# they're only answered once
+def take_due_buffers(everything=False):
+    now = time.monotonic()
+    due = []
+    for kind in ("album", "text"):
+        entries, lock = get_buffers(kind)
+        with lock:
+            for key, entry in entries.items():
+                deadline = entry.get("deadline")
+                if deadline is not None and (everything or deadline <= now):
+                    entry["deadline"] = None
+                    due.append((kind, key))
+    return due
+
+
+# Function to answer a text (one or more messages, joined) on the conversation of the chat
+def answer_text(message, text, claim=None):
+    # Checking if the cache should be skipped for this message
+    text, use_cache = split_cache_opt_out(text)
+
+    # Defining user message for the conversation
+    user_message = {
+        "role": "user",
+        "content": text,
+    }
+    # Getting the conversation with the newly received message, and keeping the messages
+    # that fit the token budget in order to provide to the chatbot
+    conversation, history, context = get_text_context(message.chat.id, user_message)
 
-        # Making an API request to the chatbot
-        res = openai.chat.completions.create(
-            model=model_engine,
-            messages=messages,
+    # If the recent turns have photos, they're re-attached for the vision model
+    attached = None
+    if image_followup_turns:
+        attached = attach_recent_images(history, context)
+    if attached:
+        content, metadata = reply_image_followup(message, attached, claim)
+    else:
+        # Checking if the user's quota admits the request (or which model answers it)
+        estimate = estimate_request_tokens({"messages": context})
+        model = admit_request(message, estimate)
+        if model is None:
+            return
+
+        # Sending the response back to the user (unless a newer message superseded it,
+        # and the reply was dropped)
+        content, metadata = reply_chat_completion(
+            message.chat.id,
+            context,
+            use_cache,
+            model,
+            claim,
+            charge=lambda tokens: charge_quota(message, tokens),
         )
+        if metadata:
+            charge_quota(message, get_used_tokens(metadata, estimate, content))
+    if content is None:
+        return
 
-        # Defining the response to be sent to the user
-        user_response = res.choices[0].message.content
-        # If desired, we can add the total tokens used on the request to the user
-        user_response += f"\n\nTotal Tokens: {res.usage.total_tokens}"
+    # Defining bot response for the conversation
+    bot_message = {
+        "role": "assistant",
+        "content": content,
+    }
+    # Finally, the whole turn is saved on the conversation and the DynamoDB table
+    # This will be used to update the conversation context
+    queue_dynamo_turn(
+        message.chat.id, conversation, user_message, bot_message, metadata
+    )
 
-        # Sending message back to the user
-        bot.send_message(message.chat.id, user_response)
 
-        # Defining bot response for the conversation
-        bot_message = {
-            "role": "assistant",
-            "content": res.choices[0].message.content,
-        }
-        # We'll also append the bot response to the messages list and DynamoDB table
-        # This will be used to update the conversation context
-        messages.append(bot_message)
-        update_dynamo_messages(bot_message)
+# Function to get the conversation of a chat with a new user message, and the context
+# (the messages that fit the token budget, and the recalled turns) to be sent to the model
+def get_text_context(chat_id, user_message):
+    conversation = get_conversation(chat_id)
+    history = conversation["messages"] + [user_message]
+    context = get_conversation_context(chat_id, history, conversation)
+    # Recalling the earlier turns related to the message, if any
+    if long_term_memory:
+        context = add_recalled_turns(chat_id, conversation, history, context)
+    return conversation, history, context
+
+
+# Function to answer a text with the async clients, like answer_text does
+# The conversation, the quota and the turn, which use the DynamoDB table (and the summary
+# and memory models, if enabled), are handled on threads
+async def answer_text_async(message, text, claim=None):
+    # Checking if the cache should be skipped for this message
+    text, use_cache = split_cache_opt_out(text)
+
+    # Getting the conversation with the newly received message, and its context
+    user_message = {
+        "role": "user",
+        "content": text,
+    }
+    conversation, history, context = await asyncio.to_thread(
+        get_text_context, message.chat.id, user_message
+    )
+
+    # If the recent turns have photos, they're re-attached for the vision model
+    attached = None
+    if image_followup_turns:
+        attached = await attach_recent_images_async(history, context)
+    if attached:
+        content, metadata = await reply_image_followup_async(message, attached, claim)
+    else:
+        # Checking if the user's quota admits the request (or which model answers it)
+        estimate = estimate_request_tokens({"messages": context})
+        model = await asyncio.to_thread(admit_request, message, estimate)
+        if model is None:
+            return
+
+        # Sending the response back to the user (unless a newer message superseded it,
+        # and the reply was dropped)
+        content, metadata = await reply_chat_completion_async(
+            message.chat.id,
+            context,
+            use_cache,
+            model,
+            claim,
+            charge=lambda tokens: charge_quota(message, tokens),
+        )
+        if metadata:
+            tokens = get_used_tokens(metadata, estimate, content)
+            await asyncio.to_thread(charge_quota, message, tokens)
+    if content is None:
+        return
+
+    # Finally, the whole turn is saved on the conversation and the DynamoDB table
+    bot_message = {
+        "role": "assistant",
+        "content": content,
+    }
+    await asyncio.to_thread(
+        queue_dynamo_turn,
+        message.chat.id,
+        conversation,
+        user_message,
+        bot_message,
+        metadata,
+    )
+
+
+# Function to get the recorded metrics in the Prometheus text format
+def get_prometheus_metrics():
+    lines = [
+        "# HELP chatbot_stage_seconds Latency of each stage of the updates.",
+        "# TYPE chatbot_stage_seconds histogram",
+    ]
+    with metrics_lock:
+        for (stage, route), entry in sorted(stage_metrics.items()):
+            labels = f'stage="{stage}",route="{route}"'
+            count = 0
+            for bound, bucket_count in zip(metrics_buckets + ("+Inf",), entry):
+                count += bucket_count
+                lines.append(
+                    f'chatbot_stage_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                )
+            lines.append(f"chatbot_stage_seconds_sum{{{labels}}} {entry[-1]:.6f}")
+            lines.append(f"chatbot_stage_seconds_count{{{labels}}} {count}")
+        lines += [
+            "# HELP chatbot_tokens_total Tokens used by the chat model requests.",
+            "# TYPE chatbot_tokens_total counter",
+        ]
+        for (route, kind), tokens in sorted(token_metrics.items()):
+            lines.append(
+                f'chatbot_tokens_total{{route="{route}",kind="{kind}"}} {tokens}'
+            )
+    lines += [
+        "# HELP chatbot_http_retries_total Retries made by the HTTP session.",
+        "# TYPE chatbot_http_retries_total counter",
+        f"chatbot_http_retries_total {http_retry_count}",
+        "# HELP chatbot_openai_hedges_total Hedge requests sent to OpenAI, and the ones that won.",
+        "# TYPE chatbot_openai_hedges_total counter",
+        f'chatbot_openai_hedges_total{{result="sent"}} {hedge_stats["sent"]}',
+        f'chatbot_openai_hedges_total{{result="won"}} {hedge_stats["won"]}',
+        "# HELP chatbot_cache_requests_total Results cache lookups.",
+        "# TYPE chatbot_cache_requests_total counter",
+    ]
+    for route, stats in sorted(cache_stats.items()):
+        for result in ("hits", "misses"):
+            lines.append(
+                f'chatbot_cache_requests_total{{route="{route}",result="{result}"}} {stats[result]}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+# Prometheus metrics endpoint, served on a background thread
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = get_prometheus_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Function to start the Prometheus metrics endpoint
+# (each worker process serves its own metrics, on the next ports)
+def start_metrics_server(shard=None):
+    port = metrics_port if shard is None else metrics_port + shard + 1
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving the metrics on port {port}")
+
+
+# Function to get the chat ID of an update, used to keep each chat's updates in order
+def get_update_chat_id(update):
+    for value in update.values():
+        if isinstance(value, dict):
+            # Messages and posts have the chat, callback queries have it on their message
+            chat = value.get("chat") or value.get("message", {}).get("chat")
+            if chat:
+                return chat["id"]
+    return None
+
+
+# Function to get the trace record of an update, scrubbed of any private content: the chat
+# and album IDs are hashed, and only the length of the texts (and the photo sizes) is kept
+def trace_record(update):
+    salt = trace_salt or config["BOT_TOKEN"]
+
+    def scrub(value):
+        return hashlib.sha256(f"{salt}:{value}".encode()).hexdigest()[:12]
+
+    message = update.get("message") or {}
+    chat = message.get("chat") or {}
+    record = {
+        "ts": int(time.time() * 1000),
+        "chat": scrub(chat.get("id")),
+        "type": chat.get("type"),
+    }
+    text = message.get("text")
+    if text is not None:
+        # Only the command itself is kept (e.g. "/image"), along with the length of the rest
+        if text.startswith("/"):
+            command, _, text = text.partition(" ")
+            command = command.split("@")[0]
+            record["command"] = command if command in trace_commands else "/other"
+        record["text"] = len(text)
+    if "photo" in message:
+        record["photo"] = [[p["width"], p["height"]] for p in message["photo"]]
+        record["caption"] = len(message.get("caption") or "")
+        if message.get("media_group_id"):
+            record["group"] = scrub(message["media_group_id"])
+    return record
+
+
+# Function to append the received updates to the trace file, if set
+def record_updates(updates):
+    if not trace_file or not updates:
+        return
+    lines = "".join(
+        json.dumps(trace_record(update), separators=(",", ":")) + "\n"
+        for update in updates
+    )
+    try:
+        with trace_lock, open(trace_file, "a") as f:
+            f.write(lines)
+    except OSError as e:
+        print(f"Failed to record the updates: {e}")
+
+
+# Function to process an update on the async runtime
+# The text messages and the photos are answered with the async clients, and the commands
+# (and any other update) by the blocking handlers, on a thread
+async def process_update(update):
+    update = telebot.types.Update.de_json(update)
+    message = update.message
+    commands = {
+        command
+        for handler in bot.message_handlers
+        for command in handler["filters"].get("commands") or ()
+    }
+    if message is not None and message.content_type == "photo":
+        await visual_input_async(message)
+    elif (
+        message is not None
+        and message.content_type == "text"
+        and telebot.util.extract_command(message.text) not in commands
+    ):
+        await echo_all_async(message)
+    else:
+        await asyncio.to_thread(bot.process_new_updates, [update])
+
+
+# Function to process the queued updates of a single chat, one at a time
+# Each update is claimed once processed, and reported to the finish function
+# The updates waiting when the bot started (the backlog) may have been processed before a
+# crash or restart, so they're skipped if they were claimed already
+# The messages buffered by the updates (the photos of an album, or the texts sent in a quick
+# succession) are answered once they're due, or before the chat's next update that doesn't
+# add to them (so e.g. a /clear never runs before their answer), and their updates are
+# only claimed and reported once they're answered
+async def process_chat_updates(chat_id, chats, running, finish, in_backlog):
+    queue = chats[chat_id]
+    buffer = None
+    buffered = []
+
+    # Function to check if an update was processed before the bot started
+    async def is_processed(update_id):
+        return in_backlog(update_id) and await asyncio.to_thread(
+            is_update_claimed, update_id
+        )
+
+    while True:
+        # Waiting for the next update, until the buffered messages are due
+        update = None
+        try:
+            if buffer is None:
+                update = await queue.get()
+            else:
+                timeout = (get_buffer_deadline(buffer) or 0) - time.monotonic()
+                update = await asyncio.wait_for(queue.get(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+        # Answering the buffered messages, unless the update adds to them
+        if buffer is not None and (
+            update is None or get_update_buffer(update) != buffer
+        ):
+            async with running:
+                try:
+                    processed = [
+                        await is_processed(update_id) for update_id in buffered
+                    ]
+                    if all(processed):
+                        print(f"Skipping duplicate updates {buffered}")
+                        drop_buffer(buffer)
+                    else:
+                        await answer_buffer_async(buffer)
+                        for update_id in buffered:
+                            await asyncio.to_thread(claim_update, update_id)
+                except Exception as e:
+                    print(f"An error occurred while processing updates {buffered}: {e}")
+            for update_id in buffered:
+                finish(update_id)
+            buffer, buffered = None, []
+
+        if update is not None:
+            update_id = update["update_id"]
+            buffer = get_update_buffer(update)
+            try:
+                async with running:
+                    # Buffered messages are only checked and claimed once answered
+                    if buffer is None and await is_processed(update_id):
+                        print(f"Skipping duplicate update {update_id}")
+                    else:
+                        await process_update(update)
+                        if buffer is None:
+                            await asyncio.to_thread(claim_update, update_id)
+            except Exception as e:
+                print(f"An error occurred while processing update {update_id}: {e}")
+            if buffer is None:
+                finish(update_id)
+            else:
+                buffered.append(update_id)
+
+        # When the chat has no more updates (nor buffered messages), its worker is finished
+        if buffer is None and queue.empty():
+            del chats[chat_id]
+            return
+
+
+# Function to poll the updates and process many chats concurrently
+# The updates of each chat are still processed in the order they were received
+# The offset confirmed to Telegram never goes past the oldest update not yet processed, so
+# the updates still queued (or being processed) are received again after a crash or restart
+async def poll_updates():
+    global async_http, async_openai
+
+    # Queues with the updates of each chat and the bounds for the in-flight work
+    chats = {}
+    workers = set()
+    running = asyncio.Semaphore(max_concurrent_updates)
+    pending = asyncio.Semaphore(max_pending_updates)
+
+    # IDs of the updates received but not yet processed, and the next ID to be received
+    unprocessed = set()
+    next_offset = None
+    processed = asyncio.Event()
+
+    # ID following the updates waiting when the bot started (known once they're received)
+    backlog_end = None
+
+    # Function to check if an update was waiting when the bot started
+    def in_backlog(update_id):
+        return backlog_end is None or update_id < backlog_end
+
+    # Function to report a processed update, leaving room for another one
+    def finish(update_id):
+        unprocessed.discard(update_id)
+        pending.release()
+        processed.set()
+
+    # Stopping gracefully on interruption or termination signals
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    # The blocking handlers and calls (e.g. the commands, and the DynamoDB ones) run on as
+    # many threads as the updates allowed at the same time (the default executor may have
+    # fewer, e.g. only 5 on a single CPU)
+    loop.set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=max_concurrent_updates, thread_name_prefix="update"
+        )
+    )
+
+    # The text messages and the photos are answered with the async clients
+    async_http = MeteredAsyncClient(
+        timeout=httpx.Timeout(http_timeout, connect=http_connect_timeout),
+        limits=httpx.Limits(max_keepalive_connections=http_pool_size),
+    )
+    async_openai = openai.AsyncOpenAI(
+        api_key=config["OPENAI_API_KEY"],
+        base_url=openai_base_url,
+        http_client=async_http,
+        max_retries=0,
+        timeout=http_timeout,
+    )
+
+    url = telebot.apihelper.API_URL.format(config["BOT_TOKEN"], "getUpdates")
+    async with async_http, httpx.AsyncClient(timeout=40) as client:
+        while not stopping.is_set():
+            # Long polling the updates, unless we're asked to stop while waiting
+            # While updates are being processed, they're received again right away along
+            # with the new ones, so the request doesn't wait
+            processed.clear()
+            offset = min(unprocessed, default=next_offset)
+            params = {"offset": offset, "timeout": 0 if unprocessed else 30}
+            request = asyncio.create_task(client.get(url, params=params))
+            stop = asyncio.create_task(stopping.wait())
+            await asyncio.wait({request, stop}, return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            if stopping.is_set():
+                request.cancel()
+                break
+            try:
+                updates = request.result().json()["result"]
+            except Exception as e:
+                print(f"Failed to get updates: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            # The backlog is received once a poll doesn't return as many updates as it can
+            if backlog_end is None and len(updates) < 100:
+                backlog_end = updates[-1]["update_id"] + 1 if updates else 0
+
+            # Skipping the updates already received
+            if next_offset is not None:
+                updates = [u for u in updates if u["update_id"] >= next_offset]
+            record_updates(updates)
+
+            # Without new updates, polling again once an update is processed (or after the
+            # polling interval)
+            if not updates and unprocessed:
+                try:
+                    await asyncio.wait_for(processed.wait(), polling_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for update in updates:
+                next_offset = update["update_id"] + 1
+                # Waiting for room when too many updates are pending
+                await pending.acquire()
+                unprocessed.add(update["update_id"])
+                chat_id = get_update_chat_id(update)
+                if chat_id not in chats:
+                    chats[chat_id] = asyncio.Queue()
+                    worker = asyncio.create_task(
+                        process_chat_updates(
+                            chat_id, chats, running, finish, in_backlog
+                        )
+                    )
+                    workers.add(worker)
+                    worker.add_done_callback(workers.discard)
+                chats[chat_id].put_nowait(update)
+
+        # Draining the pending updates before leaving
+        print("Stopping, waiting for the pending updates...")
+        await asyncio.gather(*workers)
+        await asyncio.to_thread(wait_image_jobs)
+        flush_dynamo_turns()
+
+        # Confirming the processed updates, so they're not received again
+        if next_offset is not None:
+            await client.get(url, params={"offset": next_offset, "timeout": 0})
+
+
+# Function to claim an update before processing it, so it's processed only once
+# The updates not yet saved as processed are dispatched again after a restart, so only
+# the first dispatch gets the claim (expired claims are removed by the table's TTL)
+def claim_update(update_id):
+    try:
+        table.put_item(
+            Item={
+                "pk": f"update#{update_id}",
+                "sk": 0,
+                "expires_at": int(time.time()) + update_claim_ttl,
+            },
+            ConditionExpression="attribute_not_exists(pk)",
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+# Function to check if an update was already claimed (e.g. processed before a restart)
+def is_update_claimed(update_id):
+    item = table.get_item(
+        Key={"pk": f"update#{update_id}", "sk": 0}, ConsistentRead=True
+    ).get("Item")
+    return item is not None
+
+
+# Function to process the updates dispatched to a worker process (a shard of the chats)
+# Each processed update ID is reported back to the poller
+# The messages buffered by the updates are answered once they're due, or before the chat's
+# next update that doesn't add to them, and only then are their updates reported
+def run_shard_worker(shard, updates, done):
+    # The poller takes care of the signals, stopping the workers once they're drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if metrics_enabled and metrics_port:
+        start_metrics_server(shard)
+
+    # Buffered messages of each chat, along with the IDs of their updates
+    buffers = {}
+
+    # Function to answer the buffered messages of a chat, reporting their updates
+    # Their updates are claimed together, so messages already answered before a restart
+    # are dropped instead
+    def answer_buffered(chat_id):
+        buffer, update_ids = buffers.pop(chat_id)
+        try:
+            if any([claim_update(update_id) for update_id in update_ids]):
+                answer_buffer(buffer)
+            else:
+                print(f"Skipping duplicate updates {update_ids}")
+                drop_buffer(buffer)
+        except Exception as e:
+            print(f"An error occurred while processing updates {update_ids}: {e}")
+        for update_id in update_ids:
+            done.put(update_id)
+
+    while True:
+        # Waiting for the next update, until the first buffered messages are due
+        timeout = None
+        if buffers:
+            deadlines = [get_buffer_deadline(b) or 0 for b, _ in buffers.values()]
+            timeout = max(min(deadlines) - time.monotonic(), 0)
+        try:
+            update = updates.get(timeout=timeout)
+        except queue.Empty:
+            update = {}
+        if update is None:
+            break
+        chat_id = get_update_chat_id(update) if update else None
+        buffer = get_update_buffer(update) if update else None
+
+        # Answering the buffered messages that are due, and the chat's ones unless the
+        # update adds to them
+        now = time.monotonic()
+        for buffered_chat_id, (buffered, _) in list(buffers.items()):
+            due = (get_buffer_deadline(buffered) or 0) <= now
+            if due or (buffered_chat_id == chat_id and buffered != buffer):
+                answer_buffered(buffered_chat_id)
+        if not update:
+            continue
+
+        try:
+            # Skipping the update if it was already processed before a restart
+            # (buffered messages are only claimed once answered)
+            if buffer is None and not claim_update(update["update_id"]):
+                print(f"Skipping duplicate update {update['update_id']}")
+            else:
+                bot.process_new_updates([telebot.types.Update.de_json(update)])
+        except Exception as e:
+            print(
+                f"An error occurred while processing update {update['update_id']}: {e}"
+            )
+        if buffer is None:
+            done.put(update["update_id"])
+        else:
+            buffers.setdefault(chat_id, (buffer, []))[1].append(update["update_id"])
+
+    # Answering the buffered messages before leaving
+    for chat_id in list(buffers):
+        answer_buffered(chat_id)
+    wait_image_jobs()
+    flush_dynamo_turns()
+
+
+# Function to load the polling offset and the updates not yet processed
+def load_polling_state():
+    try:
+        with open(polling_state_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"offset": None, "pending": []}
+
+
+# Function to save the polling offset and the updates not yet processed
+# The file is written to disk and then replaced at once, so a crash never leaves it half
+# written (nor replaced by an empty file)
+def save_polling_state(offset, pending):
+    with open(polling_state_file + ".tmp", "w") as f:
+        json.dump(
+            {
+                "offset": offset,
+                "pending": sorted(pending.values(), key=lambda u: u["update_id"]),
+            },
+            f,
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(polling_state_file + ".tmp", polling_state_file)
+
+
+# Function to poll the updates and dispatch them to the worker processes, sharded by chat
+# The updates of a chat always go to the same worker, so they keep their order
+def poll_updates_to_workers():
+    # Starting the worker processes, each one with a bounded queue
+    context = multiprocessing.get_context("spawn")
+    done = context.Queue()
+    shards = [context.Queue(shard_queue_size) for _ in range(worker_processes)]
+    workers = [
+        context.Process(target=run_shard_worker, args=(shard, shards[shard], done))
+        for shard in range(worker_processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # The fetched updates are saved before being confirmed to Telegram (on the next
+    # request), and only removed once processed, so a restart resumes from them
+    state = load_polling_state()
+    offset = state["offset"]
+    pending = {update["update_id"]: update for update in state["pending"]}
+    pending_lock = threading.Lock()
+    shed = 0
+
+    # Function to receive the processed update IDs from the workers
+    # The state is saved at most once a second, with every ID received meanwhile (the
+    # updates processed but not yet saved are skipped by their claims after a restart)
+    def receive_done():
+        while True:
+            update_ids = [done.get()]
+            deadline = time.monotonic() + 1
+            while update_ids[-1] is not None:
+                try:
+                    timeout = max(deadline - time.monotonic(), 0)
+                    update_ids.append(done.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with pending_lock:
+                for update_id in update_ids:
+                    pending.pop(update_id, None)
+                save_polling_state(offset, pending)
+            if update_ids[-1] is None:
+                return
+
+    receiver = threading.Thread(target=receive_done)
+    receiver.start()
+
+    # Function to answer a shed update with a busy message
+    def send_busy_message(chat_id):
+        try:
+            bot.send_message(
+                chat_id, "The bot is busy right now, please try again in a moment."
+            )
+        except Exception as e:
+            print(f"Failed to send the busy message: {e}")
+
+    # The busy messages are sent on their own thread, so the rate limits don't hold
+    # the polling back
+    busy_messages = ThreadPoolExecutor(max_workers=1, thread_name_prefix="busy")
+
+    # Function to send an update to its worker, or to answer it with a busy message
+    # if the worker has too many updates queued (load shedding)
+    def dispatch(update):
+        nonlocal shed
+        chat_id = get_update_chat_id(update)
+        try:
+            shards[hash(chat_id) % worker_processes].put_nowait(update)
+        except queue.Full:
+            shed += 1
+            print(f"Shedding update {update['update_id']} ({shed} so far)")
+            busy_messages.submit(send_busy_message, chat_id)
+            with pending_lock:
+                pending.pop(update["update_id"], None)
+
+    # Resuming the updates left from the previous run
+    for update_id in sorted(pending):
+        dispatch(pending[update_id])
+
+    # Stopping gracefully on interruption or termination signals
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: stopping.set())
+
+    url = telebot.apihelper.API_URL.format(config["BOT_TOKEN"], "getUpdates")
+    while not stopping.is_set():
+        # Waiting for room when too many updates are pending
+        with pending_lock:
+            full = len(pending) >= max_pending_updates
+        if full:
+            time.sleep(0.1)
+            continue
+
+        # Long polling the updates (for a short while, so stopping isn't delayed)
+        try:
+            updates = http_session.get(
+                url, params={"offset": offset, "timeout": 10}
+            ).json()["result"]
+        except Exception as e:
+            print(f"Failed to get updates: {e}")
+            time.sleep(1)
+            continue
+        if not updates:
+            continue
+        record_updates(updates)
+
+        # Saving the updates before they're confirmed, then dispatching them
+        with pending_lock:
+            offset = updates[-1]["update_id"] + 1
+            pending.update((update["update_id"], update) for update in updates)
+            save_polling_state(offset, pending)
+        for update in updates:
+            dispatch(update)
+
+    # Draining the queued updates before leaving
+    print("Stopping, waiting for the pending updates...")
+    for shard in shards:
+        shard.put(None)
+    for worker in workers:
+        worker.join()
+    done.put(None)
+    receiver.join()
+    busy_messages.shutdown()
+
+    # Confirming the processed updates, so they're not received again
+    if offset is not None:
+        http_session.get(url, params={"offset": offset, "timeout": 0})
+
+
+# Function to poll the updates with telebot's own threads (the "sync" runtime)
+# There are no chat workers here, so the buffered messages are answered on their own
+# threads once they're due (and before stopping)
+def poll_updates_sync():
+    # The updates are only seen as messages by the handlers here
+    bot.set_update_listener(
+        lambda messages: record_updates([{"message": m.json} for m in messages])
+    )
+    answers = ThreadPoolExecutor(
+        max_workers=max_concurrent_updates, thread_name_prefix="buffer"
+    )
+    stopping = threading.Event()
+
+    # Function to answer the buffered messages once they're due
+    def answer_due_buffers():
+        while not stopping.wait(0.05):
+            for buffer in take_due_buffers():
+                answers.submit(answer_buffer, buffer)
+
+    answerer = threading.Thread(target=answer_due_buffers)
+    answerer.start()
+
+    # Stopping gracefully on interruption or termination signals (once the current long
+    # polling request is over)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: bot.stop_polling())
+    bot.infinity_polling()
+
+    # Answering the buffered messages before leaving
+    print("Stopping, waiting for the buffered messages...")
+    stopping.set()
+    answerer.join()
+    for buffer in take_due_buffers(everything=True):
+        answers.submit(answer_buffer, buffer)
+    answers.shutdown()
+    wait_image_jobs()
 
 
 # Here we can poll messages to test the chat locally
-bot.infinity_polling()
+# The module may also be imported (e.g. by the benchmark) without polling
+if __name__ == "__main__":
+    if metrics_enabled and metrics_port:
+        start_metrics_server()
+    if polling_mode == "async":
+        asyncio.run(poll_updates())
+    elif polling_mode == "processes":
+        poll_updates_to_workers()
+    else:
+        poll_updates_sync()
@@ -1,113 +1,2277 @@
 # Function dependencies
+# The heavy SDKs (telebot, openai, boto3 and requests) are imported only on first use,
+# so the cold start doesn't pay for the ones the update doesn't need
 import json
 import os
-import telebot
-import openai
+import hashlib
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 import logging
-import boto3
 import base64
-import requests
+import io
+import random
+import re
+import time
 
 # Setting up the loggers
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initializing the Bot
-bot = telebot.TeleBot(os.environ["BOT_TOKEN"])
+# Setting the model engines for OpenAI (chat and vision)
+model_engine = os.environ.get("CHAT_MODEL", "gpt-3.5-turbo-1106")
+vision_model = os.environ.get("VISION_MODEL", "gpt-4-vision-preview")
 
-# Setting the API Key and model engine for OpenAI
-openai.api_key = os.environ["OPENAI_API_KEY"]
-model_engine = "gpt-3.5-turbo-1106"
+# Deadline (in seconds) of the chat and vision requests, including their hedges
+chat_deadline = float(os.environ.get("CHAT_DEADLINE", "30"))
+vision_deadline = float(os.environ.get("VISION_DEADLINE", "45"))
+# If a request wasn't answered by this percentile of its model's recent latencies (0 disables
+# it), a hedge request is sent to the hedge model (or to the same one), and the first
+# response is used
+hedge_percentile = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+hedge_model = os.environ.get("HEDGE_MODEL")
+vision_hedge_model = os.environ.get("VISION_HEDGE_MODEL")
+# Latencies recorded for a model before its requests are hedged, and the minimum delay
+# (in seconds) before a hedge
+hedge_min_samples = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+hedge_min_delay = float(os.environ.get("HEDGE_MIN_DELAY", "0.5"))
+
+# Recent latencies of each model (model: latencies), and the hedges sent and won
+model_latencies = {}
+latencies_lock = threading.Lock()
+hedge_stats = Counter()
+# Threads running the (possibly hedged) model requests
+model_executor = ThreadPoolExecutor(max_workers=8)
+
+# Minimum side (in pixels) of the photos sent to the vision model, and the maximum one
+# Larger photos are downscaled (the model itself scales them down to these sizes)
+vision_min_side = int(os.environ.get("VISION_MIN_SIDE", "768"))
+vision_max_side = int(os.environ.get("VISION_MAX_SIDE", "2048"))
+# Maximum size (in bytes) of a downloaded photo
+vision_max_bytes = int(os.environ.get("VISION_MAX_BYTES", "5242880"))
+# Byte budget of the processed photos kept in memory (by their Telegram file_unique_id), and
+# the directory and byte budget of the on-disk tier (kept by warm containers, empty disables it)
+image_cache_bytes = int(os.environ.get("IMAGE_CACHE_BYTES", "33554432"))
+image_cache_dir = os.environ.get("IMAGE_CACHE_DIR", "/tmp/images")
+image_cache_disk_bytes = int(os.environ.get("IMAGE_CACHE_DISK_BYTES", "268435456"))
+# Number of recent turns whose photos are re-attached to the text messages that follow them,
+# which are then answered by the vision model (disabled by default, with 0)
+image_followup_turns = int(os.environ.get("IMAGE_FOLLOWUP_TURNS", "0"))
+
+# Processed photos kept in memory (file unique ID: base64 image), from the least recently
+# used, and the bytes they take (the ones on the disk are only counted once needed)
+image_cache = OrderedDict()
+image_cache_lock = threading.Lock()
+image_cache_used = 0
+image_disk_used = None
+# The photos of an album arrive as separate updates (sharing a media_group_id), so they're
+# buffered until none arrived for this long (in seconds), and answered with a single request
+album_window = float(os.environ.get("ALBUM_WINDOW", "1.5"))
+# If set, the text messages of a chat are also buffered until none arrived for this long
+# (in seconds), so the ones sent in a quick succession are answered together (0 disables it)
+coalesce_window = float(os.environ.get("COALESCE_WINDOW", "0"))
+
+# Maximum number of results kept on the in-process cache, and for how long (in seconds)
+cache_size = int(os.environ.get("CACHE_SIZE", "256"))
+cache_ttl = int(os.environ.get("CACHE_TTL", "3600"))
+# Generated image URLs expire after a while, so they're kept for less time
+image_cache_ttl = int(os.environ.get("IMAGE_CACHE_TTL", "1800"))
+# If enabled, results are also cached on the DynamoDB table (shared by every instance)
+cache_dynamodb = os.environ.get("CACHE_DYNAMODB", "false").lower() == "true"
+# Tag that may be added to a message to skip the cache for it
+cache_opt_out_tag = "#nocache"
+
+# Sizes accepted by the image generation, and the maximum number of images of a request
+# (each size and variant is generated at the same time, and they're sent as an album)
+image_sizes = ("1024x1024", "1792x1024", "1024x1792")
+image_max_images = min(int(os.environ.get("IMAGE_MAX_IMAGES", "4")), 10)
+# Maximum number of image jobs running at the same time on each chat, and for how long
+# (in seconds) a job may run before it stops counting against the limit
+image_jobs_per_chat = int(os.environ.get("IMAGE_JOBS_PER_CHAT", "2"))
+image_job_timeout = int(os.environ.get("IMAGE_JOB_TIMEOUT", "300"))
+
+# Users (or chats) allowed to use the bot besides the admin, as comma-separated IDs
+# ("*" allows everyone)
+allowed_users = {
+    user.strip()
+    for user in os.environ.get("ALLOWED_USERS", "").split(",")
+    if user.strip()
+}
+# Tokens each user (other than the admin) may use per period ("daily" or "monthly")
+# Over it, requests are downgraded to the fallback model (if set) until the hard quota,
+# which defaults to twice the quota, and rejected from then on (0 disables the quotas)
+token_quota = int(os.environ.get("TOKEN_QUOTA", "0"))
+token_quota_period = os.environ.get("TOKEN_QUOTA_PERIOD", "daily")
+token_quota_hard = int(os.environ.get("TOKEN_QUOTA_HARD", "0")) or 2 * token_quota
+quota_fallback_model = os.environ.get("QUOTA_FALLBACK_MODEL")
+
+# Tokens used by each user on the current period, as last known (user ID: (period, tokens))
+# It's updated by every charge, so the table is only read on the first request of a user
+quota_usage = {}
+quota_lock = threading.Lock()
+
+# In-process results cache (key: (expiration, result)), from the least recently used
+results_cache = OrderedDict()
+cache_lock = threading.Lock()
+# Cache hits and misses, per route
+cache_stats = {}
+
+# Connection pool size (per host), retries and timeouts (in seconds) of the outbound HTTP calls
+http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+http_retries = int(os.environ.get("HTTP_RETRIES", "3"))
+http_backoff = float(os.environ.get("HTTP_BACKOFF", "0.5"))
+http_connect_timeout = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+http_timeout = float(os.environ.get("HTTP_TIMEOUT", "60"))
+
+# Webhook mode: "inline" processes each update on the webhook request, while "queue"
+# only enqueues it (on an SQS FIFO queue), to be processed by the worker handler
+webhook_mode = os.environ.get("WEBHOOK_MODE", "inline")
+# Optional secret token set for the webhook, sent by Telegram on every request
+webhook_secret = os.environ.get("WEBHOOK_SECRET")
+
+# For how long (in seconds) a processed update is remembered, to skip its redeliveries
+# Telegram keeps the undelivered updates for up to 24 hours
+update_claim_ttl = int(os.environ.get("UPDATE_CLAIM_TTL", "86400"))
+
+# Whether the latency of each stage (e.g. an external call) and the token usage are recorded
+metrics_enabled = os.environ.get("METRICS", "true").lower() == "true"
+# Namespace of the metrics on CloudWatch
+metrics_namespace = os.environ.get("METRICS_NAMESPACE", "ChatGPTTelegramBot")
+
+# Route and chat of the update being processed, along with its recorded stages and token usage
+metrics_context = {}
+# Hedged request running on the current thread (its stages aren't recorded once another
+# request was used, as its update may be over)
+hedged_attempt = threading.local()
+
+# If enabled, every update is also logged as a compact trace record (with the IDs hashed and
+# only the length of the texts), which replay.py may replay on the local stand-ins
+trace_updates = os.environ.get("TRACE_UPDATES", "false").lower() == "true"
+# Salt of the hashed IDs on the trace records (the bot token, if not set)
+trace_salt = os.environ.get("TRACE_SALT")
+# Commands kept on the trace records (any other one is recorded as "/other")
+trace_commands = ("/start", "/clear", "/export", "/image", "/cancel")
+
+# Outbound rate limits, enforced by token buckets before each call (if enabled)
+# Telegram: messages per second (overall and per chat) and per minute (per group)
+rate_limits = os.environ.get("RATE_LIMITS", "true").lower() == "true"
+telegram_rate = float(os.environ.get("TELEGRAM_RATE", "30"))
+telegram_chat_rate = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+telegram_group_rate = float(os.environ.get("TELEGRAM_GROUP_RATE", "20"))
+telegram_chat_burst = int(os.environ.get("TELEGRAM_CHAT_BURST", "3"))
+# OpenAI: requests, tokens and images per minute (updated from the rate limit headers)
+openai_rpm = float(os.environ.get("OPENAI_RPM", "500"))
+openai_tpm = float(os.environ.get("OPENAI_TPM", "60000"))
+openai_ipm = float(os.environ.get("OPENAI_IPM", "5"))
+
+# Base URL of the OpenAI API (another OpenAI compatible server may be used)
+openai_base_url = os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com/v1/"
+
+# Clients created on first use, and reused across warm invocations
+http_session = None
+bot = None
+openai_client = None
+table = None
+sqs = None
+s3 = None
+lambda_client = None
+
+# Number of retries made by the HTTP session
+http_retry_count = 0
+
+
+# Function to start recording the metrics of an update
+def start_metrics(route, chat_id):
+    metrics_context.clear()
+    if metrics_enabled:
+        metrics_context.update(
+            route=route,
+            chat_id=chat_id,
+            spans={},
+            tokens=Counter(),
+            started=time.perf_counter(),
+            retries=http_retry_count,
+            hedges=hedge_stats["sent"],
+        )
+
+
+# Function to record the duration of a stage of the current update
+def record_span(stage, seconds):
+    finished = getattr(hedged_attempt, "finished", None)
+    if metrics_context and not (finished and finished.is_set()):
+        metrics_context["spans"].setdefault(stage, []).append(round(seconds * 1000, 3))
+
+
+# Function to record the token usage of a chat model request
+def record_usage(usage):
+    if metrics_context and usage:
+        for kind in ("prompt", "completion", "total"):
+            metrics_context["tokens"][f"{kind.capitalize()}Tokens"] += usage.get(
+                f"{kind}_tokens", 0
+            )
+
+
+# Function to log the metrics of the current update in the CloudWatch Embedded Metric Format
+# The document is printed as is, since the log lines must be plain JSON to be parsed
+def flush_metrics():
+    if not metrics_context:
+        return
+    record_span("total", time.perf_counter() - metrics_context["started"])
+    values = {
+        **metrics_context["spans"],
+        **metrics_context["tokens"],
+        "HttpRetries": http_retry_count - metrics_context["retries"],
+        "OpenAIHedges": hedge_stats["sent"] - metrics_context["hedges"],
+    }
+    units = {name: "Milliseconds" for name in metrics_context["spans"]}
+    document = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": metrics_namespace,
+                    "Dimensions": [["Route"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": units.get(name, "Count")}
+                        for name in values
+                    ],
+                }
+            ],
+        },
+        "Route": metrics_context["route"],
+        "ChatId": metrics_context["chat_id"],
+        **values,
+    }
+    print(json.dumps(document))
+    metrics_context.clear()
+
+
+# Function to get the stage name of an outbound HTTP call, from its service and method
+# (e.g. "telegram.sendMessage", "telegram.download" or "openai.chat.completions")
+def get_http_stage(url):
+    path = urlsplit(url).path
+    if path.startswith("/file/bot"):
+        return "telegram.download"
+    if path.startswith("/bot"):
+        return "telegram." + path.rsplit("/", 1)[-1]
+    if url.startswith(openai_base_url):
+        parts = url[len(openai_base_url) :].split("?")[0].split("/")
+        return "openai." + (parts[0] if parts[0] == "models" else ".".join(parts))
+    return "http." + urlsplit(url).hostname
+
+
+# Functions timing the AWS calls (DynamoDB and SQS), through the botocore events
+def start_aws_span(context, **kwargs):
+    context["span_start"] = time.perf_counter()
+
+
+def end_aws_span(context, model, **kwargs):
+    if "span_start" in context:
+        record_span(
+            f"{model.service_model.endpoint_prefix}.{model.name}",
+            time.perf_counter() - context["span_start"],
+        )
+
+
+# Function to time the calls made by an AWS client
+def meter_aws_client(client):
+    if metrics_enabled:
+        client.meta.events.register("before-call", start_aws_span)
+        client.meta.events.register("after-call", end_aws_span)
+
+
+# Context manager timing a stage of the current update
+@contextmanager
+def span(stage):
+    if not metrics_enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+
+# Stages sent on the background lane (e.g. image generation), which must leave part of
+# the buckets to the interactive ones, so short replies aren't queued behind them
+background_stages = {
+    "openai.images.generations",
+    "telegram.sendPhoto",
+    "telegram.sendMediaGroup",
+    "telegram.sendChatAction",
+}
+background_headroom = 0.5
+
+
+# Token bucket pacing the calls to a service, whose rate adapts to its rate limit responses
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = self.max_rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Function to wait until the amount is available, taking it from the bucket
+    def acquire(self, amount=1, background=False):
+        amount = min(amount, self.burst)
+        needed = min(self.burst, amount + background * self.burst * background_headroom)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= needed:
+                        self.tokens -= amount
+                        return
+                    wait = (needed - self.tokens) / self.rate
+            time.sleep(min(wait, 1))
+
+    # Function to pause the bucket after a rate limited call, halving its rate
+    def penalize(self, retry_after):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    # Function to speed the bucket back up after a successful call
+    def recover(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+    # Function to update the bucket from the limit reported by the service (per minute),
+    # what's left of it and when it's reset (in seconds), keeping 10 seconds of burst
+    def update_limit(self, limit, remaining, reset):
+        with self.lock:
+            self.max_rate = limit / 60
+            self.rate = min(self.rate, self.max_rate)
+            self.burst = max(1, limit / 6)
+            self.tokens = min(self.tokens, self.burst, remaining)
+            if remaining <= 0:
+                self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+
+# Buckets of each service, with up to 10 seconds of burst for the per minute limits
+rate_buckets = {
+    "telegram": TokenBucket(telegram_rate, telegram_rate),
+    "openai.requests": TokenBucket(openai_rpm / 60, openai_rpm / 6),
+    "openai.tokens": TokenBucket(openai_tpm / 60, openai_tpm / 6),
+    "openai.images": TokenBucket(openai_ipm / 60, openai_ipm / 6),
+}
+# Buckets of each chat, from the least recently used
+chat_buckets = OrderedDict()
+chat_buckets_lock = threading.Lock()
+
+# Pattern of the images sent as data URLs, which aren't counted by their size
+image_data_pattern = re.compile(rb'"data:image/[^"]*"')
+
+
+# Function to get the bucket of a chat (groups and channels have a per minute limit)
+def get_chat_bucket(chat_id):
+    with chat_buckets_lock:
+        bucket = chat_buckets.get(chat_id)
+        if bucket is None:
+            group = str(chat_id).startswith(("-", "@"))
+            rate = telegram_group_rate / 60 if group else telegram_chat_rate
+            bucket = chat_buckets[chat_id] = TokenBucket(rate, telegram_chat_burst)
+            while len(chat_buckets) > 10000:
+                chat_buckets.popitem(last=False)
+        chat_buckets.move_to_end(chat_id)
+        return bucket
+
+
+# Function to estimate the tokens of a chat model request from its body
+# Each image counts as a high detail one, plus a typical completion
+def estimate_request_tokens(body):
+    if not isinstance(body, bytes):
+        body = json.dumps(body or "").encode()
+    body, images = image_data_pattern.subn(b'""', body)
+    return len(body) // 4 + images * 765 + 256
+
+
+# Function to get the buckets (and the amount taken from each one) of an outbound call
+def get_rate_buckets(stage, kwargs):
+    if stage.startswith("telegram.") and stage not in (
+        "telegram.getUpdates",
+        "telegram.download",
+    ):
+        buckets = [(rate_buckets["telegram"], 1)]
+        chat_id = (kwargs.get("params") or {}).get("chat_id")
+        if chat_id is not None:
+            buckets.append((get_chat_bucket(chat_id), 1))
+        return buckets
+    if stage.startswith("openai."):
+        buckets = [(rate_buckets["openai.requests"], 1)]
+        if stage == "openai.chat.completions":
+            body = kwargs.get("data") or kwargs.get("json")
+            buckets.append(
+                (rate_buckets["openai.tokens"], estimate_request_tokens(body))
+            )
+        elif stage == "openai.images.generations":
+            buckets.append((rate_buckets["openai.images"], 1))
+        return buckets
+    return []
+
+
+# Function to wait for the rate limits of an outbound call
+def wait_rate_limits(stage, kwargs):
+    if rate_limits:
+        background = stage in background_stages
+        for bucket, amount in get_rate_buckets(stage, kwargs):
+            bucket.acquire(amount, background)
+
+
+# Function to parse the durations of the OpenAI rate limit headers (e.g. "6m0s" or "20ms")
+def parse_duration(value):
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(amount) * units[unit]
+        for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value or "")
+    )
+
+
+# Function to adapt the buckets of an outbound call to its response
+# Returns whether the call was rate limited (429), so it can be sent again
+# (the 429 responses are retried even when the rate limits aren't enforced)
+def update_rate_limits(stage, kwargs, response):
+    global http_retry_count
+
+    # OpenAI reports its limits (and what's left of them) on every response
+    headers = response.headers
+    if rate_limits:
+        for kind in ("requests", "tokens"):
+            if f"x-ratelimit-limit-{kind}" in headers:
+                rate_buckets[f"openai.{kind}"].update_limit(
+                    float(headers[f"x-ratelimit-limit-{kind}"]),
+                    float(headers.get(f"x-ratelimit-remaining-{kind}", 1)),
+                    parse_duration(headers.get(f"x-ratelimit-reset-{kind}")),
+                )
+
+    buckets = []
+    if rate_limits:
+        buckets = [bucket for bucket, amount in get_rate_buckets(stage, kwargs)]
+    if response.status_code != 429:
+        for bucket in buckets:
+            bucket.recover()
+        return False
+
+    # Telegram sends the time to wait on the response body, OpenAI on the headers
+    retry_after = headers.get("Retry-After")
+    if retry_after is None and stage.startswith("telegram."):
+        try:
+            retry_after = response.json()["parameters"]["retry_after"]
+        except Exception:
+            pass
+    retry_after = float(retry_after or 1)
+    logger.info(f"Rate limited on {stage}, waiting {retry_after}s")
+    http_retry_count += 1
+
+    # For Telegram, the limit is most likely the chat's one (the last bucket)
+    # Without buckets to pause, the call waits here before being sent again
+    if not buckets:
+        time.sleep(retry_after)
+    for bucket in buckets[-1:] if stage.startswith("telegram.") else buckets:
+        bucket.penalize(retry_after)
+    return True
+
+
+# Function to get the HTTP session shared by every outbound call (Telegram, OpenAI and downloads)
+# Its connections are kept alive, so warm invocations reuse them
+def get_http_session():
+    global http_session
+    if http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Retry policy with a random jitter on the exponential backoff
+        # The Retry-After header of 503 responses is honored by urllib3 (429 responses are
+        # sent again by the session, once their retry_after wait is over, since Telegram
+        # sends it on the response body)
+        class JitteredRetry(Retry):
+            def get_backoff_time(self):
+                return random.uniform(0, super().get_backoff_time())
+
+            def increment(self, *args, **kwargs):
+                global http_retry_count
+                http_retry_count += 1
+                return super().increment(*args, **kwargs)
+
+        retry = JitteredRetry(
+            total=http_retries,
+            backoff_factor=http_backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        # Blocking pools, so no more than the pool size connections are opened per host
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=http_pool_size,
+            pool_block=True,
+            max_retries=retry,
+        )
+
+        # HTTP session pacing and timing each outbound call, as a stage named after its service
+        # and method, and sending the rate limited calls again once the wait is over
+        class MeteredSession(requests.Session):
+            def request(self, method, url, *args, **kwargs):
+                stage = get_http_stage(url)
+                for attempt in range(http_retries + 1):
+                    wait_rate_limits(stage, kwargs)
+                    with span(stage):
+                        response = super().request(method, url, *args, **kwargs)
+                    if attempt == http_retries or not update_rate_limits(
+                        stage, kwargs, response
+                    ):
+                        return response
+                    response.close()
+
+        http_session = MeteredSession()
+        http_session.mount("https://", adapter)
+        http_session.mount("http://", adapter)
+    return http_session
+
+
+# Function to get the connection reuse counters of the HTTP session
+def get_http_stats():
+    connections = sent = 0
+    if http_session is not None:
+        pools = http_session.get_adapter("https://").poolmanager.pools
+        for key in pools.keys():
+            connections += pools[key].num_connections
+            sent += pools[key].num_requests
+    return {
+        "connections": connections,
+        "requests": sent,
+        "reused": sent - connections,
+        "retries": http_retry_count,
+    }
+
+
+# Function to get the Telegram Bot client
+def get_bot():
+    global bot
+    if bot is None:
+        import telebot
+
+        # The Bot API calls are made through the shared HTTP session
+        telebot.apihelper.session = get_http_session()
+        telebot.apihelper.CONNECT_TIMEOUT = http_connect_timeout
+        telebot.apihelper.READ_TIMEOUT = http_timeout
+        bot = telebot.TeleBot(os.environ["BOT_TOKEN"])
+    return bot
+
+
+# Function to get the OpenAI client, with the API Key set
+def get_openai():
+    global openai_client
+    if openai_client is None:
+        import httpx
+        import openai
+
+        # Stream of a response body received through the shared HTTP session
+        class SessionResponseStream(httpx.SyncByteStream):
+            def __init__(self, response):
+                self.response = response
+
+            def __iter__(self):
+                yield from self.response.raw.stream(64 * 1024, decode_content=False)
+
+            def close(self):
+                self.response.close()
+
+        # Transport sending the OpenAI SDK requests through the shared HTTP session
+        class SessionTransport(httpx.BaseTransport):
+            def handle_request(self, request):
+                timeout = request.extensions.get("timeout", {})
+                response = get_http_session().request(
+                    request.method,
+                    str(request.url),
+                    headers=dict(request.headers),
+                    data=request.read(),
+                    stream=True,
+                    timeout=(
+                        timeout.get("connect", http_connect_timeout),
+                        timeout.get("read", http_timeout),
+                    ),
+                )
+                return httpx.Response(
+                    response.status_code,
+                    headers=list(response.raw.headers.items()),
+                    stream=SessionResponseStream(response),
+                )
+
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+        # Retries are made by the shared HTTP session
+        openai.http_client = httpx.Client(transport=SessionTransport())
+        openai.max_retries = 0
+        openai.timeout = http_timeout
+        openai.base_url = openai_base_url
+        openai_client = openai
+    return openai_client
+
+
+# Function to get the DynamoDB table with the conversations
+def get_table():
+    global table
+    if table is None:
+        import boto3
+
+        # An endpoint may be set to use a local table (e.g. DynamoDB Local)
+        dynamodb = boto3.resource(
+            "dynamodb",
+            region_name=os.environ["AWS_REGION"],
+            endpoint_url=os.environ.get("AWS_DYNAMODB_ENDPOINT") or None,
+        )
+        table = dynamodb.Table(os.environ["AWS_DYNAMODB"])
+        meter_aws_client(dynamodb.meta.client)
+    return table
+
+
+# Function to get the S3 client, used to keep the older conversation segments
+def get_s3():
+    global s3
+    if s3 is None:
+        import boto3
+        from botocore.config import Config
+
+        # An endpoint may be set to use a local bucket (e.g. moto's server)
+        endpoint = os.environ.get("AWS_S3_ENDPOINT") or None
+        s3 = boto3.client(
+            "s3",
+            region_name=os.environ["AWS_REGION"],
+            endpoint_url=endpoint,
+            config=Config(s3={"addressing_style": "path" if endpoint else "auto"}),
+        )
+        meter_aws_client(s3)
+    return s3
+
+
+# Function to get the SQS client, used to enqueue the updates on queue mode
+def get_sqs():
+    global sqs
+    if sqs is None:
+        import boto3
+
+        # An endpoint may be set to use a local queue (e.g. moto's server)
+        sqs = boto3.client(
+            "sqs",
+            region_name=os.environ["AWS_REGION"],
+            endpoint_url=os.environ.get("AWS_SQS_ENDPOINT") or None,
+        )
+        meter_aws_client(sqs)
+    return sqs
+
+
+# Function to pre-establish the clients connections on warm-up events
+# (e.g. a scheduled event with {"warmup": true}), so the next update finds them ready
+def warm_up():
+    get_bot().get_me()
+    get_openai().models.retrieve(model_engine)
+    get_table().get_item(Key={"pk": "warmup", "sk": 0})
+    if webhook_mode == "queue":
+        get_sqs().get_queue_attributes(QueueUrl=os.environ["AWS_SQS_QUEUE_URL"])
+    count_tokens("")
+
+
+# Function to claim an update before processing it, so it's processed only once
+# Telegram redelivers an update when the webhook takes too long to answer,
+# so only the first delivery gets the claim (expired claims are removed by the table's TTL)
+def claim_update(update_id):
+    table = get_table()
+    try:
+        table.put_item(
+            Item={
+                "pk": f"update#{update_id}",
+                "sk": 0,
+                "expires_at": int(time.time()) + update_claim_ttl,
+            },
+            ConditionExpression="attribute_not_exists(pk)",
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+# Function to release the claim of an update, so it can be processed again
+def release_update(update_id):
+    get_table().delete_item(Key={"pk": f"update#{update_id}", "sk": 0})
+
+
+# Function to start an image job of a chat, returning its ID (or None, if the chat already
+# has as many jobs running as allowed)
+# Each chat has a few job slots on the DynamoDB table, taken with a conditional write, so
+# concurrent requests can't go over the limit (the slots of interrupted jobs are taken
+# again once they expire); the job ID is its slot and a random token
+def start_image_job(chat_id):
+    table = get_table()
+    now = int(time.time())
+    for slot in range(1, image_jobs_per_chat + 1):
+        job_id = f"{slot}:{os.urandom(8).hex()}"
+        try:
+            table.put_item(
+                Item={
+                    "pk": f"job#{chat_id}",
+                    "sk": slot,
+                    "job_id": job_id,
+                    "expires_at": now + image_job_timeout,
+                },
+                ConditionExpression="attribute_not_exists(pk) OR expires_at < :now",
+                ExpressionAttributeValues={":now": now},
+            )
+            return job_id
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            continue
+    return None
+
+
+# Function to get the DynamoDB key of an image job's slot
+def image_job_key(chat_id, job_id):
+    return {"pk": f"job#{chat_id}", "sk": int(job_id.split(":")[0])}
+
+
+# Function to check if an image job is still running (it wasn't cancelled)
+def is_image_job_active(chat_id, job_id):
+    res = get_table().get_item(Key=image_job_key(chat_id, job_id), ConsistentRead=True)
+    return res.get("Item", {}).get("job_id") == job_id
+
+
+# Function to free the slot of a finished image job (if it wasn't taken by another one)
+def finish_image_job(chat_id, job_id):
+    table = get_table()
+    try:
+        table.delete_item(
+            Key=image_job_key(chat_id, job_id),
+            ConditionExpression="job_id = :job",
+            ExpressionAttributeValues={":job": job_id},
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+# Function to cancel the image jobs of a chat, returning how many were running
+def cancel_image_jobs(chat_id):
+    table = get_table()
+
+    from boto3.dynamodb.conditions import Key
+
+    res = table.query(
+        KeyConditionExpression=Key("pk").eq(f"job#{chat_id}"),
+        ProjectionExpression="pk, sk, expires_at",
+        ConsistentRead=True,
+    )
+    for item in res["Items"]:
+        table.delete_item(Key={"pk": item["pk"], "sk": item["sk"]})
+    return sum(1 for item in res["Items"] if item["expires_at"] > time.time())
+
+
+# Function to get the chat ID of an update, used to keep each chat's updates in order
+def get_update_chat_id(update):
+    for value in update.values():
+        if isinstance(value, dict):
+            # Messages and posts have the chat, callback queries have it on their message
+            chat = value.get("chat") or value.get("message", {}).get("chat")
+            if chat:
+                return chat["id"]
+    return None
+
+
+# Function to normalize the parameters of a cacheable request
+# Whitespace differences are ignored, as well as the bookkeeping fields of the messages
+def normalize_cache_params(value):
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {
+            k: normalize_cache_params(v)
+            for k, v in value.items()
+            if k not in ("seq", "tokens")
+        }
+    if isinstance(value, list):
+        return [normalize_cache_params(v) for v in value]
+    return value
+
+
+# Function to get the cache key of a request, as a stable hash of its parameters
+def cache_key(route, **params):
+    data = json.dumps(normalize_cache_params(params), sort_keys=True, default=str)
+    return f"cache#{route}#{hashlib.sha256(data.encode()).hexdigest()}"
+
+
+# Function to remove the cache opt-out tag from a text
+# Returns the text without the tag and whether the cache may be used for the request
+def split_cache_opt_out(text):
+    if text and cache_opt_out_tag in text:
+        return " ".join(text.replace(cache_opt_out_tag, " ").split()), False
+    return text, True
+
+
+# Function to get a cached result, from the in-process cache or from the DynamoDB table
+def get_cached_result(route, key):
+    stats = cache_stats.setdefault(route, {"hits": 0, "misses": 0})
+    now = time.time()
+
+    # Looking for the result on the in-process cache first
+    with cache_lock:
+        entry = results_cache.get(key)
+        if entry and entry[0] > now:
+            results_cache.move_to_end(key)
+            stats["hits"] += 1
+            return entry[1]
+
+    # Then, if enabled, on the DynamoDB table (expired items may not be deleted yet)
+    if cache_dynamodb:
+        item = get_table().get_item(Key={"pk": key, "sk": 0}).get("Item")
+        if item and item["expires_at"] > now:
+            result = json.loads(item["result"])
+            with cache_lock:
+                results_cache[key] = (float(item["expires_at"]), result)
+                while len(results_cache) > cache_size:
+                    results_cache.popitem(last=False)
+            stats["hits"] += 1
+            return result
+
+    stats["misses"] += 1
+    return None
+
+
+# Function to save a result to the in-process cache and, if enabled, to the DynamoDB table
+def set_cached_result(key, result, ttl=None):
+    expires_at = int(time.time() + (ttl or cache_ttl))
+
+    # Saving the result, evicting the least recently used ones over the cache size
+    with cache_lock:
+        results_cache[key] = (expires_at, result)
+        results_cache.move_to_end(key)
+        while len(results_cache) > cache_size:
+            results_cache.popitem(last=False)
+
+    # The table's TTL must be enabled on the "expires_at" attribute
+    if cache_dynamodb:
+        get_table().put_item(
+            Item={
+                "pk": key,
+                "sk": 0,
+                "result": json.dumps(result),
+                "expires_at": expires_at,
+            }
+        )
+
+
+# Function to get the cache hit rate of each route
+def get_cache_stats():
+    return {
+        route: {
+            **stats,
+            "hit_rate": stats["hits"] / ((stats["hits"] + stats["misses"]) or 1),
+        }
+        for route, stats in cache_stats.items()
+    }
+
+
+# Function to get the path of an image on the on-disk tier of the image cache
+def image_cache_path(file_unique_id):
+    return os.path.join(image_cache_dir, f"{file_unique_id}.b64")
+
+
+# Function to keep a processed image on the in-memory tier of the image cache, evicting the
+# least recently used ones over its byte budget
+def keep_cached_image(file_unique_id, image):
+    global image_cache_used
+    with image_cache_lock:
+        image_cache_used -= len(image_cache.pop(file_unique_id, ""))
+        if len(image) <= image_cache_bytes:
+            image_cache[file_unique_id] = image
+            image_cache_used += len(image)
+        while image_cache_used > image_cache_bytes:
+            image_cache_used -= len(image_cache.popitem(last=False)[1])
+
+
+# Function to get a processed image (encoded as base64) by its Telegram file_unique_id,
+# from the in-memory tier of the image cache or from the on-disk one
+def get_cached_image(file_unique_id):
+    stats = cache_stats.setdefault("image", {"hits": 0, "misses": 0})
+    with image_cache_lock:
+        image = image_cache.get(file_unique_id)
+        if image is not None:
+            image_cache.move_to_end(file_unique_id)
+            stats["hits"] += 1
+            return image
+
+    # The images read from the disk are touched, so the least recently used are removed
+    if image_cache_dir:
+        path = image_cache_path(file_unique_id)
+        try:
+            with open(path) as f:
+                image = f.read()
+            os.utime(path)
+        except OSError:
+            image = None
+        if image:
+            keep_cached_image(file_unique_id, image)
+            stats["hits"] += 1
+            return image
+
+    stats["misses"] += 1
+    return None
+
+
+# Function to save a processed image to the image cache, on both tiers
+def set_cached_image(file_unique_id, image):
+    global image_disk_used
+    keep_cached_image(file_unique_id, image)
+    if not image_cache_dir:
+        return
+    try:
+        # The image is written to a temporary file first, so it's never read incomplete
+        os.makedirs(image_cache_dir, exist_ok=True)
+        path = image_cache_path(file_unique_id)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(image)
+        os.replace(temp_path, path)
+        with image_cache_lock:
+            image_disk_used = (image_disk_used or 0) + len(image)
+            trim = image_disk_used > image_cache_disk_bytes
+        if trim:
+            trim_image_disk_cache()
+    except OSError as e:
+        logger.error(f"Failed to save the image to the disk cache: {e}")
+
+
+# Function to remove the least recently used images of the on-disk tier over its byte budget
+def trim_image_disk_cache():
+    global image_disk_used
+    files = []
+    for entry in os.scandir(image_cache_dir):
+        if entry.name.endswith(".b64"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    used = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if used <= image_cache_disk_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        used -= size
+    with image_cache_lock:
+        image_disk_used = used
+
+
+# Function to select the photo size to be sent to the vision model
+# Telegram sends several sizes of each photo, from the smallest to the largest,
+# so we take the smallest one that still meets the resolution used by the model
+def select_photo_size(photos):
+    for photo in photos:
+        if min(photo["width"], photo["height"]) >= vision_min_side:
+            return photo
+    return photos[-1]
+
+
+# Function to get the reference to a photo kept on the conversation history, so it can be
+# sent again to the vision model on a later turn
+def photo_reference(photo):
+    return {k: photo[k] for k in ("file_id", "file_unique_id", "width", "height")}
+
+
+# Function to downscale an image to the maximum side used by the vision model
+def downscale_image(image):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image)) as img:
+        img.thumbnail((vision_max_side, vision_max_side))
+        output = io.BytesIO()
+        img.convert("RGB").save(output, format="JPEG", quality=85)
+    return output.getbuffer()
+
+
+# Function to encode binary data as base64, in chunks
+# The chunks are views of the data (multiple of 3 bytes, so no padding is added)
+def encode_base64(data, chunk_size=3 * 64 * 1024):
+    view = memoryview(data)
+    encoded = bytearray()
+    for start in range(0, len(view), chunk_size):
+        encoded += base64.b64encode(view[start : start + chunk_size])
+    return encoded.decode("ascii")
 
 
 # Function to get image from URL as base64
-def url_to_base64(url):
+# The download is streamed and stops if the image exceeds the size limit
+def url_to_base64(url, downscale=False):
+    try:
+        # Fetch the image from the URL
+        with get_http_session().get(
+            url, stream=True, timeout=(http_connect_timeout, http_timeout)
+        ) as response:
+            # Check if the request was successful (status code 200)
+            if response.status_code != 200:
+                logger.error(
+                    f"Failed to fetch image. Status code: {response.status_code}"
+                )
+                return None
+
+            # Reading the image content, up to the size limit
+            image = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                image += chunk
+                if len(image) > vision_max_bytes:
+                    logger.error(
+                        f"Image exceeds the size limit of {vision_max_bytes} bytes"
+                    )
+                    return None
+
+        # If the image is larger than the model uses, we downscale it
+        if downscale:
+            image = downscale_image(image)
+
+        # Encode the image content as base64
+        return encode_base64(image)
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+    # If no image could be encoded, we return Nne
+    return None
+
+
+# This function checks if the message was sent by the admin
+def is_admin_message(message):
+    return message["chat"]["id"] == int(os.environ["ADMIN_CHAT_ID"])
+
+
+# This function checks if the message was sent by an allowed user (or on an allowed chat)
+def is_allowed_message(message):
+    ids = {str(message["chat"]["id"]), str(message.get("from", {}).get("id"))}
+    if is_admin_message(message) or "*" in allowed_users or ids & allowed_users:
+        return True
+    get_bot().send_message(
+        message["chat"]["id"],
+        "Currently, you don't have access to this feature.",
+    )
+    return False
+
+
+# Function to get the current quota period (e.g. 20240131 for a daily quota)
+def get_quota_period():
+    period_format = "%Y%m" if token_quota_period == "monthly" else "%Y%m%d"
+    return int(time.strftime(period_format, time.gmtime()))
+
+
+# Function to get the user whose quota is charged for a message (None if there's no quota)
+def get_quota_user(message):
+    if not token_quota or is_admin_message(message):
+        return None
+    return message.get("from", {}).get("id", message["chat"]["id"])
+
+
+# Function to get the tokens used by a user on the current period
+def get_quota_usage(user_id):
+    period = get_quota_period()
+    with quota_lock:
+        known = quota_usage.get(user_id)
+    if known and known[0] == period:
+        return known[1]
+
+    # The first request of the user (or period) reads the counter from the table
+    item = (
+        get_table()
+        .get_item(Key={"pk": f"quota#{user_id}", "sk": period})
+        .get("Item", {})
+    )
+    tokens = int(item.get("tokens", 0))
+    with quota_lock:
+        known = quota_usage.get(user_id)
+        if known and known[0] == period:
+            tokens = max(tokens, known[1])
+        quota_usage[user_id] = (period, tokens)
+    return tokens
+
+
+# Function to check if a request of a message is admitted, given its estimated tokens
+# Returns the model to be used (the fallback one, if over the quota), or None if the request
+# was rejected (after informing the user)
+def admit_request(message, estimate, model=model_engine, fallback=True):
+    user_id = get_quota_user(message)
+    if user_id is None:
+        return model
+
+    used = get_quota_usage(user_id) + estimate
+    if used <= token_quota:
+        return model
+    if fallback and quota_fallback_model and used <= token_quota_hard:
+        return quota_fallback_model
+
+    period = "month" if token_quota_period == "monthly" else "day"
+    get_bot().send_message(
+        message["chat"]["id"],
+        f"You've reached your quota of {token_quota} tokens for the {period}, please try again later.",
+    )
+    return None
+
+
+# Function to charge the tokens used by a request to the quota of a message's user
+# The counter is increased atomically on the table, which returns the updated total
+def charge_quota(message, tokens):
+    user_id = get_quota_user(message)
+    if user_id is None or not tokens:
+        return
+    period = get_quota_period()
+    try:
+        res = get_table().update_item(
+            Key={"pk": f"quota#{user_id}", "sk": period},
+            UpdateExpression="ADD tokens :tokens SET expires_at = :expires_at",
+            ExpressionAttributeValues={
+                ":tokens": tokens,
+                # The counters are kept for a while after their period
+                ":expires_at": int(time.time()) + 40 * 86400,
+            },
+            ReturnValues="UPDATED_NEW",
+        )
+    # The response was already sent, so a failed charge is only logged
+    except Exception as e:
+        logger.error(f"Failed to charge {tokens} tokens to user {user_id}: {e}")
+        return
+    with quota_lock:
+        quota_usage[user_id] = (period, int(res["Attributes"]["tokens"]))
+
+
+# Function to get the tokens used by a request from its metadata (cached responses are free)
+# Streamed responses don't have the token usage, so it's estimated
+def get_used_tokens(metadata, estimate, content):
+    if metadata.get("cached"):
+        return 0
+    if "usage" in metadata:
+        return metadata["usage"]["total_tokens"]
+    return estimate + count_tokens(content or "")
+
+
+# Maximum number of messages loaded from the conversation history
+history_limit = int(os.environ.get("HISTORY_LIMIT", "50"))
+
+# If enabled, only the newest messages (the hot tail) are kept on the DynamoDB table, and
+# the older ones are compacted into gzip-compressed JSONL segments on the S3 bucket
+cold_storage = os.environ.get("COLD_STORAGE", "false").lower() == "true"
+# Number of messages kept on the hot tail (at least the history limit), and on each segment
+hot_messages = max(int(os.environ.get("HOT_MESSAGES", "200")), history_limit)
+segment_messages = int(os.environ.get("SEGMENT_MESSAGES", "500"))
+
+# Maximum number of chats whose conversation is kept in memory
+conversation_cache_size = int(os.environ.get("CONVERSATION_CACHE_SIZE", "100"))
+
+# Conversations kept in memory (chat ID: conversation), from the least recently used
+conversations = OrderedDict()
+conversations_lock = threading.Lock()
+
+# Maximum number of tokens of the conversation context sent to the chat model
+context_token_budget = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+# Optional system prompt, always pinned at the start of the conversation context
+system_prompt = os.environ.get("SYSTEM_PROMPT")
+# If enabled, messages evicted from the context are kept as a rolling summary
+summarize_evicted = os.environ.get("SUMMARIZE_EVICTED", "false").lower() == "true"
+
+# If enabled, every conversation turn is embedded, and the past turns most similar to the
+# new message are recalled on the context, even after they left the history
+long_term_memory = os.environ.get("MEMORY", "false").lower() == "true"
+# Embedding model, and the dimensions its embeddings are shortened to (0 keeps them whole)
+embedding_model = os.environ.get("EMBEDDING_MODEL", "text-embedding-3-small")
+embedding_dimensions = int(os.environ.get("EMBEDDING_DIMENSIONS", "256"))
+# Maximum number of recalled turns, their minimum similarity and their maximum tokens
+memory_top_k = int(os.environ.get("MEMORY_TOP_K", "3"))
+memory_min_score = float(os.environ.get("MEMORY_MIN_SCORE", "0.3"))
+memory_token_budget = int(os.environ.get("MEMORY_TOKENS", "600"))
+# Directory where the memory index of each chat is kept (the S3 bucket keeps a copy, so
+# other containers can rebuild it), and number of turns of the merged S3 objects
+memory_dir = os.environ.get("MEMORY_DIR", "/tmp/memory")
+memory_chunk = int(os.environ.get("MEMORY_CHUNK", "256"))
+
+# Memory indexes opened (chat ID: memory), from the least recently used
+memories = OrderedDict()
+memories_lock = threading.Lock()
+
+# If enabled, text responses are streamed to the user as they are generated
+stream_responses = os.environ.get("STREAM_RESPONSES", "false").lower() == "true"
+# Minimum interval (in seconds) between the edits of a streamed message
+stream_edit_interval = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+# Maximum length of a Telegram message
+telegram_message_limit = 4096
+
+# Tokenizer used to count the messages tokens (loaded on first use)
+tokenizer = None
+
+
+# Function to count the tokens of a message content
+def count_tokens(text):
+    global tokenizer
+    # Loading the tokenizer used by the chat models, if available
+    if tokenizer is None:
+        try:
+            import tiktoken
+
+            tokenizer = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.error(f"Tokenizer could not be loaded, estimating tokens: {e}")
+            tokenizer = False
+    # Each message also takes a few tokens for its role and delimiters
+    if tokenizer:
+        return len(tokenizer.encode(text)) + 4
+    # Otherwise, we estimate around 4 characters per token
+    return len(text) // 4 + 4
+
+
+# Function to get the DynamoDB partition key for a chat conversation
+# Each message is stored as its own item, with the sequence number as the sort key
+# The item with sort key 0 holds the conversation metadata (e.g. the last sequence number)
+def chat_key(chat_id):
+    return f"chat#{chat_id}"
+
+
+# Function to get messages from DynamoDB table
+def get_dynamodb_messages(chat_id, limit=history_limit):
+    # Getting the DynamoDB table
+    table = get_table()
+
+    from boto3.dynamodb.conditions import Key
+
+    # Querying only the newest messages of the chat (metadata item is skipped)
+    # The read is strongly consistent, like the metadata one, so the messages cached
+    # under its version include the newest ones
+    res = table.query(
+        KeyConditionExpression=Key("pk").eq(chat_key(chat_id)) & Key("sk").gt(0),
+        ScanIndexForward=False,
+        Limit=limit,
+        ConsistentRead=True,
+    )
+
+    # Items are returned newest first, so we reverse them to the conversation order
+    # The sequence number and the token count are kept to build the context later
+    dynamo_messages = [
+        {
+            "role": item["role"],
+            "content": item["content"],
+            "seq": int(item["sk"]),
+            "tokens": int(item.get("tokens") or count_tokens(item["content"])),
+            **({"images": item["images"]} if "images" in item else {}),
+        }
+        for item in reversed(res["Items"])
+    ]
+
+    # Returning resulting list
+    return dynamo_messages
+
+
+# Function to get the DynamoDB item of a conversation message
+# The message must be formatted as one of the following:
+# {"role": "user", "content": "Text content'}
+# {"role": "assistant", "content": "Text content'}
+# The tokens are counted only once, and stored alongside the message
+def dynamo_message_item(chat_id, seq, message):
+    message["seq"] = seq
+    return {
+        "pk": chat_key(chat_id),
+        "sk": seq,
+        "role": message["role"],
+        "content": message["content"],
+        "tokens": message.setdefault("tokens", count_tokens(message["content"])),
+        # The photos of the message are referenced by their Telegram IDs
+        **({"images": message["images"]} if message.get("images") else {}),
+    }
+
+
+# Function to get the conversation metadata from DynamoDB table: its version (the last
+# sequence number), the rolling summary of the evicted messages, the last sequence
+# number moved to the S3 bucket and the first one after the last clear
+def get_dynamodb_conversation_meta(chat_id):
+    item = (
+        get_table()
+        .get_item(Key={"pk": chat_key(chat_id), "sk": 0}, ConsistentRead=True)
+        .get("Item", {})
+    )
+    return (
+        int(item.get("last_seq", 0)),
+        item.get("summary"),
+        int(item.get("summary_seq", 0)),
+        int(item.get("cold_seq", 0)),
+        int(item.get("cleared_seq", 0)),
+    )
+
+
+# Function to add messages to a cached conversation, keeping only the newest ones
+def append_conversation_messages(conversation, messages):
+    conversation["messages"].extend(messages)
+    del conversation["messages"][:-history_limit]
+
+
+# Function to get the conversation of a chat (its newest messages and metadata)
+# The cached conversation is used while its version matches the stored one, so the
+# history is only read again when the conversation was changed elsewhere
+def get_conversation(chat_id):
+    meta = get_dynamodb_conversation_meta(chat_id)
+    version, summary, summary_seq, cold_seq, cleared_seq = meta
+    with conversations_lock:
+        conversation = conversations.get(chat_id)
+        if conversation is not None and conversation["version"] == version:
+            conversations.move_to_end(chat_id)
+        else:
+            conversation = None
+
+    # Otherwise, the history is loaded and cached, evicting the least recently used chats
+    if conversation is None:
+        conversation = {"version": version, "messages": get_dynamodb_messages(chat_id)}
+        with conversations_lock:
+            conversations[chat_id] = conversation
+            while len(conversations) > conversation_cache_size:
+                conversations.popitem(last=False)
+
+    conversation["summary"] = summary
+    conversation["summary_seq"] = summary_seq
+    conversation["cold_seq"] = cold_seq
+    conversation["cleared_seq"] = cleared_seq
+    return conversation
+
+
+# Function to save a conversation turn on DynamoDB table, with optimistic concurrency
+# The turn (the user message and the response, which keeps the request metadata) is
+# written with a single transaction, only if the conversation is still at its version;
+# otherwise, the conversation is reloaded and the turn goes after the new messages
+def save_conversation_turn(
+    chat_id, conversation, user_message, bot_message, metadata=None
+):
+    # Getting the DynamoDB table
+    table = get_table()
+
+    for attempt in range(3):
+        version = conversation["version"]
+        items = [
+            dynamo_message_item(chat_id, version + 1, user_message),
+            {
+                **dynamo_message_item(chat_id, version + 2, bot_message),
+                **(metadata or {}),
+            },
+        ]
+        try:
+            table.meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": table.name,
+                            "Key": {"pk": chat_key(chat_id), "sk": 0},
+                            "UpdateExpression": "SET last_seq = :next",
+                            "ConditionExpression": "attribute_not_exists(last_seq) OR last_seq = :version",
+                            "ExpressionAttributeValues": {
+                                ":next": version + 2,
+                                ":version": version,
+                            },
+                        }
+                    }
+                ]
+                + [{"Put": {"TableName": table.name, "Item": item}} for item in items]
+            )
+            break
+        # If the conversation was changed elsewhere, we reload it and try again
+        except table.meta.client.exceptions.TransactionCanceledException:
+            logger.info(f"Conversation {chat_id} changed, reloading it")
+            conversation = get_conversation(chat_id)
+    else:
+        raise Exception("The conversation was changed too many times while saving")
+
+    # Updating the cached conversation with the new messages
+    conversation["version"] = version + 2
+    append_conversation_messages(conversation, [user_message, bot_message])
+
+    # Moving the oldest messages to the S3 bucket, once the hot tail is a segment too long
+    if (
+        cold_storage
+        and conversation["version"] - conversation.get("cold_seq", 0)
+        > hot_messages + segment_messages
+    ):
+        try:
+            conversation["cold_seq"] = compact_conversation(chat_id)
+        except Exception as e:
+            logger.error(f"Failed to compact the conversation {chat_id}: {e}")
+
+    # Adding the turn to the chat memory
+    if long_term_memory:
+        remember_turn(chat_id, conversation, user_message, bot_message)
+
+
+# Function to get the S3 key prefix of a chat conversation segments
+def segment_prefix(chat_id):
+    return f"conversations/{chat_id}/"
+
+
+# Function to get the S3 key of a conversation segment
+# The zero-padded sequence numbers keep the segments listed in the conversation order,
+# and the random suffix keeps concurrent compactions of the same range apart
+def segment_key(chat_id, first_seq, last_seq):
+    suffix = os.urandom(4).hex()
+    return (
+        f"{segment_prefix(chat_id)}{first_seq:012d}-{last_seq:012d}-{suffix}.jsonl.gz"
+    )
+
+
+# Function to convert the numbers read from DynamoDB table (decimals) to JSON ones
+def json_number(value):
+    return int(value) if value % 1 == 0 else float(value)
+
+
+# Function to get the segment record of a message item, which keeps its sequence number
+# and request metadata
+def segment_record(item):
+    return {
+        "seq": int(item["sk"]),
+        **{k: v for k, v in item.items() if k not in ("pk", "sk")},
+    }
+
+
+# Function to encode records as a gzip-compressed JSONL segment (a message per line)
+def encode_segment(records):
+    import gzip
+
+    lines = (
+        json.dumps(record, default=json_number, ensure_ascii=False) + "\n"
+        for record in records
+    )
+    return gzip.compress("".join(lines).encode(), compresslevel=6)
+
+
+# Function to decode the messages of a gzip-compressed JSONL segment
+def decode_segment(data):
+    import gzip
+
+    return [json.loads(line) for line in gzip.decompress(data).splitlines() if line]
+
+
+# Function to query every item of a chat conversation within a range of sequence numbers
+def query_conversation_items(chat_id, first_seq, last_seq=None):
+    from boto3.dynamodb.conditions import Key
+
+    key = Key("pk").eq(chat_key(chat_id))
+    if last_seq is None:
+        key &= Key("sk").gte(first_seq)
+    else:
+        key &= Key("sk").between(first_seq, last_seq)
+    query = {"KeyConditionExpression": key, "ConsistentRead": True}
+    items = []
+    while True:
+        res = get_table().query(**query)
+        items.extend(res["Items"])
+        # Following the pagination until all items are read
+        if "LastEvaluatedKey" not in res:
+            return items
+        query["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+
+# Function to move the oldest segment of the hot tail to the S3 bucket, returning the last
+# sequence number moved so far
+# The segment is uploaded first, then the cold sequence number moves forward (if no other
+# compaction or clear got there first) and only then the items are deleted, so the messages
+# are never lost; a failed attempt just leaves its segment behind, which is removed
+def compact_conversation(chat_id):
+    # Getting the DynamoDB table
+    table = get_table()
+
+    item = table.get_item(
+        Key={"pk": chat_key(chat_id), "sk": 0},
+        ConsistentRead=True,
+        ProjectionExpression="last_seq, cold_seq",
+    ).get("Item", {})
+    last_seq, cold_seq = int(item.get("last_seq", 0)), int(item.get("cold_seq", 0))
+    if last_seq - cold_seq <= hot_messages + segment_messages:
+        return cold_seq
+
+    # Uploading the oldest messages of the hot tail as a segment
+    next_cold_seq = cold_seq + segment_messages
+    items = query_conversation_items(chat_id, cold_seq + 1, next_cold_seq)
+    bucket = os.environ["AWS_BUCKET"]
+    key = segment_key(chat_id, cold_seq + 1, next_cold_seq)
+    get_s3().put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=encode_segment(map(segment_record, items)),
+        ContentType="application/gzip",
+    )
+
+    try:
+        table.update_item(
+            Key={"pk": chat_key(chat_id), "sk": 0},
+            UpdateExpression="SET cold_seq = :next",
+            ConditionExpression="attribute_not_exists(cold_seq) OR cold_seq = :cold",
+            ExpressionAttributeValues={":next": next_cold_seq, ":cold": cold_seq},
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"Conversation {chat_id} was already compacted or cleared")
+        get_s3().delete_object(Bucket=bucket, Key=key)
+        return get_dynamodb_conversation_meta(chat_id)[3]
+
+    # Deleting the moved messages from the hot tail
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.delete_item(Key={"pk": item["pk"], "sk": item["sk"]})
+    return next_cold_seq
+
+
+# Function to list the S3 keys of a chat conversation segments, in the conversation order
+def list_conversation_segments(chat_id):
+    keys = []
+    pages = get_s3().get_paginator("list_objects_v2")
+    for page in pages.paginate(
+        Bucket=os.environ["AWS_BUCKET"], Prefix=segment_prefix(chat_id)
+    ):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return sorted(keys)
+
+
+# Function to export the full history of a conversation as a gzip-compressed JSONL file,
+# joining the segments on the S3 bucket and the hot tail on the DynamoDB table
+def export_conversation(chat_id):
+    # Records by sequence number, so the messages left behind by an interrupted compaction
+    # (or the segments of concurrent ones) are only exported once
+    records = {}
+    if cold_storage:
+        for key in list_conversation_segments(chat_id):
+            obj = get_s3().get_object(Bucket=os.environ["AWS_BUCKET"], Key=key)
+            for record in decode_segment(obj["Body"].read()):
+                records[record["seq"]] = record
+    for item in query_conversation_items(chat_id, 1):
+        records.setdefault(int(item["sk"]), segment_record(item))
+    return encode_segment(records[seq] for seq in sorted(records))
+
+
+# Function to clear previous saved messages on DynamoDB table
+def clear_dynamo_messages(chat_id):
+    # Getting the DynamoDB table
+    table = get_table()
+
+    from boto3.dynamodb.conditions import Key
+
+    # Deleting every message item of the chat (the sequence counter is kept)
+    query = {
+        "KeyConditionExpression": Key("pk").eq(chat_key(chat_id)) & Key("sk").gt(0),
+        "ProjectionExpression": "pk, sk",
+    }
+    with table.batch_writer() as batch:
+        while True:
+            res = table.query(**query)
+            for item in res["Items"]:
+                batch.delete_item(Key={"pk": item["pk"], "sk": item["sk"]})
+            # Following the pagination until all items are deleted
+            if "LastEvaluatedKey" not in res:
+                break
+            query["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+    # Removing the rolling summary of the conversation as well, and changing its version
+    # (the counter is kept, so the sequence numbers are never reused)
+    # The hot tail (and the memory) starts over after the cleared messages
+    table.update_item(
+        Key={"pk": chat_key(chat_id), "sk": 0},
+        UpdateExpression=(
+            "REMOVE summary, summary_seq"
+            " SET cold_seq = if_not_exists(last_seq, :zero) + :one,"
+            " cleared_seq = if_not_exists(last_seq, :zero) + :one"
+            " ADD last_seq :one"
+        ),
+        ExpressionAttributeValues={":one": 1, ":zero": 0},
+    )
+
+    # Deleting the segments on the S3 bucket, after the cold sequence number changed (so no
+    # compaction in progress may add one later)
+    if cold_storage:
+        keys = list_conversation_segments(chat_id)
+        for i in range(0, len(keys), 1000):
+            get_s3().delete_objects(
+                Bucket=os.environ["AWS_BUCKET"],
+                Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+            )
+
+    # Clearing the chat memory as well
+    if long_term_memory:
+        clear_memory(chat_id)
+
+    # Removing the cached conversation
+    with conversations_lock:
+        conversations.pop(chat_id, None)
+
+
+# Function to save the rolling summary of the evicted messages on DynamoDB table
+def update_dynamo_summary(chat_id, summary, summary_seq):
+    # Getting the DynamoDB table
+    table = get_table()
+
+    # Only a summary covering newer messages may replace the current one
+    try:
+        table.update_item(
+            Key={"pk": chat_key(chat_id), "sk": 0},
+            UpdateExpression="SET summary = :summary, summary_seq = :seq",
+            ConditionExpression="attribute_not_exists(summary_seq) OR summary_seq < :seq",
+            ExpressionAttributeValues={":summary": summary, ":seq": summary_seq},
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info("A newer conversation summary was already saved")
+
+
+# Function to summarize the messages evicted from the context, along with the previous summary
+def summarize_messages(summary, evicted):
+    # Formatting the evicted messages as a transcript
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+    if summary:
+        transcript = f"Previous summary: {summary}\n\n{transcript}"
+
+    # Requesting a short summary to the chat model
+    res = get_openai().chat.completions.create(
+        model=model_engine,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Summarize the conversation below in a few sentences,"
+                    " keeping facts that may be needed later."
+                ),
+            },
+            {"role": "user", "content": transcript},
+        ],
+        max_tokens=300,
+    )
+    record_usage(res.usage.model_dump())
+    return res.choices[0].message.content
+
+
+# Function to get the embeddings of texts, normalized so their dot product is the cosine
+def embed_texts(texts):
+    import numpy as np
+
+    # The newer embedding models may shorten the embeddings to the given dimensions
+    res = get_openai().embeddings.create(
+        model=embedding_model,
+        input=texts,
+        extra_body=(
+            {"dimensions": embedding_dimensions} if embedding_dimensions else None
+        ),
+        timeout=chat_deadline,
+    )
+    record_usage(res.usage.model_dump())
+    vectors = np.array([item.embedding for item in res.data], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# Function to get the text of a conversation turn, as embedded on the memory
+def turn_text(messages):
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+# Function to (re)map the files of a chat memory, after they changed
+# Each turn is a row of the index (its sequence number, and where its messages start and
+# end on the turns file), along with its embedding on the vectors file
+def map_memory(memory):
+    import numpy as np
+
+    rows_path = os.path.join(memory["path"], "rows.i64")
+    count = os.path.getsize(rows_path) // 24 if os.path.exists(rows_path) else 0
+    memory.update(count=count, rows=None, vectors=None)
+    if count:
+        memory["rows"] = np.memmap(rows_path, np.int64, "r", shape=(count, 3))
+        memory["vectors"] = np.memmap(
+            os.path.join(memory["path"], "vectors.f32"),
+            np.float32,
+            "r",
+            shape=(count, embedding_dimensions or 1536),
+        )
+
+
+# Function to remove every turn of a chat memory
+def reset_memory(memory):
+    memory.update(rows=None, vectors=None, synced=None, objects={})
+    for name in ("rows.i64", "vectors.f32", "turns.jsonl"):
+        path = os.path.join(memory["path"], name)
+        if os.path.exists(path):
+            os.remove(path)
+    map_memory(memory)
+
+
+# Function to open the memory of a chat, whose files are kept on the memory directory
+# The opened memories are kept, evicting the least recently used ones
+def open_memory(chat_id):
+    with memories_lock:
+        memory = memories.get(chat_id)
+        if memory is not None:
+            memories.move_to_end(chat_id)
+            return memory
+
+    path = os.path.join(memory_dir, str(chat_id))
+    os.makedirs(path, exist_ok=True)
+    memory = {"path": path, "lock": threading.Lock(), "synced": None, "objects": {}}
+    try:
+        map_memory(memory)
+    # Files left incomplete (or with other dimensions) are started over
+    except ValueError:
+        reset_memory(memory)
+    with memories_lock:
+        memory = memories.setdefault(chat_id, memory)
+        while len(memories) > conversation_cache_size:
+            memories.popitem(last=False)
+    return memory
+
+
+# Function to add turns to a chat memory, appending to its files
+# Each turn is a dict with its sequence number (the user message one) and its messages
+def append_memory(memory, turns, vectors):
+    import numpy as np
+
+    count = memory["count"]
+    start = int(memory["rows"][-1, 1] + memory["rows"][-1, 2]) if count else 0
+    lines = [
+        json.dumps(turn["messages"], ensure_ascii=False).encode() + b"\n"
+        for turn in turns
+    ]
+    rows = []
+    for turn, line in zip(turns, lines):
+        rows.append((turn["seq"], start, len(line)))
+        start += len(line)
+
+    # The rows are written last, so anything left behind by an interrupted append (past
+    # the last row) is dropped on the next one
+    with open(os.path.join(memory["path"], "turns.jsonl"), "ab") as f:
+        f.truncate(rows[0][1])
+        f.write(b"".join(lines))
+    with open(os.path.join(memory["path"], "vectors.f32"), "ab") as f:
+        f.truncate(count * vectors.shape[1] * 4)
+        f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+    with open(os.path.join(memory["path"], "rows.i64"), "ab") as f:
+        f.write(np.array(rows, dtype=np.int64).tobytes())
+    map_memory(memory)
+
+
+# Function to read turns of a chat memory, by their row indexes
+def read_memory_turns(memory, indexes):
+    turns = []
+    with open(os.path.join(memory["path"], "turns.jsonl"), "rb") as f:
+        for index in indexes:
+            seq, start, length = (int(value) for value in memory["rows"][index])
+            f.seek(start)
+            turns.append({"seq": seq, "messages": json.loads(f.read(length))})
+    return turns
+
+
+# Function to get the past turns most similar to an embedding, with their similarity
+# Only the turns between the given sequence numbers are searched (e.g. the ones older than
+# the context, and newer than the last clear)
+def search_memory(memory, vector, after_seq, before_seq):
+    import numpy as np
+
+    if not memory["count"]:
+        return []
+    rows, vectors = memory["rows"], memory["vectors"]
+    first, last = np.searchsorted(rows[:, 0], [after_seq, before_seq])
+    if first >= last:
+        return []
+
+    # Cosine similarity of every turn at once (the embeddings are normalized), keeping the
+    # top ones without sorting the whole range
+    scores = vectors[first:last] @ vector
+    k = min(memory_top_k, len(scores))
+    top = np.argpartition(scores, -k)[-k:]
+    top = top[np.argsort(scores[top])[::-1]]
+    top = top[scores[top] >= memory_min_score]
+    turns = read_memory_turns(memory, first + top)
+    for turn, score in zip(turns, scores[top]):
+        turn["score"] = float(score)
+    return turns
+
+
+# Function to get the S3 key prefix of a chat memory objects
+def memory_prefix(chat_id):
+    return f"memory/{chat_id}/"
+
+
+# Function to get the S3 key of a memory object, holding a range of turns
+# The random suffix keeps the objects of concurrent writers apart
+def memory_key(chat_id, first_seq, last_seq, count):
+    suffix = os.urandom(4).hex()
+    return (
+        f"{memory_prefix(chat_id)}{first_seq:012d}-{last_seq:012d}-{count}-{suffix}.bin"
+    )
+
+
+# Function to encode turns (and their embeddings) as a memory object: a JSON line with the
+# turns, followed by the float32 embeddings
+def encode_memory_object(turns, vectors):
+    import numpy as np
+
+    header = json.dumps(turns, ensure_ascii=False).encode() + b"\n"
+    return header + np.ascontiguousarray(vectors, dtype=np.float32).tobytes()
+
+
+# Function to decode the turns and embeddings of a memory object
+def decode_memory_object(data):
+    import numpy as np
+
+    header, _, body = data.partition(b"\n")
+    turns = json.loads(header)
+    return turns, np.frombuffer(body, dtype=np.float32).reshape(len(turns), -1)
+
+
+# Function to bring the memory of a chat up to date with the S3 bucket, where each container
+# uploads its new turns (the memory files are only local to the container)
+# The bucket is only listed when the conversation changed since the last time
+def sync_memory(chat_id, conversation):
+    memory = open_memory(chat_id)
+    with memory["lock"]:
+        # The turns from before the last clear are dropped
+        if memory["count"] and memory["rows"][0, 0] < conversation["cleared_seq"]:
+            reset_memory(memory)
+        if memory["synced"] == conversation["version"] or not os.environ.get(
+            "AWS_BUCKET"
+        ):
+            return memory
+
+        # Appending the turns of the objects newer than the memory (turns uploaded late by
+        # another container, older than the memory's last one, are skipped)
+        last_seq = int(memory["rows"][-1, 0]) if memory["count"] else 0
+        objects = {}
+        pages = get_s3().get_paginator("list_objects_v2")
+        for page in pages.paginate(
+            Bucket=os.environ["AWS_BUCKET"], Prefix=memory_prefix(chat_id)
+        ):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(memory_prefix(chat_id)) :]
+                objects[obj["Key"]] = [int(part) for part in name.split("-")[:3]]
+        for key, (first_seq, object_last_seq, count) in sorted(objects.items()):
+            if object_last_seq <= last_seq:
+                continue
+            data = (
+                get_s3()
+                .get_object(Bucket=os.environ["AWS_BUCKET"], Key=key)["Body"]
+                .read()
+            )
+            turns, vectors = decode_memory_object(data)
+            keep = [i for i, turn in enumerate(turns) if turn["seq"] > last_seq]
+            if keep:
+                append_memory(memory, [turns[i] for i in keep], vectors[keep])
+                last_seq = turns[keep[-1]]["seq"]
+        memory["objects"] = objects
+        memory["synced"] = conversation["version"]
+    return memory
+
+
+# Function to merge the small objects of a chat memory (each one with the turns uploaded at
+# once) into a single one, once they hold enough turns, so the bucket isn't filled with them
+# The merged turns are taken from the memory files, as long as all of them are there
+def merge_memory_objects(chat_id, memory):
+    import numpy as np
+
+    small = {
+        key: ranges
+        for key, ranges in memory["objects"].items()
+        if ranges[2] < memory_chunk
+    }
+    if sum(ranges[2] for ranges in small.values()) < memory_chunk:
+        return
+    first_seq = min(ranges[0] for ranges in small.values())
+    last_seq = max(ranges[1] for ranges in small.values())
+    first, last = np.searchsorted(memory["rows"][:, 0], [first_seq, last_seq + 1])
+    if last - first != sum(ranges[2] for ranges in small.values()):
+        return
+
+    key = memory_key(chat_id, first_seq, last_seq, last - first)
+    turns = read_memory_turns(memory, range(first, last))
+    get_s3().put_object(
+        Bucket=os.environ["AWS_BUCKET"],
+        Key=key,
+        Body=encode_memory_object(turns, memory["vectors"][first:last]),
+    )
+    get_s3().delete_objects(
+        Bucket=os.environ["AWS_BUCKET"],
+        Delete={"Objects": [{"Key": key} for key in small]},
+    )
+    for small_key in small:
+        memory["objects"].pop(small_key)
+    memory["objects"][key] = [first_seq, last_seq, last - first]
+
+
+# Function to add a saved conversation turn to the chat memory, along with its embedding
+# The turn is also uploaded to the S3 bucket, for the other containers
+def remember_turn(chat_id, conversation, user_message, bot_message):
     try:
-        # Fetch the image from the URL
-        response = requests.get(url)
+        vectors = embed_texts([turn_text([user_message, bot_message])])
+        turns = [
+            {
+                "seq": user_message["seq"],
+                "messages": [
+                    {"role": m["role"], "content": m["content"]}
+                    for m in (user_message, bot_message)
+                ],
+            }
+        ]
+        memory = open_memory(chat_id)
+        with memory["lock"]:
+            # The memory stays in sync if it was before the turn was saved
+            up_to_date = memory["synced"] == user_message["seq"] - 1
+            append_memory(memory, turns, vectors)
+            if os.environ.get("AWS_BUCKET"):
+                seq = user_message["seq"]
+                key = memory_key(chat_id, seq, seq, 1)
+                get_s3().put_object(
+                    Bucket=os.environ["AWS_BUCKET"],
+                    Key=key,
+                    Body=encode_memory_object(turns, vectors),
+                )
+                memory["objects"][key] = [seq, seq, 1]
+                merge_memory_objects(chat_id, memory)
+            if up_to_date:
+                memory["synced"] = conversation["version"]
+    # The memory is an addition to the context, so a failure is only logged
+    except Exception as e:
+        logger.error(f"Failed to remember the turn of chat {chat_id}: {e}")
 
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Encode the image content as base64
-            base64_image = base64.b64encode(response.content).decode("utf-8")
-            return base64_image
-        else:
-            logger.error(f"Failed to fetch image. Status code: {response.status_code}")
+
+# Function to clear the memory of a chat, on the memory files and the S3 bucket
+def clear_memory(chat_id):
+    memory = open_memory(chat_id)
+    with memory["lock"]:
+        reset_memory(memory)
+    if os.environ.get("AWS_BUCKET"):
+        keys = []
+        pages = get_s3().get_paginator("list_objects_v2")
+        for page in pages.paginate(
+            Bucket=os.environ["AWS_BUCKET"], Prefix=memory_prefix(chat_id)
+        ):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        for i in range(0, len(keys), 1000):
+            get_s3().delete_objects(
+                Bucket=os.environ["AWS_BUCKET"],
+                Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+            )
+
+
+# Function to add the past turns most similar to the new message to the context (right
+# before the recent messages), as long as they're older than the context
+def add_recalled_turns(chat_id, conversation, history, context):
+    try:
+        memory = sync_memory(chat_id, conversation)
+        vector = embed_texts([history[-1]["content"]])[0]
+
+        # The oldest message of the history on the context (the newest messages may not
+        # have a sequence number yet)
+        pinned = sum(1 for m in context if m["role"] == "system")
+        recent = history[len(history) - (len(context) - pinned) :]
+        before_seq = min(
+            (m["seq"] for m in recent if "seq" in m),
+            default=conversation["version"] + 1,
+        )
+        turns = search_memory(memory, vector, conversation["cleared_seq"], before_seq)
+    # The memory is an addition to the context, so a failure is only logged
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
-    # If no image could be encoded, we return Nne
-    return None
+        logger.error(f"Failed to recall the turns of chat {chat_id}: {e}")
+        return context
 
+    # Adding the most similar turns that fit the memory budget, in the conversation order
+    lines, used = [], 0
+    for turn in turns:
+        text = turn_text(turn["messages"])
+        tokens = count_tokens(text)
+        if lines and used + tokens > memory_token_budget:
+            break
+        used += tokens
+        lines.append((turn["seq"], text))
+    if not lines:
+        return context
+    recalled = {
+        "role": "system",
+        "content": "Relevant earlier messages of the conversation:\n\n"
+        + "\n\n".join(text for _, text in sorted(lines)),
+    }
+    return context[:pinned] + [recalled] + context[pinned:]
 
-# This function checks if the message was sent by the admin
-def is_admin_message(message):
-    # Comparing the user ID and the defined admin chat ID
-    if message["chat"]["id"] != int(os.environ["ADMIN_CHAT_ID"]):
-        bot.send_message(
-            message["chat"]["id"],
-            "Currently, only the admin has access to this feature.",
+
+# Function to build the conversation context that fits the token budget
+# The newest messages are kept, along with the pinned system prompt and the rolling summary
+def build_context(history, summary=None, budget=context_token_budget):
+    # Defining the pinned messages at the start of the context
+    pinned = []
+    if system_prompt:
+        pinned.append({"role": "system", "content": system_prompt})
+    if summary:
+        pinned.append(
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {summary}",
+            }
         )
-        return False
-    return True
+    used = sum(count_tokens(m["content"]) for m in pinned)
 
+    # Adding the newest messages while they fit the budget (the last one is always sent)
+    selected = []
+    for message in reversed(history):
+        tokens = message.get("tokens") or count_tokens(message["content"])
+        if selected and used + tokens > budget:
+            break
+        used += tokens
+        selected.append({"role": message["role"], "content": message["content"]})
+    selected.reverse()
 
-# Function to get messages from DynamoDN table
-def get_dynamodb_messages():
-    # Initializing DynamoDB instance and getting table
-    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
-    table = dynamodb.Table(os.environ["AWS_DYNAMODB"])
-    scan = table.scan()
-    # Getting messages formatted as dict
-    dynamo_messages = scan["Items"][0]["messages"]
+    # Returning the context and the messages evicted from it
+    evicted = history[: len(history) - len(selected)]
+    return pinned + selected, evicted
 
-    # Returning resulting dict
-    return dynamo_messages
 
+# Function to get the conversation context to be sent to the chat model
+def get_conversation_context(chat_id, history, conversation):
+    # If summaries are disabled, evicted messages are simply left out
+    if not summarize_evicted:
+        return build_context(history)[0]
 
-# Function to update the messages list on DynamoDB table
-def update_dynamo_messages(message):
-    # Initializing DynamoDB instance and getting table
-    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
-    table = dynamodb.Table(os.environ["AWS_DYNAMODB"])
+    # Otherwise, new evicted messages are folded into the rolling summary
+    summary = conversation["summary"]
+    context, evicted = build_context(history, summary)
+    new_evicted = [m for m in evicted if m.get("seq", 0) > conversation["summary_seq"]]
+    if new_evicted:
+        summary = summarize_messages(summary, new_evicted)
+        update_dynamo_summary(chat_id, summary, new_evicted[-1]["seq"])
+        conversation["summary"] = summary
+        conversation["summary_seq"] = new_evicted[-1]["seq"]
+        context = build_context(history[len(evicted) :], summary)[0]
+    return context
 
-    # Getting the required item with the list of messages to be updated
-    res = table.get_item(Key={"field": "messages"})
-    item = res["Item"]
 
-    # Appending the new message to the list
-    # Must be formatted as one of the following:
-    # {"role": "user", "content": "Text content'}
-    # {"role": "assistant", "content": "Text content'}
-    item["messages"].append(message)
+# Function to record the latency of a model request, keeping the most recent ones
+def record_model_latency(model, seconds):
+    with latencies_lock:
+        latencies = model_latencies.setdefault(model, deque(maxlen=100))
+        latencies.append(seconds)
 
-    # Updating item in the table
-    table.put_item(Item=item)
 
+# Function to get after how long (in seconds) a request to a model is hedged
+# Returns None if hedging is disabled, or there are not enough recorded latencies yet
+def get_hedge_delay(model):
+    if not hedge_percentile:
+        return None
+    with latencies_lock:
+        latencies = sorted(model_latencies.get(model, ()))
+    if len(latencies) < hedge_min_samples:
+        return None
+    index = min(len(latencies) - 1, int(len(latencies) * hedge_percentile / 100))
+    return max(latencies[index], hedge_min_delay)
 
-# Function to clear previous saved messages on DynamoDB table
-def clear_dynamo_messages():
-    # Initializing DynamoDB instance and getting table
-    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
-    table = dynamodb.Table(os.environ["AWS_DYNAMODB"])
 
-    # Getting the required item with the list of messages to be updated
-    res = table.get_item(Key={"field": "messages"})
-    item = res["Item"]
+# Function to make a model request within a deadline, hedging it if it's slower than usual
+# The request function receives the model and its timeout, and the first response is used
+# (a late one is discarded, as its call can't be interrupted, but its timeout ends with the
+# deadline, and the discard function, if given, still gets it, e.g. to charge its usage)
+def hedged_request(
+    request, model, fallback_model=None, deadline=chat_deadline, discard=None
+):
+    expires = time.monotonic() + deadline
+    finished = threading.Event()
+
+    # Function to make one of the requests, recording its latency
+    def attempt(model):
+        hedged_attempt.finished = finished
+        try:
+            started = time.monotonic()
+            result = request(model, max(expires - started, 0.001))
+            record_model_latency(model, time.monotonic() - started)
+            return result
+        finally:
+            hedged_attempt.finished = None
+
+    # Function to pass the response of a request that wasn't used to the discard function
+    def discarded(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            discard(future.result())
+        except Exception as e:
+            logger.error(f"Failed to discard a {model} response: {e}")
+
+    futures = [model_executor.submit(attempt, model)]
+    pending = set(futures)
+    hedge = None
+    delay = get_hedge_delay(model)
+    if delay is not None and delay < deadline:
+        # If the request is slower than usual, the hedge one is sent
+        if not wait(pending, timeout=delay).done:
+            hedge = model_executor.submit(attempt, fallback_model or model)
+            futures.append(hedge)
+            pending.add(hedge)
+            hedge_stats["sent"] += 1
+            logger.info(f"Hedged the {model} request after {delay:.3f}s")
+
+    # Waiting for the first successful response, until the deadline
+    # Once it's over, the other requests are discarded
+    error = None
+    winner = None
+    try:
+        while pending:
+            remaining = max(expires - time.monotonic(), 0)
+            done, pending = wait(
+                pending, timeout=remaining, return_when=FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    hedge_stats["won"] += 1
+                winner = future
+                return result
+        if error is not None:
+            raise error
+        raise TimeoutError(f"The {model} request exceeded its deadline of {deadline}s")
+    finally:
+        finished.set()
+        if discard:
+            for future in futures:
+                if future is not winner:
+                    future.add_done_callback(discarded)
+
+
+# Function to stream a chat completion to the user, editing a message as the tokens arrive
+# The edits are throttled (Telegram limits the edits per chat) and long responses
+# continue on follow-up messages, returning the complete response at the end
+def stream_completion(chat_id, messages, model=model_engine):
+    # Sending a placeholder message right away, to be updated with the response
+    started = time.monotonic()
+    sent = get_bot().send_message(chat_id, "...")
+    stream = get_openai().chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        timeout=chat_deadline,
+    )
+
+    # Response received so far, where the current message starts on it and what it shows
+    response = ""
+    offset = 0
+    shown = ""
+    last_edit = 0
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            response += delta
+
+            # If the current message is full, we finish it and continue on a new one
+            # (unless it already shows its full text, which Telegram wouldn't take as an edit)
+            while len(response) - offset > telegram_message_limit:
+                end = offset + telegram_message_limit
+                if response[offset:end] != shown:
+                    try:
+                        get_bot().edit_message_text(
+                            response[offset:end], chat_id, sent.message_id
+                        )
+                    # A failed edit only leaves this message short, so the reply goes on
+                    except Exception as e:
+                        logger.info(f"Failed to finish the streamed message: {e}")
+                offset = end
+                shown = response[offset : offset + telegram_message_limit]
+                sent = get_bot().send_message(chat_id, shown)
+                last_edit = time.monotonic()
+
+            # Otherwise, we update the current message if the edit interval has passed
+            interval_passed = time.monotonic() - last_edit >= stream_edit_interval
+            if interval_passed and response[offset:] != shown:
+                if not shown:
+                    logger.info(
+                        f"Time to first visible token: {time.monotonic() - started:.3f}s"
+                    )
+                shown = response[offset:]
+                last_edit = time.monotonic()
+                try:
+                    get_bot().edit_message_text(shown, chat_id, sent.message_id)
+                # A failed intermediate edit is fine, as the next one carries the full text
+                except Exception as e:
+                    logger.info(f"Failed to edit the streamed message: {e}")
+
+    # The stream's connection is released even if the reply fails midway
+    finally:
+        stream.response.close()
+
+    # Making sure the final text is shown
+    if response[offset:] != shown:
+        get_bot().edit_message_text(
+            response[offset:] or "(empty response)", chat_id, sent.message_id
+        )
+
+    # Returning the complete response
+    return response
+
+
+# Function to answer the conversation, sending the response to the user
+# Returns the response content, to be saved to the conversation, and the request metadata
+# If a claim function is given, the response is only sent if it succeeds (otherwise, the
+# messages were superseded by a newer one, and the content is None)
+# If a charge function is given, it gets the tokens of a hedged response that wasn't used
+def reply_chat_completion(
+    chat_id, messages, use_cache=True, model=model_engine, claim=None, charge=None
+):
+    # Identical requests are answered from the cache
+    key = cache_key("chat", model=model, messages=messages)
+    cached = get_cached_result("chat", key) if use_cache else None
+    if cached:
+        if claim and not claim():
+            return None, None
+        get_bot().send_message(chat_id, cached["content"])
+        return cached["content"], {"model": model, "cached": True}
+
+    # If enabled, the response is streamed to the user as it's generated
+    # (the token usage isn't sent on streamed responses)
+    if stream_responses:
+        # A streamed response can't be superseded once it's shown, so it's claimed first
+        if claim and not claim():
+            return None, None
+        with span("openai.stream"):
+            content = stream_completion(chat_id, messages, model)
+        metadata = {"model": model}
+
+    # Otherwise, we wait for the complete response
+    else:
+        # Making an API request to the OpenAI API (hedged, if it's slower than usual)
+        res = hedged_request(
+            lambda model, timeout: get_openai().chat.completions.create(
+                model=model, messages=messages, timeout=timeout
+            ),
+            model,
+            hedge_model,
+            discard=charge and (lambda res: charge(res.usage.total_tokens)),
+        )
+        content = res.choices[0].message.content
+        metadata = {"model": res.model, "usage": res.usage.model_dump()}
+        record_usage(metadata["usage"])
 
-    # Clearing the list of items
-    item["messages"] = []
+        # If a newer message arrived meanwhile, the response is dropped
+        if claim and not claim():
+            return None, metadata
 
-    # Updating item in the table
-    table.put_item(Item=item)
+        # If desired, we can add the total tokens used on the request to the user
+        get_bot().send_message(
+            chat_id, content + f"\n\nTotal Tokens: {res.usage.total_tokens}"
+        )
 
-    # Clearing the local messages list
-    global messages
-    messages = []
+    # Saving the response to the cache, for identical requests
+    if use_cache:
+        set_cached_result(key, {"content": content})
+    return content, metadata
 
 
 # Initial/welcome message handler
 def send_welcome(message):
-    bot.send_message(
+    get_bot().send_message(
         message["chat"]["id"],
         f"Hello, {message['chat']['first_name']}, welcome to the personal ChatGPT Telegram Chatbot!",
     )
@@ -115,226 +2279,923 @@ def send_welcome(message):
 
 # Command to clear current conversation
 def clear_messages(message):
-    # Checking if it's an admin message
-    if is_admin_message(message):
+    # Checking if it's an allowed message
+    if is_allowed_message(message):
         # Clearing the current conversation
-        clear_dynamo_messages()
-        bot.send_message(message["chat"]["id"], "Conversation was cleared!")
+        clear_dynamo_messages(message["chat"]["id"])
+        get_bot().send_message(message["chat"]["id"], "Conversation was cleared!")
+
+
+# Command to export the whole conversation, as a gzip-compressed JSONL file
+def export_messages(message):
+    # Checking if it's an allowed message
+    if is_allowed_message(message):
+        chat_id = message["chat"]["id"]
+        get_bot().send_document(
+            chat_id,
+            export_conversation(chat_id),
+            visible_file_name=f"conversation-{chat_id}.jsonl.gz",
+        )
+
+
+# Function to parse the options of an image request, which may start with the sizes of the
+# images (e.g. "1792x1024") and the number of variants of each size (e.g. "x3")
+# Returns the prompt and the (size, variant) of each image to generate
+def parse_image_request(text):
+    words = text.split()
+    sizes, variants = [], 1
+    while words:
+        if words[0] in image_sizes:
+            sizes.append(words.pop(0))
+        elif re.fullmatch(r"x[1-9]", words[0]):
+            variants = int(words.pop(0)[1:])
+        else:
+            break
+    images = [(size, i) for size in sizes or image_sizes[:1] for i in range(variants)]
+    return " ".join(words), images[:image_max_images]
+
+
+# Function to generate an image, returning its URL and the revised prompt (as a caption)
+# Identical prompts (and variants) are answered from the cache
+def generate_image(prompt, size, variant, use_cache):
+    params = {
+        "model": "dall-e-3",
+        "prompt": prompt,
+        "size": size,
+        "quality": "standard",
+        "n": 1,
+    }
+    key = cache_key("image", variant=variant, **params)
+    result = get_cached_result("image", key) if use_cache else None
+    if result is None:
+        # Requesting the image generation
+        response = get_openai().images.generate(**params)
+        result = {
+            "url": response.data[0].url,
+            "caption": response.data[0].revised_prompt,
+        }
+        if use_cache:
+            set_cached_result(key, result, image_cache_ttl)
+    return result
+
+
+# Function to run an image job, generating its images at the same time and sending them
+# to the chat (as an album, if there's more than one)
+# The upload_photo action (sent when the job was requested) is kept on while the images are
+# generated, and the results are dropped if the job is cancelled meanwhile
+def run_image_job(chat_id, job_id, prompt, images, use_cache):
+    executor = ThreadPoolExecutor(max_workers=len(images))
+    try:
+        futures = [
+            executor.submit(generate_image, prompt, size, variant, use_cache)
+            for size, variant in images
+        ]
+        done, pending = wait(futures, timeout=4)
+        while pending:
+            if not is_image_job_active(chat_id, job_id):
+                return
+            # The chat action lasts for 5 seconds, or until a message is sent
+            get_bot().send_chat_action(chat_id, "upload_photo")
+            done, pending = wait(pending, timeout=4)
+        if not is_image_job_active(chat_id, job_id):
+            return
+
+        # Sending the generated images back to the user, and the errors of the failed ones
+        results, errors = [], []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if len(results) == 1:
+            get_bot().send_photo(
+                chat_id, photo=results[0]["url"], caption=results[0]["caption"]
+            )
+        elif results:
+            from telebot.types import InputMediaPhoto
+
+            get_bot().send_media_group(
+                chat_id,
+                [InputMediaPhoto(r["url"], caption=r["caption"]) for r in results],
+            )
+        if errors:
+            get_bot().send_message(
+                chat_id,
+                f"Error trying to generate {len(errors)} of the images: {errors[0]}",
+            )
+    # If something goes wrong, we'll inform about the error
+    except Exception as e:
+        get_bot().send_message(chat_id, f"Error trying to generate the image: {e}")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        finish_image_job(chat_id, job_id)
+
+
+# Function to get the Lambda client, used to run the image jobs on their own invocation
+def get_lambda():
+    global lambda_client
+    if lambda_client is None:
+        import boto3
+
+        lambda_client = boto3.client("lambda", region_name=os.environ["AWS_REGION"])
+        meter_aws_client(lambda_client)
+    return lambda_client
+
+
+# Function to run an image job on a new (asynchronous) invocation of this function
+# On queue mode, the worker function invokes itself, so the job doesn't hold the next
+# updates of its batch (and of the chat) while the images are generated
+def invoke_image_job(job):
+    get_lambda().invoke(
+        FunctionName=os.environ["AWS_LAMBDA_FUNCTION_NAME"],
+        InvocationType="Event",
+        Payload=json.dumps({"image_job": job}),
+    )
 
 
 # Image generation request handler
+# The image job is run on a new invocation, so the update is answered right away
 def request_image(message):
-    # Checking if it's an admin message
-    if is_admin_message(message):
+    # Checking if it's an allowed message
+    if is_allowed_message(message):
+        chat_id = message["chat"]["id"]
         # Getting the text from the message
         text = message["text"].strip()
         # If no content was provided
         if text == "/image":
-            bot.send_message(
-                message["chat"]["id"],
+            get_bot().send_message(
+                chat_id,
                 "Please provide a prompt for the image generation.",
             )
-        # If a prompt was provided
-        else:
-            # We'll extract the prompt from the message text
-            prompt = text.replace("/image", "")
-
-            # If the content is too short
-            if len(prompt) < 10:
-                bot.send_message(
-                    message["chat"]["id"], "Prompt is too short (min length: 10 chars)."
-                )
+            return
 
-            # If everything is ok, we'll try to generate the image and return to the user
-            else:
-                try:
-                    # Requesting the image generation
-                    response = openai.images.generate(
-                        model="dall-e-3",
-                        prompt=prompt,
-                        size="1024x1024",
-                        quality="standard",
-                        n=1,
-                    )
-                    # Getting the image URL
-                    image_url = response.data[0].url
-                    # Getting the revised prompt to be sent as a caption
-                    caption = response.data[0].revised_prompt
-                    # Send the generated image back to the user
-                    bot.send_photo(
-                        message["chat"]["id"],
-                        photo=image_url,
-                        caption=caption,
-                    )
-                # If something goes wrong, we'll inform about the error
-                except Exception as e:
-                    bot.send_message(
-                        message["chat"]["id"],
-                        f"Error trying to generate the image: {e}",
-                    )
+        # We'll extract the prompt and the images options from the message text
+        prompt, use_cache = split_cache_opt_out(text.replace("/image", ""))
+        prompt, images = parse_image_request(prompt)
 
+        # If the content is too short
+        if len(prompt) < 10:
+            get_bot().send_message(
+                chat_id, "Prompt is too short (min length: 10 chars)."
+            )
+            return
 
-# Visual input messages handler
-def visual_input(message):
-    try:
-        # Checking if a image caption was provided
-        if message["caption"] is None:
-            bot.send_message(
-                message["chat"]["id"],
-                'Please, provide some context for the image as captions, e.g.: "What this image represents?"',
+        # If the chat has too many images being generated
+        job_id = start_image_job(chat_id)
+        if job_id is None:
+            get_bot().send_message(
+                chat_id,
+                f"Up to {image_jobs_per_chat} image requests may run at the same time,"
+                " please wait for them (or /cancel them).",
             )
             return
 
-        # Getting the image path
-        file_info = bot.get_file(message["photo"][-1]["file_id"])
+        # If everything is ok, we'll generate the images and send them to the user
+        get_bot().send_chat_action(chat_id, "upload_photo")
+        job = {
+            "chat_id": chat_id,
+            "job_id": job_id,
+            "prompt": prompt,
+            "images": images,
+            "use_cache": use_cache,
+        }
+        # Out of Lambda (e.g. while testing), the job runs here
+        if not os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+            run_image_job(**job)
+            return
+        try:
+            invoke_image_job(job)
+        except Exception as e:
+            finish_image_job(chat_id, job_id)
+            get_bot().send_message(chat_id, f"Error trying to generate the image: {e}")
+
 
-        # Creating the image URL for the photo
-        image_url = f"https://api.telegram.org/file/bot{os.environ['BOT_TOKEN']}/{file_info.file_path}"
+# Command to cancel the image requests of the chat
+def cancel_images(message):
+    chat_id = message["chat"]["id"]
+    count = cancel_image_jobs(chat_id)
+    get_bot().send_message(
+        chat_id,
+        (
+            f"Cancelled {count} image request(s)."
+            if count
+            else "No image requests to cancel."
+        ),
+    )
 
-        # Getting the image encoded as base64
-        base64_image = url_to_base64(image_url)
 
-        # If no image was returned
-        if base64_image is None:
-            bot.send_message(message["chat"]["id"], "The image could not be retrieved.")
-            return
+# Function to download a photo sent by the user, encoded as base64 (or None if it failed)
+def download_photo(photo):
+    # Processed photos are reused (e.g. when sent again, or re-attached on a later turn)
+    image = get_cached_image(photo["file_unique_id"])
+    if image is not None:
+        return image
+
+    # Getting the image path
+    file_info = get_bot().get_file(photo["file_id"])
+
+    # Creating the image URL for the photo
+    from telebot import apihelper
+
+    image_url = apihelper.FILE_URL.format(os.environ["BOT_TOKEN"], file_info.file_path)
+
+    # Getting the image encoded as base64
+    downscale = max(photo["width"], photo["height"]) > vision_max_side
+    with span("url_to_base64"):
+        image = url_to_base64(image_url, downscale)
+    if image is not None:
+        set_cached_image(photo["file_unique_id"], image)
+    return image
+
+
+# Function to get the images of photos encoded as base64, downloading them at the same time
+def download_photos(photos):
+    if not photos:
+        return []
+    with ThreadPoolExecutor(max_workers=len(photos)) as executor:
+        return list(executor.map(download_photo, photos))
 
-        # Defining the headers for the request
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}",
+
+# Function to get the content of a message with images (encoded as base64) for the vision model
+def image_content(text, base64_images):
+    return [{"type": "text", "text": text}] + [
+        {
+            "type": "image_url",
+            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
         }
+        for base64_image in base64_images
+    ]
 
-        # Defining the payload for the visual input completion request
-        payload = {
-            # Defining the required model for the request
-            "model": "gpt-4-vision-preview",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        # Including the message sent by the user
-                        {"type": "text", "text": message["caption"]},
-                        # Including the image sent by the user
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            "max_tokens": 300,
+
+# Function to request the vision model to answer a caption about one or more photos
+# The earlier messages of the context (which may have images of their own) go before it
+# Returns the response content and the request metadata (or None if it failed,
+# after informing the user), and a charge function, if given, gets the tokens of a hedged
+# response that wasn't used
+def request_visual_completion(chat_id, caption, photos, context=(), charge=None):
+    # Getting the images encoded as base64
+    base64_images = download_photos(photos)
+
+    # If some image was not returned
+    if None in base64_images:
+        get_bot().send_message(chat_id, "The image could not be retrieved.")
+        return None, None
+
+    # Defining the headers for the request
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}",
+    }
+
+    # Defining the payload for the visual input completion request
+    payload = {
+        "messages": list(context)
+        + [
+            # Including the message and the images sent by the user
+            {"role": "user", "content": image_content(caption, base64_images)}
+        ],
+        "max_tokens": 300,
+    }
+
+    # Function to make the request to the API, with the required model
+    def request(model, timeout):
+        res = get_http_session().post(
+            f"{openai_base_url}chat/completions",
+            headers=headers,
+            json={"model": model, **payload},
+            timeout=(http_connect_timeout, timeout),
+        )
+        res.raise_for_status()
+        return res.json()
+
+    # Making the request (hedged, if it's slower than usual)
+    try:
+        result = hedged_request(
+            request,
+            vision_model,
+            vision_hedge_model,
+            vision_deadline,
+            discard=charge and (lambda result: charge(result["usage"]["total_tokens"])),
+        )
+    # If an error occurs while requesting the API (or it took too long)
+    except Exception as e:
+        logger.error(f"Vision request failed: {e}")
+        get_bot().send_message(chat_id, "There was an error while parsing the image.")
+        return None, None
+
+    # Returning the API response content and the request metadata
+    metadata = {"model": result["model"], "usage": result["usage"]}
+    record_usage(result["usage"])
+    return result["choices"][0]["message"]["content"], metadata
+
+
+# Function to re-attach the photos of the recent turns to their messages on the context, so
+# a follow-up message about them is answered by the vision model (the photos are usually
+# still on the image cache, so no other download is needed)
+# Returns the context with the images, or None if no recent message on it has photos
+def attach_recent_images(history, context):
+    # The messages of the history on the context (after the pinned ones), and the first one
+    # recent enough to have its photos re-attached
+    pinned = sum(1 for m in context if m["role"] == "system")
+    offset = len(history) - (len(context) - pinned)
+    first = len(history) - 1 - 2 * image_followup_turns
+    indexes = [
+        i for i in range(max(offset, first), len(history)) if history[i].get("images")
+    ]
+    if not indexes:
+        return None
+
+    # Getting the images of every message at once
+    photos = [image for i in indexes for image in history[i]["images"]]
+    base64_images = download_photos(photos)
+    if None in base64_images:
+        logger.error("The images of the recent turns could not be retrieved")
+        return None
+
+    context = list(context)
+    for i in indexes:
+        count = len(history[i]["images"])
+        message = context[pinned + i - offset]
+        context[pinned + i - offset] = {
+            "role": message["role"],
+            "content": image_content(message["content"], base64_images[:count]),
+        }
+        base64_images = base64_images[count:]
+    return context
+
+
+# Function to answer a follow-up message about the photos of the recent turns, whose context
+# has them re-attached, with the vision model
+# Returns the response content and the request metadata (the response is None if it wasn't
+# sent, e.g. if a newer message superseded it)
+def reply_image_followup(message, context, claim=None):
+    chat_id = message["chat"]["id"]
+
+    # Checking if the user's quota admits the request (the vision model has no fallback)
+    estimate = estimate_request_tokens({"messages": context}) + 300
+    if admit_request(message, estimate, fallback=False) is None:
+        return None, None
+
+    content, metadata = request_visual_completion(
+        chat_id,
+        context[-1]["content"],
+        [],
+        context[:-1],
+        charge=lambda tokens: charge_quota(message, tokens),
+    )
+    if content is None:
+        return None, None
+    charge_quota(message, get_used_tokens(metadata, estimate, content))
+
+    # If a newer message arrived meanwhile, the response is dropped
+    if claim and not claim():
+        return None, metadata
+    get_bot().send_message(chat_id, content)
+    return content, metadata
+
+
+# Function to add a photo of an album to the buffer on the DynamoDB table, returning when
+# it was received (in microseconds)
+def buffer_album_photo(message):
+    received = time.time_ns() // 1000
+    get_table().put_item(
+        Item={
+            "pk": f"album#{message['media_group_id']}",
+            "sk": message["message_id"],
+            "message": json.dumps(message),
+            "received": received,
+            "expires_at": int(time.time()) + update_claim_ttl,
         }
+    )
+    return received
+
 
-        # Making the request to the API
-        res = requests.post(
-            "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+# Function to collect the photos of an album, sent on separate updates (each one processed
+# by its own invocation)
+# Every invocation buffers its photo and waits for the album window: only the one with the
+# last photo received claims the album and gets its photos (the others get None)
+def collect_album(message):
+    table = get_table()
+
+    from boto3.dynamodb.conditions import Key
+
+    # Skipping the photos of an album that was already answered
+    album_key = f"album#{message['media_group_id']}"
+    claim = table.get_item(Key={"pk": album_key, "sk": 0}, ConsistentRead=True)
+    if "Item" in claim:
+        logger.info(f"Album {message['media_group_id']} was already answered")
+        return None
+
+    received = buffer_album_photo(message)
+    time.sleep(album_window)
+    res = table.query(
+        KeyConditionExpression=Key("pk").eq(album_key) & Key("sk").gt(0),
+        ConsistentRead=True,
+    )
+    if any(int(item["received"]) > received for item in res["Items"]):
+        return None
+
+    # Claiming the album, so it's answered only once
+    try:
+        table.put_item(
+            Item={
+                "pk": album_key,
+                "sk": 0,
+                "expires_at": int(time.time()) + update_claim_ttl,
+            },
+            ConditionExpression="attribute_not_exists(pk)",
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"Album {message['media_group_id']} was already answered")
+        return None
+    return [json.loads(item["message"]) for item in res["Items"]]
+
+
+# Function to add a text message of a chat to the buffer on the DynamoDB table, returning
+# when it was received (in microseconds), which is also set as the chat's latest message
+def buffer_fragment(message):
+    table = get_table()
+    fragments_key = f"fragments#{message['chat']['id']}"
+    received = time.time_ns() // 1000
+    expires_at = int(time.time()) + update_claim_ttl
+
+    # A message already buffered (e.g. by the worker, along with its batch) keeps its time
+    try:
+        table.put_item(
+            Item={
+                "pk": fragments_key,
+                "sk": message["message_id"],
+                "text": message["text"],
+                "received": received,
+                "expires_at": expires_at,
+            },
+            ConditionExpression="attribute_not_exists(sk)",
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        item = table.get_item(
+            Key={"pk": fragments_key, "sk": message["message_id"]},
+            ConsistentRead=True,
+        )["Item"]
+        return int(item["received"])
+
+    try:
+        table.update_item(
+            Key={"pk": fragments_key, "sk": 0},
+            UpdateExpression="SET latest = :received, expires_at = :expires_at",
+            ConditionExpression="attribute_not_exists(latest) OR latest < :received",
+            ExpressionAttributeValues={
+                ":received": received,
+                ":expires_at": expires_at,
+            },
         )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+    return received
+
+
+# Function to collect the text messages of a chat sent in a quick succession (each one
+# processed by its own invocation)
+# Every invocation buffers its message and waits for the coalesce window: only the one with
+# the latest message gets the texts of the buffered ones (the others get None), along with
+# the function claiming them before they're answered, which fails if a newer message
+# arrived meanwhile (so the newer one answers all of them)
+def collect_fragments(message):
+    table = get_table()
 
-        # If an error occurs while requesting the API
-        if res.status_code != 200:
-            bot.send_message(
-                message["chat"]["id"], "There was an error while parsing the image."
+    from boto3.dynamodb.conditions import Key
+
+    # If a newer message was already buffered, there's no need to wait for the window
+    fragments_key = f"fragments#{message['chat']['id']}"
+    received = buffer_fragment(message)
+
+    def get_latest():
+        marker = table.get_item(
+            Key={"pk": fragments_key, "sk": 0}, ConsistentRead=True
+        ).get("Item", {})
+        return int(marker.get("latest", 0))
+
+    if get_latest() != received:
+        return None
+    time.sleep(coalesce_window)
+    if get_latest() != received:
+        return None
+    items = table.query(
+        KeyConditionExpression=Key("pk").eq(fragments_key) & Key("sk").gt(0),
+        ConsistentRead=True,
+    )["Items"]
+
+    # Function to claim the buffered messages, removing them along with the check that
+    # this is still the latest message
+    def claim():
+        try:
+            table.meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        "ConditionCheck": {
+                            "TableName": table.name,
+                            "Key": {"pk": fragments_key, "sk": 0},
+                            "ConditionExpression": "latest = :received",
+                            "ExpressionAttributeValues": {":received": received},
+                        }
+                    }
+                ]
+                + [
+                    {
+                        "Delete": {
+                            "TableName": table.name,
+                            "Key": {"pk": fragments_key, "sk": item["sk"]},
+                        }
+                    }
+                    for item in items
+                ]
+            )
+        except table.meta.client.exceptions.TransactionCanceledException:
+            logger.info(f"Messages of chat {message['chat']['id']} were superseded")
+            return False
+        return True
+
+    return [item["text"] for item in items], claim
+
+
+# Visual input messages handler
+# The photos of an album are answered together, once all of them arrived
+def visual_input(message):
+    if not is_allowed_message(message):
+        return
+    if "media_group_id" in message:
+        messages = collect_album(message)
+        if messages:
+            answer_photos(messages)
+    else:
+        answer_photos([message])
+
+
+# Function to answer the caption of one or more photos (e.g. an album) with the vision model
+def answer_photos(messages):
+    chat_id = messages[0]["chat"]["id"]
+    try:
+        # Checking if a image caption was provided (on an album, only a photo has it)
+        captions = [m["caption"] for m in messages if m.get("caption")]
+        if not captions:
+            get_bot().send_message(
+                chat_id,
+                'Please, provide some context for the image as captions, e.g.: "What this image represents?"',
             )
             return
 
-        # Replying with the API response contet
-        bot.send_message(
-            message["chat"]["id"], res.json()["choices"][0]["message"]["content"]
+        # Checking if the cache should be skipped for this request
+        caption, use_cache = split_cache_opt_out(captions[0])
+
+        # Selecting the photo sizes to be sent to the model
+        photos = [select_photo_size(m["photo"]) for m in messages]
+
+        # Checking if the user's quota admits the request (the vision model has no fallback)
+        estimate = count_tokens(caption) + len(photos) * 765 + 300
+        if admit_request(messages[0], estimate, fallback=False) is None:
+            return
+
+        # The same caption on the same photos is answered from the cache
+        key = cache_key(
+            "vision",
+            model=vision_model,
+            caption=caption,
+            photo=[photo["file_unique_id"] for photo in photos],
+            max_tokens=300,
         )
+        cached = get_cached_result("vision", key) if use_cache else None
+        if cached:
+            content = cached["content"]
+            metadata = {"model": vision_model, "cached": True}
+        else:
+            content, metadata = request_visual_completion(
+                chat_id,
+                caption,
+                photos,
+                charge=lambda tokens: charge_quota(messages[0], tokens),
+            )
+            if content is None:
+                return
+            charge_quota(messages[0], get_used_tokens(metadata, estimate, content))
+            if use_cache:
+                set_cached_result(key, {"content": content})
+
+        # Replying with the API response contet
+        get_bot().send_message(chat_id, content)
 
-        # Defining user message for the conversation
+        # Defining user message for the conversation (referencing its photos)
         user_message = {
             "role": "user",
-            "content": message["caption"],
+            "content": caption,
+            "images": [photo_reference(photo) for photo in photos],
         }
         # Defining bot response for the conversation
         bot_message = {
             "role": "assistant",
-            "content": res.json()["choices"][0]["message"]["content"],
+            "content": content,
         }
         # Adding the newly received and generated messages to the DynamoDB table in order to provide to the chatbot
-        update_dynamo_messages(user_message)
-        update_dynamo_messages(bot_message)
+        # Both messages are saved with a single request
+        conversation = get_conversation(chat_id)
+        save_conversation_turn(
+            chat_id, conversation, user_message, bot_message, metadata
+        )
 
     # If something goes wrong
     except Exception as e:
-        bot.send_message(
-            message["chat"]["id"],
+        get_bot().send_message(
+            chat_id,
             f"There was an error while processing your request: {e}",
         )
 
 
-# Main function
-def lambda_handler(event, context):
-    try:
-        # Getting the message from the event
-        message = json.loads(event["body"])["message"]
+# Function to process an update (a message sent to the bot)
+def process_update(update):
+    # Getting the message from the update
+    message = update["message"]
 
-        # Split between three variables bellow
+    # Split between three variables bellow
 
-        # Chat ID will guide your chatbot reply
-        chat_id = message["chat"]["id"]
-        # Sender's first name, registered by user's Telegram app
-        sender = message["from"]["first_name"]
+    # Chat ID will guide your chatbot reply
+    chat_id = message["chat"]["id"]
+    # Sender's first name, registered by user's Telegram app
+    sender = message["from"]["first_name"]
 
-        # Here, we check if it was a text message
-        if "text" in message:
-            # The message content
-            text = message["text"]
+    # Here, we check if it was a text message
+    if "text" in message:
+        # The message content
+        text = message["text"]
 
-            # Logging data about message received
-            logger.info(sender)
-            logger.info(text)
+        # Logging data about message received
+        logger.info(sender)
+        logger.info(text)
 
-            # If user is sending an available command
-            if text == "/start":
-                send_welcome(message)
-                return
-            elif text == "/clear":
-                clear_messages(message)
-                return
-            elif text.startswith("/image"):
-                request_image(message)
+        # If user is sending an available command
+        if text == "/start":
+            send_welcome(message)
+            return
+        elif text == "/clear":
+            clear_messages(message)
+            return
+        elif text == "/export":
+            export_messages(message)
+            return
+        elif text == "/cancel":
+            cancel_images(message)
+            return
+        elif text.startswith("/image"):
+            request_image(message)
+            return
+
+        # Otherwise, the conversation is only available to the allowed users
+        if not is_allowed_message(message):
+            return
+
+        # If enabled, the messages sent in a quick succession are answered together
+        claim = None
+        if coalesce_window:
+            fragments = collect_fragments(message)
+            if fragments is None:
                 return
+            texts, claim = fragments
+            text = "\n".join(texts)
+
+        # Checking if the cache should be skipped for this message
+        text, use_cache = split_cache_opt_out(text)
 
-            # Otherwise, we'll save the message to the DynamoDB table
-            update_dynamo_messages({"role": "user", "content": text})
+        # Otherwise, we'll add the message to the conversation
+        user_message = {"role": "user", "content": text}
 
-            # Here, we'll talk to ChatGPT
+        # Here, we'll talk to ChatGPT
 
-            # First, we get the messages list
-            messages = get_dynamodb_messages()
-            # Making an API request to the OpenAI API
-            res = openai.chat.completions.create(
-                model=model_engine,
-                messages=messages,
+        # First, we get the newest messages and keep the ones that fit the token budget
+        conversation = get_conversation(chat_id)
+        history = conversation["messages"] + [user_message]
+        messages = get_conversation_context(chat_id, history, conversation)
+        # Recalling the earlier turns related to the message, if any
+        if long_term_memory:
+            messages = add_recalled_turns(chat_id, conversation, history, messages)
+
+        # If the recent turns have photos, they're re-attached for the vision model
+        attached = None
+        if image_followup_turns:
+            attached = attach_recent_images(history, messages)
+        if attached:
+            response, metadata = reply_image_followup(message, attached, claim)
+        else:
+            # Checking if the user's quota admits the request (or which model answers it)
+            estimate = estimate_request_tokens({"messages": messages})
+            model = admit_request(message, estimate)
+            if model is None:
+                return
+
+            # Then, we reply the user's message (unless a newer message superseded it, and
+            # the reply was dropped)
+            response, metadata = reply_chat_completion(
+                chat_id,
+                messages,
+                use_cache,
+                model,
+                claim,
+                charge=lambda tokens: charge_quota(message, tokens),
             )
+            if metadata:
+                charge_quota(message, get_used_tokens(metadata, estimate, response))
+
+        # And save the whole turn to the DynamoDB table
+        if response is None:
+            return
+        bot_message = {"role": "assistant", "content": response}
+        save_conversation_turn(
+            chat_id, conversation, user_message, bot_message, metadata
+        )
+        return
+
+    # If a photo was sent
+    elif "photo" in message:
+        # We call the function to handle it
+        visual_input(message)
 
-            # Defining the response to be sent to the user
-            response = res.choices[0].message.content
-            # We'll also save the response to the DynamoDB table
-            update_dynamo_messages({"role": "assistant", "content": response})
+    # Other types of messages/content is not supported currently
+    else:
+        get_bot().send_message(chat_id, "This type of content is not supported")
 
-            # If desired, we can add the total tokens used on the request to the user
-            response += f"\n\nTotal Tokens: {res.usage.total_tokens}"
 
-            # Finally, we'll reply the user's message
-            bot.send_message(chat_id, response)
+# Function to get the route of an update (the handler it goes to), used to tag its metrics
+def get_update_route(update):
+    message = update.get("message") or {}
+    text = message.get("text")
+    if text is None:
+        return "photo" if "photo" in message else "other"
+    if text in ("/start", "/clear", "/export", "/cancel"):
+        return text[1:]
+    return "image" if text.startswith("/image") else "text"
+
+
+# Function to get the trace record of an update, scrubbed of any private content: the chat
+# and album IDs are hashed, and only the length of the texts (and the photo sizes) is kept
+def trace_record(update):
+    salt = trace_salt or os.environ["BOT_TOKEN"]
+
+    def scrub(value):
+        return hashlib.sha256(f"{salt}:{value}".encode()).hexdigest()[:12]
+
+    message = update.get("message") or {}
+    chat = message.get("chat") or {}
+    record = {
+        "ts": int(time.time() * 1000),
+        "chat": scrub(chat.get("id")),
+        "type": chat.get("type"),
+    }
+    text = message.get("text")
+    if text is not None:
+        # Only the command itself is kept (e.g. "/image"), along with the length of the rest
+        if text.startswith("/"):
+            command, _, text = text.partition(" ")
+            command = command.split("@")[0]
+            record["command"] = command if command in trace_commands else "/other"
+        record["text"] = len(text)
+    if "photo" in message:
+        record["photo"] = [[p["width"], p["height"]] for p in message["photo"]]
+        record["caption"] = len(message.get("caption") or "")
+        if message.get("media_group_id"):
+            record["group"] = scrub(message["media_group_id"])
+    return record
+
+
+# Function to check the secret token of a webhook request, if one was set for the webhook
+def is_valid_webhook(event):
+    if not webhook_secret:
+        return True
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    return headers.get("x-telegram-bot-api-secret-token") == webhook_secret
+
+
+# Function to send an update to the queue, to be processed by the worker handler
+# The FIFO queue keeps the updates of each chat in order, and drops repeated update IDs
+def enqueue_update(update):
+    get_sqs().send_message(
+        QueueUrl=os.environ["AWS_SQS_QUEUE_URL"],
+        MessageBody=json.dumps(update),
+        MessageGroupId=str(get_update_chat_id(update)),
+        MessageDeduplicationId=str(update["update_id"]),
+    )
+
+
+# Main function
+def lambda_handler(event, context):
+    try:
+        # Warm-up events only prepare the clients for the next updates
+        if event.get("warmup"):
+            start_metrics("warmup", None)
+            warm_up()
             return
 
-        # If a photo was sent
-        elif "photo" in message:
-            # We call the function to handle it
-            visual_input(message)
+        # Image jobs invoked by the function itself (without a queue) are run on their own
+        if "image_job" in event:
+            job = event["image_job"]
+            start_metrics("image_job", job["chat_id"])
+            run_image_job(**job)
+            return
 
-        # Other types of messages/content is not supported currently
-        else:
-            bot.send_message(chat_id, "This type of content is not supported")
+        # Rejecting requests without the webhook secret token
+        if not is_valid_webhook(event):
+            return {"statusCode": 401}
+
+        # Getting the update from the event
+        update = json.loads(event["body"])
+
+        # Logging the update as a trace record, if enabled
+        if trace_updates:
+            print("TRACE " + json.dumps(trace_record(update), separators=(",", ":")))
+
+        # Recording the latency of each stage of the update, tagged with its route and chat
+        route = "enqueue" if webhook_mode == "queue" else get_update_route(update)
+        start_metrics(route, get_update_chat_id(update))
+
+        # On queue mode, the update is only enqueued, so the webhook is answered right away
+        # If it can't be enqueued, the error response makes Telegram deliver it again
+        if webhook_mode == "queue":
+            try:
+                enqueue_update(update)
+            except Exception as e:
+                logger.error(e)
+                return {"statusCode": 500}
+            return {"statusCode": 200}
+
+        # Skipping the update if it was already delivered before
+        if not claim_update(update["update_id"]):
+            logger.info(f"Skipping duplicate update {update['update_id']}")
+            return
+
+        # Processing the update
+        process_update(update)
 
     # If something goes wrong
     except Exception as e:
         # We'll just log the error
         logger.error(e)
+
+    # Logging the metrics of the update, the connection reuse counters of the outbound calls
+    # and the cache hit rates
+    finally:
+        flush_metrics()
+        logger.info(f"HTTP transport: {get_http_stats()}")
+        logger.info(f"Cache: {get_cache_stats()}")
+
+
+# Worker function, processing the updates enqueued by the main function (SQS event source)
+# The failed messages are reported, so only them are received again (ReportBatchItemFailures)
+def worker_handler(event, context):
+    # Image jobs invoked by the function itself are run on their own
+    if "image_job" in event:
+        job = event["image_job"]
+        start_metrics("image_job", job["chat_id"])
+        try:
+            run_image_job(**job)
+        finally:
+            flush_metrics()
+        return
+
+    failures = []
+    failed_chats = set()
+
+    # The photos of an album (and the text messages sent in a quick succession) usually come
+    # on the same batch, but they're processed one by one, so all of them are buffered first
+    # (the first photo processed answers the album, and the last text the texts)
+    for record in event["Records"]:
+        message = json.loads(record["body"]).get("message") or {}
+        if "media_group_id" in message and "photo" in message:
+            buffer_album_photo(message)
+        elif coalesce_window and not message.get("text", "/").startswith("/"):
+            buffer_fragment(message)
+    for record in event["Records"]:
+        chat = record.get("attributes", {}).get("MessageGroupId")
+
+        # Once an update of a chat fails, the following ones must wait for it to be retried
+        if chat in failed_chats:
+            failures.append({"itemIdentifier": record["messageId"]})
+            continue
+
+        # Skipping the update if it was already processed before
+        update = json.loads(record["body"])
+        if not claim_update(update["update_id"]):
+            logger.info(f"Skipping duplicate update {update['update_id']}")
+            continue
+
+        start_metrics(get_update_route(update), get_update_chat_id(update))
+        try:
+            process_update(update)
+        # If something goes wrong, the update is released to be processed again
+        except Exception as e:
+            logger.error(e)
+            release_update(update["update_id"])
+            failed_chats.add(chat)
+            failures.append({"itemIdentifier": record["messageId"]})
+        # Logging the metrics of the update
+        finally:
+            flush_metrics()
+
+    # Logging the connection reuse counters of the outbound calls and the cache hit rates
+    logger.info(f"HTTP transport: {get_http_stats()}")
+    logger.info(f"Cache: {get_cache_stats()}")
+    return {"batchItemFailures": failures}
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of recorded traffic against the chatbot
+
+Turns the updates received by the chatbot into a compact JSONL trace (with the chat IDs
+hashed and the texts reduced to their lengths), or synthesizes one, and replays it
+against the Lambda handler (in process) or a bot.py server (polling the Telegram
+stand-in) on the local stand-ins of the benchmark, reporting the throughput, queueing
+delay, error rate and latency distribution of each update type.
+
+"""
+
+# Main dependencies
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import benchmark
+
+# Start of the replies that report a failure to the user
+error_replies = (
+    "There was an error",
+    "The image could not be retrieved",
+    "Error trying to generate",
+    "The bot is busy",
+)
+
+# Words used to fill the texts, as only their lengths are recorded
+filler_words = "tell me something about the way this works in a few words".split()
+
+
+# Function to read the records of a trace (one JSON object per line)
+def read_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Function to turn lines of logs or raw updates into trace records
+# The Lambda function logs the records (after "TRACE ") when TRACE_UPDATES is set, while the
+# raw updates (or webhook events, with the update on their body) are scrubbed here
+def convert_trace_lines(lines, trace_record):
+    for line in lines:
+        if "TRACE {" in line:
+            yield json.loads(line.split("TRACE ", 1)[1])
+        elif line.strip().startswith("{"):
+            update = json.loads(line)
+            if "body" in update:
+                update = json.loads(update["body"])
+            if "update_id" not in update:
+                continue
+            record = trace_record(update)
+            # The raw updates were received around the time they were sent
+            date = (update.get("message") or {}).get("date")
+            if date:
+                record["ts"] = date * 1000
+            yield record
+
+
+# Function to synthesize a trace: updates arriving at a rate (per second) from chats whose
+# activity follows a Zipf distribution, with a mix of update types (shares per type)
+def synthesize_trace(count, rate, chats, mix, seed):
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    chat_weights = [1 / (n + 1) for n in range(chats)]
+    records = []
+    ts = time.time()
+    while len(records) < count:
+        ts += rng.expovariate(rate)
+        chat = f"synthetic-{rng.choices(range(chats), chat_weights)[0]}"
+        kind = rng.choices(kinds, weights)[0]
+        record = {"ts": int(ts * 1000), "chat": chat, "type": "private"}
+        if kind in ("text", "image"):
+            record["text"] = int(rng.lognormvariate(3.5, 0.8))
+        if kind == "image":
+            record["command"] = "/image"
+        elif kind in ("photo", "album"):
+            record["photo"] = [[90, 90], [800, 800]]
+            record["caption"] = int(rng.lognormvariate(3, 0.5))
+        elif kind != "text":
+            record.update(command=f"/{kind}", text=0)
+        if kind == "album":
+            # The photos of an album arrive together, with the caption on the first one
+            group = f"{chat}-{len(records)}"
+            for n in range(rng.randint(2, 4)):
+                records.append(
+                    {**record, "group": group, "caption": 0 if n else record["caption"]}
+                )
+        else:
+            records.append(record)
+    return records[:count]
+
+
+# Function to get the update type of a record, used to group the results
+def get_record_kind(record):
+    if "photo" in record:
+        return "album" if record.get("group") else "photo"
+    return (record.get("command") or "/text")[1:]
+
+
+# Function to fill a text of the given length, unique for each update so no cached result
+# is used
+def fill_text(n, length):
+    words = [str(n)]
+    while len(" ".join(words)) < length:
+        words.append(filler_words[len(words) % len(filler_words)])
+    return " ".join(words)[: max(length, len(str(n)))]
+
+
+# Function to build the update of a record, for a replay chat ID
+def make_record_update(record, chat_id, n):
+    fields = {"chat": {"id": chat_id, "type": record.get("type") or "private"}}
+    fields["chat"]["first_name"] = "Replay"
+    fields["from"] = {"id": chat_id, "is_bot": False, "first_name": "Replay"}
+    if "photo" in record:
+        fields["photo"] = [
+            {
+                "file_id": f"replay-{n}-{i}",
+                "file_unique_id": f"replay-{n}-{i}",
+                "width": width,
+                "height": height,
+            }
+            for i, (width, height) in enumerate(record["photo"])
+        ]
+        if record.get("caption"):
+            fields["caption"] = fill_text(n, record["caption"])
+        if record.get("group"):
+            fields["media_group_id"] = f"replay-{record['group']}"
+        return benchmark.make_update(**fields)
+    text = fill_text(n, record.get("text") or 0) if record.get("text") else ""
+    command = record.get("command")
+    if command == "/other":
+        command = "/help"
+    if command:
+        text = f"{command} {text}".strip()
+    return benchmark.make_update(text, **fields)
+
+
+# Function to get the arrival time (in seconds from the start) of each record, following
+# the trace times (sped up) or an open-loop Poisson process at a fixed rate (per second)
+def get_arrivals(records, speedup, rate, seed):
+    if rate:
+        rng = random.Random(seed)
+        arrivals, t, group = [], 0.0, None
+        for record in records:
+            # The photos of an album keep arriving together
+            if not (record.get("group") and record.get("group") == group):
+                t += rng.expovariate(rate)
+            group = record.get("group")
+            arrivals.append(t)
+        return arrivals
+    start = records[0]["ts"]
+    return [(record["ts"] - start) / 1000 / speedup for record in records]
+
+
+# Updates being replayed, matched to the replies sent to their chats
+class Replay:
+    def __init__(self, records, arrivals):
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.units = []
+        self.by_update = {}
+        self.waiting = defaultdict(deque)
+        chat_ids = {}
+        groups = set()
+        for n, (record, arrival) in enumerate(zip(records, arrivals)):
+            chat_id = chat_ids.setdefault(record["chat"], 2000 + len(chat_ids))
+            group = record.get("group")
+            unit = {
+                "kind": get_record_kind(record),
+                "chat_id": chat_id,
+                "update": make_record_update(record, chat_id, n),
+                "arrival": arrival,
+                # Only one reply is sent to each album, so its other photos expect none
+                "expects_reply": not group or group not in groups,
+            }
+            groups.add(group)
+            self.units.append(unit)
+            self.by_update[unit["update"]["update_id"]] = unit
+
+    # Function to expect a reply to a unit, once it's sent
+    def expect(self, unit):
+        with self.lock:
+            if unit["expects_reply"]:
+                self.waiting[unit["chat_id"]].append(unit)
+
+    # Function to note the Bot API calls: the updates fetched, and the messages sent to each
+    # chat (taken as the answers to its updates, in order)
+    def on_telegram_call(self, method, params, result):
+        now = time.perf_counter()
+        if method == "getUpdates":
+            with self.lock:
+                for update in result:
+                    unit = self.by_update.get(update["update_id"])
+                    if unit is not None and "fetched" not in unit:
+                        unit["fetched"] = now
+        elif method.startswith("send") and method != "sendChatAction":
+            with self.lock:
+                waiting = self.waiting.get(int(params.get("chat_id") or 0))
+                if waiting:
+                    unit = waiting.popleft()
+                    unit["replied"] = now
+                    unit["reply"] = params.get("text") or ""
+                    self.done.notify_all()
+
+    # Function to wait for the expected replies, up to a deadline (monotonic clock)
+    def wait_replies(self, deadline):
+        with self.lock:
+            while any(self.waiting.values()):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return
+                self.done.wait(remaining)
+
+
+# Function to run the updates on the Lambda handler as they arrive, as separate invocations
+# would (on a pool of threads, or one thread each if the concurrency is unbounded)
+def replay_lambda(replay, settings, concurrency, timeout):
+    os.environ.update(settings)
+    import lambda_function
+
+    def invoke(unit):
+        unit["started"] = time.perf_counter()
+        try:
+            response = lambda_function.lambda_handler(
+                {"body": json.dumps(unit["update"])}, None
+            )
+            unit["failed"] = bool(response and response.get("statusCode", 200) >= 400)
+        except Exception as e:
+            unit["failed"] = True
+            print(f"Invocation failed: {e}")
+        unit["finished"] = time.perf_counter()
+
+    executor = ThreadPoolExecutor(concurrency or len(replay.units))
+    start = time.perf_counter()
+    futures = []
+    for unit in replay.units:
+        time.sleep(max(0, start + unit["arrival"] - time.perf_counter()))
+        unit["arrival"] += start
+        replay.expect(unit)
+        futures.append(executor.submit(invoke, unit))
+    for future in futures:
+        future.result()
+    replay.wait_replies(time.perf_counter() + timeout)
+    executor.shutdown()
+    return start
+
+
+# Function to run a bot.py server polling the stand-in, feeding it the updates as they
+# arrive
+def replay_bot(replay, settings, concurrency, timeout, polling_mode):
+    options = {"POLLING_MODE": polling_mode}
+    if concurrency:
+        options["MAX_CONCURRENT_UPDATES"] = str(concurrency)
+    process = benchmark.start_bot_server(settings, **options)
+
+    # Starting the clock once the server is polling
+    try:
+        start = time.perf_counter()
+        for unit in replay.units:
+            time.sleep(max(0, start + unit["arrival"] - time.perf_counter()))
+            unit["arrival"] += start
+            replay.expect(unit)
+            benchmark.push_update(unit["update"])
+        replay.wait_replies(time.perf_counter() + timeout)
+    finally:
+        benchmark.stop_bot_server(process)
+    return start
+
+
+# Function to summarize the replay per update type: the queueing delay (until the update
+# was fetched or started) and the latency (until it was answered) percentiles, in ms
+def summarize(replay, start):
+    kinds = defaultdict(list)
+    for unit in replay.units:
+        kinds[unit["kind"]].append(unit)
+    kinds["all"] = replay.units
+    ends = [unit.get("replied") or unit.get("finished") for unit in replay.units]
+    ends = [end for end in ends if end]
+    duration = max(ends + [start]) - start
+    results = {}
+    for kind, units in kinds.items():
+        errors = 0
+        queue, latencies = [], []
+        for unit in units:
+            reply = unit.get("reply")
+            if unit.get("failed") or (reply and reply.startswith(error_replies)):
+                errors += 1
+            elif unit["expects_reply"] and reply is None:
+                # Left unanswered
+                errors += 1
+                continue
+            pickup = unit.get("started") or unit.get("fetched")
+            if pickup:
+                queue.append((pickup - unit["arrival"]) * 1000)
+            end = unit.get("replied") or unit.get("finished")
+            if end and unit["expects_reply"]:
+                latencies.append((end - unit["arrival"]) * 1000)
+        queue.sort()
+        latencies.sort()
+        result = {"updates": len(units), "errors": errors}
+        result["error_rate"] = round(errors / len(units), 4)
+        for p in (50, 95):
+            result[f"queue_p{p}_ms"] = round(
+                benchmark.percentile(queue, p) if queue else math.nan, 2
+            )
+        for p in (50, 95, 99, 100):
+            name = "max_ms" if p == 100 else f"p{p}_ms"
+            result[name] = round(
+                benchmark.percentile(latencies, p) if latencies else math.nan, 2
+            )
+        results[kind] = result
+    last_arrival = max(unit["arrival"] for unit in replay.units) - start
+    summary = {
+        "updates": len(replay.units),
+        "duration_s": round(duration, 3),
+        "offered_per_s": (
+            round(len(replay.units) / last_arrival, 2) if last_arrival else None
+        ),
+        "throughput_per_s": (
+            round(len(replay.units) / duration, 2) if duration else None
+        ),
+    }
+    return {"summary": summary, "results": results}
+
+
+# Function to print the replay results, one row per update type
+def print_results(report):
+    columns = list(next(iter(report["results"].values())))
+    print(f"{'type':<12}" + "".join(f"{c:>14}" for c in columns))
+    for kind, result in report["results"].items():
+        print(f"{kind:<12}" + "".join(f"{result[c]:>14}" for c in columns))
+    print("  ".join(f"{k}={v}" for k, v in report["summary"].items()))
+
+
+# Reading the replay options
+parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+commands = parser.add_subparsers(dest="command", required=True)
+record = commands.add_parser("record", help="turn logs or raw updates into a trace")
+record.add_argument("input", nargs="+", help="Lambda logs or raw updates (JSONL)")
+record.add_argument("--output", required=True)
+record.add_argument("--salt", help="salt of the chat IDs hashes (TRACE_SALT)")
+synth = commands.add_parser("synth", help="synthesize a trace")
+synth.add_argument("--output", required=True)
+synth.add_argument("--updates", type=int, default=500)
+synth.add_argument("--rate", type=float, default=5, help="updates per second")
+synth.add_argument("--chats", type=int, default=50)
+synth.add_argument(
+    "--mix",
+    default="text=0.8,photo=0.06,album=0.03,image=0.03,clear=0.05,start=0.03",
+    help="share of each update type",
+)
+synth.add_argument("--seed", type=int, default=0)
+run = commands.add_parser("run", help="replay a trace")
+run.add_argument("trace")
+run.add_argument("--target", choices=("lambda", "bot"), default="lambda")
+run.add_argument("--polling-mode", default="async", help="of the bot.py server")
+run.add_argument("--speedup", type=float, default=1, help="of the trace times")
+run.add_argument("--rate", type=float, default=0, help="open-loop arrivals per second")
+run.add_argument("--concurrency", type=int, default=0, help="0 for unbounded")
+run.add_argument("--timeout", type=float, default=60, help="s to wait for replies")
+run.add_argument("--seed", type=int, default=0)
+run.add_argument("--telegram-latency", type=float, default=20, help="ms per request")
+run.add_argument("--openai-latency", type=float, default=500, help="ms per request")
+run.add_argument("--dynamodb-latency", type=float, default=5, help="ms per request")
+run.add_argument("--s3-latency", type=float, default=10, help="ms per request")
+run.add_argument("--image-latency", type=float, default=5000, help="ms per image")
+run.add_argument("--reply-words", type=int, default=60)
+run.add_argument("--photo-bytes", type=int, default=64 * 1024)
+run.add_argument("--output", help="file to save the results (JSON)")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.command == "record":
+        os.environ.setdefault("BOT_TOKEN", benchmark.bot_token)
+        if args.salt:
+            os.environ["TRACE_SALT"] = args.salt
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from lambda_function import trace_record
+
+        with open(args.output, "w") as output:
+            for path in args.input:
+                with open(path) as f:
+                    for item in convert_trace_lines(f, trace_record):
+                        output.write(json.dumps(item, separators=(",", ":")) + "\n")
+        sys.exit()
+
+    if args.command == "synth":
+        mix = {k: float(v) for k, v in (i.split("=") for i in args.mix.split(","))}
+        records = synthesize_trace(args.updates, args.rate, args.chats, mix, args.seed)
+        with open(args.output, "w") as f:
+            f.writelines(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        sys.exit()
+
+    benchmark.latency["telegram"] = args.telegram_latency / 1000
+    benchmark.latency["openai"] = args.openai_latency / 1000
+    benchmark.latency["dynamodb"] = args.dynamodb_latency / 1000
+    benchmark.latency["s3"] = args.s3_latency / 1000
+    benchmark.image_latency = args.image_latency / 1000
+    benchmark.reply_text = " ".join(["benchmark"] * args.reply_words)
+    benchmark.photo_bytes = b"\xff\xd8" + b"\0" * (args.photo_bytes - 2)
+    output_path = args.output and os.path.abspath(args.output)
+
+    # Building the updates of the trace, and the times they arrive at
+    records = sorted(read_trace(args.trace), key=lambda r: r["ts"])
+    if not records:
+        sys.exit("The trace has no updates")
+    replay = Replay(records, get_arrivals(records, args.speedup, args.rate, args.seed))
+
+    # Starting the stand-ins and pointing the clients to them
+    services_url = benchmark.start_fake_services()
+    dynamodb_url = benchmark.start_aws_service("dynamodb")
+    s3_url = benchmark.start_aws_service("s3")
+    benchmark.create_table(dynamodb_url, s3_url)
+    benchmark.telegram_listeners.append(replay.on_telegram_call)
+    settings = {
+        **benchmark.get_settings(services_url, dynamodb_url, s3_url),
+        # Every replayed chat is let in, and the metrics aren't logged
+        "ALLOWED_USERS": "*",
+        "METRICS": "false",
+        "ALBUM_WINDOW": "1",
+    }
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import telebot
+
+    telebot.apihelper.API_URL = services_url + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = services_url + "/file/bot{0}/{1}"
+
+    # Replaying the trace on the target
+    if args.target == "lambda":
+        start = replay_lambda(replay, settings, args.concurrency, args.timeout)
+    else:
+        start = replay_bot(
+            replay, settings, args.concurrency, args.timeout, args.polling_mode
+        )
+    report = {"settings": vars(args), **summarize(replay, start)}
+    print_results(report)
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
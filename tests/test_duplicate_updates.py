@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Redelivered webhook updates: Telegram delivers an update again (possibly out of order)
+when the webhook doesn't answer in time, and each update must reach OpenAI only once
+
+"""
+
+# Main dependencies
+import importlib
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+# Folder of the Lambda function
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings of the Lambda function while testing
+table_name = "chatgpt-test"
+admin_chat_id = 1000
+settings = {
+    "BOT_TOKEN": "123456:test",
+    "ADMIN_CHAT_ID": str(admin_chat_id),
+    "OPENAI_API_KEY": "sk-test",
+    "AWS_ACCESS_KEY_ID": "test",
+    "AWS_SECRET_ACCESS_KEY": "test",
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_DYNAMODB": table_name,
+    "METRICS": "false",
+    "HEDGE_PERCENTILE": "0",
+}
+
+
+# Stand-in of the Telegram bot, keeping the messages sent
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(
+            message_id=len(self.sent), chat=SimpleNamespace(id=chat_id)
+        )
+
+    def send_chat_action(self, *args, **kwargs):
+        pass
+
+
+# Stand-in of the OpenAI client, keeping the chat completion requests
+class FakeOpenAI:
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        usage = {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}
+        return SimpleNamespace(
+            model=kwargs["model"],
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Answer"))],
+            usage=SimpleNamespace(**usage, model_dump=lambda: usage),
+        )
+
+
+# Lambda function (a fresh module, so no client or cache is kept from another test), along
+# with the stand-ins of its clients
+@pytest.fixture
+def webhook(monkeypatch):
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.syspath_prepend(root)
+    with mock_dynamodb():
+        boto3.client("dynamodb", region_name="us-east-1").create_table(
+            TableName=table_name,
+            KeySchema=[
+                {"AttributeName": "pk", "KeyType": "HASH"},
+                {"AttributeName": "sk", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "pk", "AttributeType": "S"},
+                {"AttributeName": "sk", "AttributeType": "N"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        sys.modules.pop("lambda_function", None)
+        module = importlib.import_module("lambda_function")
+        bot, openai = FakeBot(), FakeOpenAI()
+        monkeypatch.setattr(module, "get_bot", lambda: bot)
+        monkeypatch.setattr(module, "get_openai", lambda: openai)
+        yield SimpleNamespace(module=module, bot=bot, openai=openai)
+        sys.modules.pop("lambda_function", None)
+
+
+# Function to build a text update from the admin chat
+def make_update(update_id, text):
+    chat = {"id": admin_chat_id, "type": "private", "first_name": "Test"}
+    message = {
+        "message_id": update_id,
+        "date": 1700000000,
+        "chat": chat,
+        "from": {"id": admin_chat_id, "is_bot": False, "first_name": "Test"},
+        "text": text,
+    }
+    return {"update_id": update_id, "message": message}
+
+
+# Function to deliver an update to the webhook
+def deliver(webhook, update):
+    return webhook.module.lambda_handler({"body": json.dumps(update)}, None)
+
+
+def test_redelivered_update_is_answered_once(webhook):
+    update = make_update(10, "Tell me something about the number 10")
+    deliver(webhook, update)
+    deliver(webhook, update)
+
+    assert len(webhook.openai.requests) == 1
+    assert len(webhook.bot.sent) == 1
+
+
+def test_out_of_order_redeliveries_are_answered_once(webhook):
+    first = make_update(20, "Tell me something about the number 20")
+    second = make_update(21, "Tell me something about the number 21")
+    for update in (second, first, second, first, first):
+        deliver(webhook, update)
+
+    requests = webhook.openai.requests
+    assert len(requests) == 2
+    asked = [request["messages"][-1]["content"] for request in requests]
+    assert asked == [second["message"]["text"], first["message"]["text"]]
+    assert len(webhook.bot.sent) == 2
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+DynamoDB round trips of a conversation turn: the user message, the response and its
+metadata are written with a single request (a transaction on the Lambda function, and a
+batch for the turns buffered by bot.py), whether the turn is a text or a vision one
+
+"""
+
+# Main dependencies
+import importlib
+import json
+import os
+import sys
+from collections import Counter
+from types import SimpleNamespace
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+# Folder of the Lambda function
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings of the Lambda function and of the bot while testing
+table_name = "chatgpt-test"
+admin_chat_id = 1000
+settings = {
+    "BOT_TOKEN": "123456:test",
+    "ADMIN_CHAT_ID": str(admin_chat_id),
+    "OPENAI_API_KEY": "sk-test",
+    "AWS_ACCESS_KEY_ID": "test",
+    "AWS_SECRET_ACCESS_KEY": "test",
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_DYNAMODB": table_name,
+    "METRICS": "false",
+    "HEDGE_PERCENTILE": "0",
+    "RATE_LIMITS": "false",
+}
+
+
+# Stand-in of the Telegram bot, keeping the messages sent
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(
+            message_id=len(self.sent), chat=SimpleNamespace(id=chat_id)
+        )
+
+    def send_chat_action(self, *args, **kwargs):
+        pass
+
+
+# Stand-in of the OpenAI client
+class FakeOpenAI:
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        usage = {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}
+        return SimpleNamespace(
+            model=kwargs["model"],
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Answer"))],
+            usage=SimpleNamespace(**usage, model_dump=lambda: usage),
+        )
+
+
+# Function to count the calls made to DynamoDB by a client, by operation
+def count_calls(client):
+    calls = Counter()
+    client.meta.events.register(
+        "before-call.dynamodb", lambda model, **kwargs: calls.update([model.name])
+    )
+    return calls
+
+
+# Function to create the conversations table on moto
+def create_table():
+    boto3.client("dynamodb", region_name="us-east-1").create_table(
+        TableName=table_name,
+        KeySchema=[
+            {"AttributeName": "pk", "KeyType": "HASH"},
+            {"AttributeName": "sk", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "pk", "AttributeType": "S"},
+            {"AttributeName": "sk", "AttributeType": "N"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+# Lambda function (a fresh module, so no client or cache is kept from another test), along
+# with the stand-ins of its clients and the DynamoDB calls it makes
+@pytest.fixture
+def webhook(monkeypatch):
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.syspath_prepend(root)
+    with mock_dynamodb():
+        create_table()
+        sys.modules.pop("lambda_function", None)
+        module = importlib.import_module("lambda_function")
+        bot, openai = FakeBot(), FakeOpenAI()
+        monkeypatch.setattr(module, "get_bot", lambda: bot)
+        monkeypatch.setattr(module, "get_openai", lambda: openai)
+        # The photos aren't downloaded, the vision model answers them directly
+        monkeypatch.setattr(
+            module,
+            "request_visual_completion",
+            lambda *args, **kwargs: ("Photo", {"model": module.vision_model}),
+        )
+        calls = count_calls(module.get_table().meta.client)
+        yield SimpleNamespace(module=module, bot=bot, calls=calls)
+        sys.modules.pop("lambda_function", None)
+
+
+# The bot (imported from a folder with its .env file) with write-behind enabled, along
+# with the DynamoDB calls it makes
+@pytest.fixture
+def bot(monkeypatch, tmp_path):
+    options = {"WRITE_BEHIND": "true", "WRITE_BEHIND_INTERVAL": "3600"}
+    (tmp_path / ".env").write_text(
+        "".join(f"{k}={v}\n" for k, v in {**settings, **options}.items())
+    )
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(root)
+    with mock_dynamodb():
+        create_table()
+        sys.modules.pop("bot", None)
+        module = importlib.import_module("bot")
+        calls = count_calls(module.table.meta.client)
+        yield SimpleNamespace(module=module, calls=calls)
+        sys.modules.pop("bot", None)
+
+
+# Function to build an update from the admin chat, with the given message fields
+def make_update(update_id, **fields):
+    chat = {"id": admin_chat_id, "type": "private", "first_name": "Test"}
+    message = {
+        "message_id": update_id,
+        "date": 1700000000,
+        "chat": chat,
+        "from": {"id": admin_chat_id, "is_bot": False, "first_name": "Test"},
+        **fields,
+    }
+    return {"update_id": update_id, "message": message}
+
+
+# Function to deliver an update to the webhook, counting only the calls made by the turn
+def deliver(webhook, update):
+    webhook.calls.clear()
+    webhook.module.lambda_handler({"body": json.dumps(update)}, None)
+    return dict(webhook.calls)
+
+
+def test_text_turn_round_trips(webhook):
+    calls = deliver(webhook, make_update(10, text="Tell me about the number 10"))
+
+    assert [text for _, text in webhook.bot.sent if text.startswith("Answer")]
+    # Claiming the update, reading the conversation (its metadata and newest messages),
+    # and writing both messages with a single transaction
+    assert calls == {"PutItem": 1, "GetItem": 1, "Query": 1, "TransactWriteItems": 1}
+
+
+def test_vision_turn_round_trips(webhook):
+    photo = [
+        {
+            "file_id": "photo",
+            "file_unique_id": "photo",
+            "width": 512,
+            "height": 512,
+            "file_size": 1000,
+        }
+    ]
+    update = make_update(20, photo=photo, caption="What does it show?")
+    calls = deliver(webhook, update)
+
+    assert webhook.bot.sent == [(admin_chat_id, "Photo")]
+    assert calls == {"PutItem": 1, "GetItem": 1, "Query": 1, "TransactWriteItems": 1}
+
+
+def test_write_behind_flush_round_trips(bot):
+    module = bot.module
+    chat_ids = (admin_chat_id, admin_chat_id + 1)
+    conversations = [module.get_conversation(chat_id) for chat_id in chat_ids]
+    for chat_id, conversation in zip(chat_ids, conversations):
+        for i in range(3):
+            module.queue_dynamo_turn(
+                chat_id,
+                conversation,
+                {"role": "user", "content": f"Question {i}"},
+                {"role": "assistant", "content": f"Answer {i}"},
+                {"model": "gpt-test", "total_tokens": 12},
+            )
+
+    # Buffered turns aren't written until the flush
+    bot.calls.clear()
+    assert module.pending_turns
+    module.flush_dynamo_turns()
+
+    # Reserving the sequence numbers of each chat, and writing every message with a batch
+    assert dict(bot.calls) == {"UpdateItem": 2, "BatchWriteItem": 1}
+    assert not module.pending_turns
+    items = module.table.query(
+        KeyConditionExpression=module.Key("pk").eq(module.chat_key(admin_chat_id))
+    )["Items"]
+    assert [int(item["sk"]) for item in items] == list(range(7))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Hedged requests: once the hedge answers, the slower request can't be interrupted, so its
+response must still reach the discard function (to charge its tokens), and its stages
+mustn't be recorded on the next update
+
+"""
+
+# Main dependencies
+import importlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# Folder of the Lambda function
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Fresh Lambda function module, with the metrics enabled and the requests always hedged
+@pytest.fixture
+def module(monkeypatch):
+    monkeypatch.setenv("BOT_TOKEN", "123456:test")
+    monkeypatch.setenv("METRICS", "true")
+    monkeypatch.syspath_prepend(root)
+    sys.modules.pop("lambda_function", None)
+    module = importlib.import_module("lambda_function")
+    monkeypatch.setattr(module, "get_hedge_delay", lambda model: 0.05)
+    yield module
+    sys.modules.pop("lambda_function", None)
+
+
+def test_late_response_is_discarded(module):
+    released = threading.Event()
+    discarded = []
+
+    # The first request only answers after the hedge one, once the update is over
+    def request(model, timeout):
+        if model == "slow":
+            released.wait(5)
+        with module.span("openai.chat.completions"):
+            pass
+        return {"model": model, "usage": {"total_tokens": 7}}
+
+    module.start_metrics("text", 1000)
+    result = module.hedged_request(request, "slow", "fast", 5, discarded.append)
+    assert result["model"] == "fast"
+    assert discarded == []
+
+    # The next update starts before the slow response arrives
+    module.start_metrics("text", 1001)
+    released.set()
+    deadline = time.monotonic() + 5
+    while not discarded and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert [result["model"] for result in discarded] == ["slow"]
+    assert module.metrics_context["spans"] == {}
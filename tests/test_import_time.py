@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Cold start checks of the Lambda function: importing it must not load the heavy SDKs (they
+are imported on first use), and must stay fast
+
+"""
+
+# Main dependencies
+import os
+import subprocess
+import sys
+
+# Folder of the Lambda function
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# SDKs that must only be imported on first use
+heavy_modules = ("boto3", "botocore", "telebot", "openai", "requests")
+
+# Maximum cumulative import time (in ms) of the Lambda function module
+import_threshold_ms = 200
+
+
+# Function to import the Lambda function on a fresh interpreter, returning its output and
+# the import times it reported (python -X importtime)
+def import_lambda_function():
+    code = "import sys, lambda_function; print(','.join(sorted(sys.modules)))"
+    env = {"PATH": os.environ.get("PATH", ""), "BOT_TOKEN": "123456:test"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=root,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.strip().split(","), result.stderr
+
+
+def test_import_skips_heavy_sdks():
+    modules, _ = import_lambda_function()
+    loaded = [m for m in modules if m.split(".")[0] in heavy_modules]
+    assert not loaded, f"imported at module load: {loaded}"
+
+
+def test_import_time_under_threshold():
+    _, report = import_lambda_function()
+    # Lines look like "import time: self [us] | cumulative | module"
+    times = {
+        line.split("|")[2].strip(): int(line.split("|")[1])
+        for line in report.splitlines()
+        if line.startswith("import time:")
+        and line.count("|") == 2
+        and line.split("|")[1].strip().isdigit()
+    }
+    import_ms = times["lambda_function"] / 1000
+    assert import_ms < import_threshold_ms, f"lambda_function took {import_ms} ms"
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limited calls: Telegram answers 429 with the time to wait on the response body (not on
+a Retry-After header), and the call must be sent again once it's over, even when the rate
+limits aren't enforced
+
+"""
+
+# Main dependencies
+import importlib
+import json
+import os
+import sys
+
+import pytest
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+# Folder of the Lambda function
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Stand-in of the Bot API, answering the first call with a 429
+class RateLimitedAdapter(BaseAdapter):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        response = Response()
+        response.request = request
+        response.url = request.url
+        if self.calls == 1:
+            response.status_code = 429
+            body = {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 3",
+                "parameters": {"retry_after": 3},
+            }
+        else:
+            response.status_code = 200
+            body = {"ok": True, "result": True}
+        response._content = json.dumps(body).encode()
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    def close(self):
+        pass
+
+
+# HTTP session of a fresh Lambda function module, without the rate limits, along with
+# the Bot API stand-in and the waits made
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setenv("BOT_TOKEN", "123456:test")
+    monkeypatch.setenv("METRICS", "false")
+    monkeypatch.setenv("RATE_LIMITS", "false")
+    monkeypatch.syspath_prepend(root)
+    sys.modules.pop("lambda_function", None)
+    module = importlib.import_module("lambda_function")
+    waits = []
+    monkeypatch.setattr(module.time, "sleep", waits.append)
+    session = module.get_http_session()
+    adapter = RateLimitedAdapter()
+    session.mount("https://", adapter)
+    yield session, adapter, waits
+    sys.modules.pop("lambda_function", None)
+
+
+def test_telegram_429_is_sent_again(session):
+    session, adapter, waits = session
+    response = session.post(
+        "https://api.telegram.org/bot123456:test/sendMessage",
+        params={"chat_id": 1000, "text": "Hi"},
+    )
+
+    assert response.status_code == 200
+    assert adapter.calls == 2
+    assert waits == [3.0]